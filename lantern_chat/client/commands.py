@@ -175,11 +175,12 @@ def cmd_snap(ctx, _):
             if not ret or frame is None:
                 notify(ctx, "[system] Could not capture frame from webcam")
                 return
-            success, encoded = _cv2.imencode('.png', frame)
+            # webcam frames are photos, a jpeg is a fraction of the size of a png of one
+            success, encoded = _cv2.imencode('.jpg', frame, [_cv2.IMWRITE_JPEG_QUALITY, ctx.config.IMG_QUALITY])
             if not success or encoded is None:
                 notify(ctx, "[system] Could not encode webcam frame")
                 return
-            ctx.network.send_img_bytes(encoded.tobytes(), "snap.png", dm_target)
+            ctx.network.send_img_bytes(encoded.tobytes(), "snap.jpg", dm_target)
         except Exception as exc:
             notify(ctx, f"[system] Snap failed: {exc}")
         finally:
@@ -191,6 +192,30 @@ def cmd_snap(ctx, _):
     return True
 
 
+@register("/saveimg", "Download the latest image in this view")
+def cmd_saveimg(ctx, _):
+    # only a preview gets sent around, this fetches the original from the server
+    with ctx.state.lock:
+        if ctx.state.current_view == "dm" and ctx.state.dm_target:
+            msgs = list(ctx.state.dm_conversations.get(ctx.state.dm_target, []))
+        else:
+            msgs = list(ctx.state.messages)
+    m = next((m for m in reversed(msgs) if m.blob), None)
+    if m is None:
+        notify(ctx, "[system] No image to save here")
+        return True
+    name = os.path.basename(m.text.rsplit("[image: ", 1)[-1].rstrip("]")) or "image"
+    folder = os.path.expanduser("~/Downloads")
+    if not os.path.isdir(folder):
+        folder = os.getcwd()
+    path = os.path.join(folder, name)
+    if os.path.exists(path):
+        path = os.path.join(folder, f"{m.blob[:8]}-{name}")
+    notify(ctx, f"[system] Downloading {name}...")
+    ctx.network.save_image(m.blob, path)
+    return True
+
+
 
 
 @register("/dm ", "Open DM with a user", prefix=True)
@@ -297,6 +322,12 @@ def cmd_reload(ctx, _):
     ctx.network.send_admin_command("reload", "")
     return True
 
+
+@register("/handlerstats", "Show the busiest server handlers (admin)")
+def cmd_handlerstats(ctx, _):
+    ctx.network.send_admin_command("handlerstats", "")
+    return True
+
 '''
 # /snap command but with multiple shots 
 @register("/snapburst ", "Send multiple webcam snapshots: /snapburst <count>", prefix=True)
@@ -332,11 +363,11 @@ def cmd_snapburst(ctx, args):
                 if not ret or frame is None:
                     notify(ctx, f"[system] Could not capture frame {i+1} from webcam")
                     continue
-                success, encoded = _cv2.imencode('.png', frame)
+                success, encoded = _cv2.imencode('.jpg', frame, [_cv2.IMWRITE_JPEG_QUALITY, ctx.config.IMG_QUALITY])
                 if not success or encoded is None:
                     notify(ctx, f"[system] Could not encode webcam frame {i+1}")
                     continue
-                ctx.network.send_img_bytes(encoded.tobytes(), f"snapburst_{i+1}.png", dm_target)
+                ctx.network.send_img_bytes(encoded.tobytes(), f"snapburst_{i+1}.jpg", dm_target)
         except Exception as exc:
             notify(ctx, f"[system] Snap burst failed: {exc}")
         finally:
@@ -50,7 +50,19 @@ class Config:
         self.MAX_MESSAGE_LEN = 400
         self.MAX_INPUT_LEN = 300
         self.MAX_MESSAGES = 500
+        # how many history messages to ask for at a time from servers that page it
+        self.HISTORY_PAGE = 50
         self.SERVER_RESPONSE_TIMEOUT = 15
+        # images bigger than this (longest side, px) or not already png/jpeg/gif/webp get shrunk and sent as
+        # jpegs at this quality - anything else is sent as the original file
+        self.IMG_MAX_DIMENSION = self._config_int(file_config, "img_max_dimension", 2048)
+        self.IMG_QUALITY = max(1, min(self._config_int(file_config, "img_quality", 85), 95))
+
+    def _config_int(self, file_config, key, default):
+        try:
+            return int(file_config.get(key, default))
+        except (TypeError, ValueError):
+            return default
 
     def _load_config(self):
         if not os.path.exists(_CONFIG_FILE):
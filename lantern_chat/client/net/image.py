@@ -5,10 +5,11 @@ import io
 import os
 
 try:
-    from PIL import Image
+    from PIL import Image, ImageOps
     _PIL_AVAILABLE = True
 except ImportError:
     Image = None
+    ImageOps = None
     _PIL_AVAILABLE = False
 
 IMG_MAX_WIDTH = 80
@@ -35,6 +36,18 @@ def _img_to_rows(data: bytes):
     return rows
 
 
+def _preview_to_rows(data: bytes):
+    # a preview the server made is already sized for the terminal - one pixel per cell, no resizing
+    # anything bigger than that goes the normal way
+    if not _PIL_AVAILABLE:
+        return None
+    img = Image.open(io.BytesIO(data)).convert("RGB")
+    if img.width > IMG_MAX_WIDTH or img.height > IMG_MAX_HEIGHT:
+        return _img_to_rows(data)
+    px = img.load()
+    return [[("█",) + px[x, y] for x in range(img.width)] for y in range(img.height)]
+
+
 def get_clipboard_image():
     # an attempt to get imgs from cliboard - this is so cancer 
     # only tested on linux so if u have a mac please lmk.
@@ -11,6 +11,8 @@ class NetworkManager(SendMixin, ReceiveMixin):
         self.state = state
         self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
         self._send_lock = threading.Lock()  # guards all writes to self.sock
+        self._reader = None  # FrameReader for self.sock, see ReceiveMixin._recv
+        self.proto = 1  # goes up to whatever the server answers our [HELLO] with
         self.last_ping_sent = 0.0
         self.last_ping_recv = 0.0
         self.ping_ms = None
@@ -18,6 +20,7 @@ class NetworkManager(SendMixin, ReceiveMixin):
     def connect(self):
         try:
             self.sock.connect((self.config.SERVER_HOST, self.config.SERVER_PORT))
+            self.send_hello()
             self._send(f"[LOGIN]|{self.config.USERNAME}|{self.config.PASSWORD}")
         except OSError:
             with self.state.lock:
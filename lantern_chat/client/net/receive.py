@@ -4,19 +4,295 @@ import time
 import platform
 import subprocess
 
-from lantern_chat.frame import recv_msg
+from lantern_chat.frame import FrameReader
+from lantern_chat.protocol import PROTO_VERSION
 from lantern_chat.client.state import Message
-from lantern_chat.client.net.image import _img_to_rows
+from lantern_chat.client.net.image import _img_to_rows, _preview_to_rows
+
+
+# join history as it streams in - batches from new servers, json chunks from old ones
+_HISTORY_TAGS = ("[CHANNEL_HISTORY_BATCH]|", "[CHANNEL_HISTORY]|")
+# how many rendered images to keep around by hash
+_BLOB_CACHE = 64
 
 
 class ReceiveMixin:
+    def _recv_message(self):
+        # (text, blob) or None - one buffered reader per socket, reconnecting swaps self.sock out so start a fresh one then
+        if self._reader is None or self._reader.sock is not self.sock:
+            self._reader = FrameReader(self.sock)
+        return self._reader.read_message()
+
+    def _recv(self):
+        # just the text, for places that dont care about attachments
+        got = self._recv_message()
+        return got[0] if got else None
+
+    def _handle_hello(self, msg):
+        # server answered our [HELLO] - from here on we can send it v2 frames
+        try:
+            self.proto = min(int(msg.split("|", 1)[1]), PROTO_VERSION)
+        except (IndexError, ValueError):
+            pass
+
+    def _history_entries(self, history, dm=False):
+        # server history json -> Message list, dm lines get the "[sender]: " prefix the live ones have
+        # image lines carry the hash of the image, their previews get fetched in the background
+        out = []
+        for m in history:
+            sender = m.get("sender", "")
+            text = m.get("text", "")
+            digest = m.get("blob")
+            out.append(Message(
+                text=f"[{sender}]: {text}" if dm else text,
+                is_self=sender == self.config.USERNAME,
+                ts=m.get("timestamp", 0),
+                seq=m.get("id"),
+                img_rows=self.state.blob_rows.get(digest) if digest else None,
+                blob=digest,
+            ))
+            if digest:
+                self._fetch_preview(digest)
+        return out
+
+    def _fetch_preview(self, digest):
+        # ask for the preview of an image we've only got the hash of, unless we have it or its already coming
+        # (None in blob_fetch is a preview on its way, a bytearray is a download of the original)
+        with self.state.lock:
+            if digest in self.state.blob_rows or digest in self.state.blob_fetch:
+                return
+            self.state.blob_fetch[digest] = None
+        self._send(f"[REQ_PREVIEW]|{digest}")
+
+    def _fetch_blob(self, digest, path=None):
+        # download the original image to path, a range at a time. no path is just to draw it
+        with self.state.lock:
+            if path is not None:
+                self.state.blob_save[digest] = path
+            if isinstance(self.state.blob_fetch.get(digest), bytearray):
+                return
+            self.state.blob_fetch[digest] = bytearray()
+        self._send(f"[REQ_BLOB]|{digest}|0")
+
+    def _on_preview(self, msg, blob):
+        # [PREVIEW]|<hash> + png
+        digest = msg.split("|", 1)[1]
+        with self.state.lock:
+            if digest in self.state.blob_fetch and self.state.blob_fetch[digest] is None:
+                del self.state.blob_fetch[digest]
+        self._show_preview(digest, blob)
+
+    def _show_preview(self, digest, data):
+        # draw a preview the server sent. an empty one means it couldnt make one (previews turned off,
+        # or the worker failed), so get the original and draw that like a pre-v5 client would
+        if not data:
+            with self.state.lock:
+                have = digest in self.state.blob_rows
+            if not have:
+                self._fetch_blob(digest)
+            return
+        try:
+            rows = _preview_to_rows(data)
+        except Exception:
+            rows = None
+        self._cache_blob(digest, rows)
+
+    def _on_upload_result(self, msg):
+        # [UPLOAD_DONE]|<hash> or [UPLOAD_FAIL]|<hash>|<reason> - answers our commits in order.
+        # a fail with no commit out is [UPLOAD_BEGIN] being turned down, so the whole upload is off
+        parts = msg.split("|", 2)
+        digest = parts[1]
+        with self.state.lock:
+            up = self.state.uploads.get(digest)
+            if up is None:
+                return
+            if up["sent"]:
+                up["sent"].pop(0)
+            else:
+                up["posts"] = []
+            if not up["posts"] and not up["sent"]:
+                del self.state.uploads[digest]
+            if msg.startswith("[UPLOAD_FAIL]|"):
+                reason = parts[2] if len(parts) > 2 else "unknown error"
+                self.state.messages.append(Message(text=f"[system] Image upload failed: {reason}", is_self=True, ts=time.time()))
+
+    def _on_blob(self, msg, blob):
+        # [BLOB]|<hash>|<offset>|<total> + bytes - ask for the next range, or save it once its all here
+        parts = msg.split("|", 3)
+        if len(parts) < 4 or blob is None:
+            return
+        digest = parts[1]
+        try:
+            offset, total = int(parts[2]), int(parts[3])
+        except ValueError:
+            return
+        with self.state.lock:
+            buf = self.state.blob_fetch.get(digest)
+            if not isinstance(buf, bytearray) or offset != len(buf):
+                return  # not something we asked for (or from before a reconnect)
+            buf += blob
+            done = len(buf) >= total or not blob
+            if done:
+                del self.state.blob_fetch[digest]
+                path = self.state.blob_save.pop(digest, None)
+        if not done:
+            self._send(f"[REQ_BLOB]|{digest}|{len(buf)}")
+            return
+        if digest not in self.state.blob_rows:
+            # fetched to draw (no preview to be had) - or saved before its preview ever turned up
+            try:
+                rows = _img_to_rows(bytes(buf))
+            except Exception:
+                rows = None
+            self._cache_blob(digest, rows)
+        if path is None:
+            return
+        try:
+            with open(path, "wb") as f:
+                f.write(buf)
+            text = f"[system] saved image to {path}"
+        except OSError as e:
+            text = f"[system] couldn't save image: {e}"
+        with self.state.lock:
+            self.state.messages.append(Message(text=text, is_self=True, ts=time.time()))
+
+    def _cache_blob(self, digest, rows):
+        # remember an image's rows and fill them into every message thats been waiting on it
+        if rows is None:
+            return
+        with self.state.lock:
+            cache = self.state.blob_rows
+            cache[digest] = rows
+            while len(cache) > _BLOB_CACHE:
+                del cache[next(iter(cache))]
+            for msgs in [self.state.messages] + list(self.state.dm_conversations.values()):
+                for m in msgs:
+                    if m.blob == digest and m.img_rows is None:
+                        m.img_rows = rows
+
+    def _more_history(self, key, count):
+        # a short page means theres nothing older on the server. caller holds state.lock
+        self.state.history_more[key] = self.proto >= 3 and count >= self.config.HISTORY_PAGE
+        self.state.history_pending.discard(key)
+
+    def _own_line(self, m):
+        # something we sent to the channel and showed straight away, before the server gave it an id
+        return m.is_self and m.seq is None and m.text.startswith(f"[{self.config.USERNAME}]: ")
+
+    def _on_channel_history(self, msg):
+        # [CHANNEL_HISTORY_BATCH]s (or an old server's [CHANNEL_HISTORY] chunks), [CHANNEL_RESYNC] and
+        # [CHANNEL_HISTORY_END] - used by the main loop and the reconnect handshake. True once its all in
+        if msg.startswith("[CHANNEL_HISTORY_BATCH]|"):
+            # a few whole messages, one json object per line - parsed here, shown straight away
+            entries = []
+            for line in msg.split("|", 1)[1].split("\n"):
+                try:
+                    entries.extend(self._history_entries([json.loads(line)]))
+                except (ValueError, AttributeError):
+                    continue
+            with self.state.lock:
+                self._merge_history(entries)
+            return False
+        with self.state.lock:
+            if msg == "[CHANNEL_RESYNC]":
+                # we were gone too long (or missed a purge) - whats coming is a fresh page, not a gap
+                self.state.messages = []
+                self.state.channel_sync = None
+                return False
+            if msg.startswith("[CHANNEL_HISTORY]|"):
+                parts = msg.split("|", 2)
+                if len(parts) == 3:
+                    try:
+                        idx = int(parts[1])
+                    except ValueError:
+                        return False
+                    while len(self.state.channel_history_buffer) <= idx:
+                        self.state.channel_history_buffer.append("")
+                    self.state.channel_history_buffer[idx] = parts[2]
+                return False
+        # [CHANNEL_HISTORY_END] - an old server's chunks only make sense all together
+        full = "".join(self.state.channel_history_buffer)
+        try:
+            entries = self._history_entries(json.loads(full)) if full else []
+        except (ValueError, AttributeError):
+            entries = []
+        with self.state.lock:
+            self._merge_history(entries)
+            if self.state.channel_sync != "delta":
+                self._more_history("channel", self.state.channel_history_count)
+            self.state.channel_history_buffer = []
+            self.state.channel_history_count = 0
+            self.state.channel_sync = None
+            self.state.channel_history_ready = True
+            self.state.authenticated = True
+        return True
+
+    def _merge_history(self, entries):
+        # add join/reconnect history to the channel. caller holds state.lock
+        msgs = self.state.messages
+        if self.state.channel_sync == "delta":
+            # just what we missed. it has the server's copy of anything we sent after `since`,
+            # so the unconfirmed copy we showed when sending it goes (newest first)
+            sent = {}
+            for e in entries:
+                if e.is_self:
+                    sent[e.text] = sent.get(e.text, 0) + 1
+            for i in range(len(msgs) - 1, -1, -1):
+                if sent.get(msgs[i].text) and self._own_line(msgs[i]):
+                    sent[msgs[i].text] -= 1
+                    del msgs[i]
+        msgs.extend(entries)
+        msgs[:] = msgs[-self.config.MAX_MESSAGES :]
+        self.state.channel_history_count += len(entries)
+
+    def _on_chat_line(self, msg, seq=None):
+        # plain channel line ("[alice]: hi", "[bob joined]"...), seq is its id when the server sent one
+        with self.state.lock:
+            is_self = msg.startswith(
+                f"[{self.config.USERNAME}]:"
+            ) or msg.startswith(f"[{self.config.USERNAME}] system")
+            self.state.messages.append(
+                Message(text=msg[: self.config.MAX_MESSAGE_LEN], is_self=is_self, ts=time.time(), seq=seq)
+            )
+            self.state.messages[:] = self.state.messages[
+                -self.config.MAX_MESSAGES :
+            ]
+            # notify on new messages unless dnd is on and window is focused
+            if not is_self and not self.state.dnd and not self.state.is_window_focused():
+                try:
+                    if platform.system() == "Darwin":
+                        safe_notif = msg[:80].replace('"', '').replace('\\', '')
+                        subprocess.Popen(
+                            ["osascript", "-e", f'display notification "{safe_notif}" with title "Lantern"'],
+                            stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+                        )
+                    elif platform.system() == "Linux":
+                        safe_msg = msg[:80].replace("\\", "")
+                        subprocess.Popen(
+                            ["notify-send", "Lantern", safe_msg, "-t", "4000"],
+                            stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+                        )
+                except Exception:
+                    pass
+
     def receive(self):
         while self.state.running:
             try:
-                msg = recv_msg(self.sock)
+                got = self._recv_message()
+                msg, blob = got if got else (None, None)
                 if msg is None:
                     if self.state.banned:
                         break
+                    # half downloaded images start over on the new connection
+                    # and uploads carry on from what the server has, whoevers sending them now stops
+                    with self.state.lock:
+                        refetch = list(self.state.blob_fetch.items())
+                        self.state.blob_fetch = {}
+                        for up in self.state.uploads.values():
+                            up["run"] = None
+                            # cant know if a commit got there before the drop, so those go again
+                            up["posts"][:0] = up["sent"]
+                            up["sent"] = []
                     # attempt reconnect
                     for attempt in range(1, 6):
                         wait = 2 ** (attempt - 1)  # 1, 2, 4, 8, 16
@@ -34,21 +310,26 @@ class ReceiveMixin:
                             self.sock = _socket.socket(_socket.AF_INET, _socket.SOCK_STREAM)
                             self.sock.connect((self.config.SERVER_HOST, self.config.SERVER_PORT))
                             # re-authenticate
+                            self.send_hello()
                             self._send(f"[LOGIN]|{self.config.USERNAME}|{self.config.PASSWORD}")
                             with self.state.lock:
                                 self.state.authenticated = False
                                 self.state.channel_history_ready = False
                                 self.state.channel_history_buffer = []
+                                self.state.channel_history_count = 0
                                 self.state.disp_index = {}
+                                self.state.history_pending = set()
                             # wait for auth
                             deadline = time.time() + 10
                             while time.time() < deadline:
-                                m = recv_msg(self.sock)
+                                m = self._recv()
                                 if m is None:
                                     break
                                 with self.state.lock:
                                     self.state.last_received_from_server = time.time()
-                                if m.startswith("[AUTH_OK]"):
+                                if m.startswith("[HELLO]|"):
+                                    self._handle_hello(m)
+                                elif m.startswith("[AUTH_OK]"):
                                     parts = m.split("|", 1)
                                     if len(parts) > 1:
                                         with self.state.lock:
@@ -63,31 +344,20 @@ class ReceiveMixin:
                                 # wait for history
                                 deadline2 = time.time() + 10
                                 while time.time() < deadline2:
-                                    m = recv_msg(self.sock)
+                                    m = self._recv()
                                     if m is None:
                                         break
                                     with self.state.lock:
                                         self.state.last_received_from_server = time.time()
-                                    # handle CHANNEL_HISTORY and CHANNEL_HISTORY_END inline
-                                    if m.startswith("[CHANNEL_HISTORY]|"):
-                                        parts = m.split("|", 2)
-                                        if len(parts) == 3:
-                                            try:
-                                                idx = int(parts[1])
-                                                chunk = parts[2]
-                                                with self.state.lock:
-                                                    while len(self.state.channel_history_buffer) <= idx:
-                                                        self.state.channel_history_buffer.append("")
-                                                    self.state.channel_history_buffer[idx] = chunk
-                                            except Exception:
-                                                pass
-                                    elif m == "[CHANNEL_HISTORY_END]":
-                                        with self.state.lock:
-                                            self.state.channel_history_ready = True
-                                            self.state.authenticated = True
-                                        break
+                                    # handle the history (just the gap, usually) inline
+                                    if m.startswith(_HISTORY_TAGS) or m in ("[CHANNEL_HISTORY_END]", "[CHANNEL_RESYNC]"):
+                                        if self._on_channel_history(m):
+                                            break
                                     elif m.startswith("[USERS]|"):
+                                        # the online list as of now - [PRESENCE] deltas from here on go on top of this one,
+                                        # not whatever we had before the drop
                                         with self.state.lock:
+                                            self.state.users = set(u for u in m.split("|", 1)[1].split(";") if u)
                                             self.state.authenticated = True
                                         break
                             with self.state.lock:
@@ -96,6 +366,17 @@ class ReceiveMixin:
                                 notice2 = Message(text="[system] reconnected!", is_self=True, ts=time.time())
                                 with self.state.lock:
                                     self.state.messages.append(notice2)
+                                for digest, buf in refetch:
+                                    if buf is None:
+                                        self._fetch_preview(digest)
+                                    else:
+                                        self._fetch_blob(digest, self.state.blob_save.get(digest))
+                                with self.state.lock:
+                                    resume = [(d, len(up["raw"])) for d, up in self.state.uploads.items()]
+                                    for up in self.state.uploads.values():
+                                        up["run"] = True
+                                for digest, size in resume:
+                                    self._send(f"[UPLOAD_BEGIN]|{digest}|{size}")
                                 break  # break out of retry loop, back to main receive loop
                         except Exception:
                             pass
@@ -120,6 +401,10 @@ class ReceiveMixin:
                         )
                     continue
 
+                if msg.startswith("[HELLO]|"):
+                    self._handle_hello(msg)
+                    continue
+
                 if msg.startswith("[AUTH_OK]"):
                     # capture session token if provided
                     parts = msg.split("|", 1)
@@ -144,47 +429,66 @@ class ReceiveMixin:
                             pass
                     continue
 
-                if msg.startswith("[CHANNEL_HISTORY]|"):
+                if msg.startswith(_HISTORY_TAGS) or msg in ("[CHANNEL_HISTORY_END]", "[CHANNEL_RESYNC]"):
+                    self._on_channel_history(msg)
+                    continue
+
+                if msg.startswith("[BLOB]|"):
+                    self._on_blob(msg, blob)
+                    continue
+
+                if msg.startswith("[PREVIEW]|"):
+                    self._on_preview(msg, blob)
+                    continue
+
+                if msg.startswith("[UPLOAD_OK]|"):
                     parts = msg.split("|", 2)
-                    if len(parts) >= 3:
-                        idx, chunk = int(parts[1]), parts[2]
-                        with self.state.lock:
-                            while len(self.state.channel_history_buffer) <= idx:
-                                self.state.channel_history_buffer.append("")
-                            self.state.channel_history_buffer[idx] = chunk
+                    if len(parts) == 3 and parts[2].isdigit():
+                        self._start_upload(parts[1], int(parts[2]))
+                    continue
+
+                if msg.startswith(("[UPLOAD_DONE]|", "[UPLOAD_FAIL]|")):
+                    self._on_upload_result(msg)
                     continue
 
-                if msg == "[CHANNEL_HISTORY_END]":
+                if msg.startswith("[BLOB_MISSING]|"):
+                    # server doesnt have it (anymore) - the message just stays as "[image: name]"
+                    digest = msg.split("|", 1)[1]
                     with self.state.lock:
-                        try:
-                            full = "".join(self.state.channel_history_buffer)
-                            if full:
-                                history = json.loads(full)
-                                for m in history:
-                                    text = m.get("text", "")
-                                    sender = m.get("sender", "")
-                                    is_self = sender == self.config.USERNAME
-                                    ts = m.get("timestamp", 0)
-                                    self.state.messages.append(Message(text=text, is_self=is_self, ts=ts))
-                                self.state.messages[:] = self.state.messages[
-                                    -self.config.MAX_MESSAGES :
-                                ]
-                            self.state.channel_history_buffer = []
-                            self.state.channel_history_ready = True
-                            self.state.authenticated = True
-                        except Exception:
-                            self.state.channel_history_buffer = []
-                            self.state.channel_history_ready = True
-                            self.state.authenticated = True
+                        self.state.blob_fetch.pop(digest, None)
+                        if self.state.blob_save.pop(digest, None):
+                            self.state.messages.append(Message(
+                                text="[system] that image isn't on the server anymore", is_self=True, ts=time.time(),
+                            ))
+                    continue
+
+                if msg.startswith("[CHANNEL_HISTORY_PAGE]|"):
+                    # older page we asked for after scrolling to the top - goes in front of everything
+                    try:
+                        history = json.loads(msg.split("|", 1)[1])
+                    except ValueError:
+                        history = []
+                    with self.state.lock:
+                        self.state.messages[:0] = self._history_entries(history)
+                        self._more_history("channel", len(history))
                     continue
 
                 with self.state.lock:
                     if msg.startswith("[USERS]|"):
-                        self.state.users = set(msg.split("|", 1)[1].split(";"))
+                        self.state.users = set(u for u in msg.split("|", 1)[1].split(";") if u)
                         if not self.state.channel_history_ready:
                             self.state.authenticated = True
                         continue
 
+                    if msg.startswith("[PRESENCE]|"):
+                        # +name came online, -name went offline, on top of the last [USERS] list
+                        for change in msg.split("|", 1)[1].split(";"):
+                            if change.startswith("+"):
+                                self.state.users.add(change[1:])
+                            elif change.startswith("-"):
+                                self.state.users.discard(change[1:])
+                        continue
+
                     if msg.startswith("[ADMINS]|"):
                         raw = msg.split("|", 1)[1]
                         self.state.admins = set(u for u in raw.split(";") if u)
@@ -230,6 +534,16 @@ class ReceiveMixin:
                                 f"  Muted: {is_muted}",
                                 f"  Channel messages: {total_msgs}",
                             ]
+                            # older servers dont send these
+                            if "total_dm_messages" in stats:
+                                sent = stats.get("bytes_sent", 0)
+                                sentStr = f"{sent / 1024:.1f} KB" if sent >= 1024 else f"{sent} B"
+                                lines.append(f"  DMs sent: {stats.get('total_dm_messages', 0)}")
+                                lines.append(f"  Sent: {sentStr}")
+                                for label, key in (("First seen", "first_seen"), ("Last seen", "last_seen")):
+                                    ts = stats.get(key) or 0
+                                    when = time.strftime("%Y-%m-%d %H:%M", time.localtime(ts)) if ts else "never"
+                                    lines.append(f"  {label}: {when}")
 
                         if self.state.current_view == "dm" and self.state.dm_target:
                             for line in lines:
@@ -263,6 +577,18 @@ class ReceiveMixin:
                             self.state.messages.append(Message(text=notice, is_self=True, ts=0))
                         continue
 
+                    if msg.startswith("[DM_ECHO]|"):
+                        # [DM_ECHO]|<recipient>|<ts>|<text> - a dm we sent from another device
+                        parts = msg.split("|", 3)
+                        if len(parts) == 4:
+                            _, to_user, ts, text = parts
+                            try:
+                                ts = float(ts)
+                            except ValueError:
+                                ts = time.time()
+                            self.state.append_dm(to_user, f"[{self.config.USERNAME}]: {text}", True, ts)
+                        continue
+
                     if msg.startswith("[DM]|"):
                         parts = msg.split("|", 3)
                         if len(parts) >= 4:
@@ -328,15 +654,8 @@ class ReceiveMixin:
                             try:
                                 history = json.loads(payload)
                                 self.state.ensure_dm_conversation(other)
-                                self.state.dm_conversations[other] = []
-                                for m in history:
-                                    sender = m.get("sender", "")
-                                    text = m.get("text", "")
-                                    is_self = sender == self.config.USERNAME
-                                    ts = m.get("timestamp", 0)
-                                    self.state.dm_conversations[other].append(
-                                        Message(text=f"[{sender}]: {text}", is_self=is_self, ts=ts)
-                                    )
+                                self.state.dm_conversations[other] = self._history_entries(history, dm=True)
+                                self._more_history(other, len(history))
                                 self.state.dm_conversations[other][:] = (
                                     self.state.dm_conversations[other][
                                         -self.config.MAX_MESSAGES :
@@ -351,6 +670,19 @@ class ReceiveMixin:
                                 self.state.pending_dm_history = None
                         continue
 
+                    if msg.startswith("[DM_HISTORY_PAGE]|"):
+                        parts = msg.split("|", 2)
+                        if len(parts) >= 3:
+                            other = parts[1]
+                            try:
+                                history = json.loads(parts[2])
+                            except ValueError:
+                                history = []
+                            conv = self.state.ensure_dm_conversation(other)
+                            conv[:0] = self._history_entries(history, dm=True)
+                            self._more_history(other, len(history))
+                        continue
+
                    
                     if msg.startswith("[BANNED]|"):
                         reason = msg.split("|", 1)[1] if "|" in msg else "You have been banned from this server"
@@ -422,14 +754,15 @@ class ReceiveMixin:
 
                     if msg.startswith("[DM_IMG]|"):
                         # [DM_IMG]|<sender>|<other_user>|<filename>|<base64_data>
-                        parts = msg.split("|", 4)
+                        # (v2 leaves the base64 field off and hands us the raw bytes as blob)
+                        parts = msg.split("|", 4) if blob is None else msg.split("|", 3) + [None]
                         if len(parts) == 5:
                             sender, other_user, filename, b64 = parts[1], parts[2], parts[3], parts[4]
                             is_self = sender == self.config.USERNAME
                             conv_key = other_user if is_self else sender
                             label = f"[{sender}]: [image: {filename}]"
                             try:
-                                img_rows = _img_to_rows(base64.b64decode(b64))
+                                img_rows = _img_to_rows(blob if blob is not None else base64.b64decode(b64))
                             except Exception:
                                 img_rows = None
                             self.state.append_dm(conv_key, label, is_self, time.time(), img_data=img_rows)
@@ -439,15 +772,49 @@ class ReceiveMixin:
                                         self.state.unread_dms[conv_key] = self.state.unread_dms.get(conv_key, 0) + 1
                         continue
 
+                    if msg.startswith("[IMG_REF]|"):
+                        # [IMG_REF]|<id>|<sender>|<hash>|<size>|<filename> + the preview to draw
+                        # (the original only gets downloaded if someone /saveimg's it)
+                        parts = msg.split("|", 5)
+                        if len(parts) == 6:
+                            _, seq, sender, digest, _size, filename = parts
+                            self.state.messages.append(Message(
+                                text=f"[{sender}]: [image: {filename}]",
+                                is_self=sender == self.config.USERNAME,
+                                ts=time.time(),
+                                img_rows=self.state.blob_rows.get(digest),
+                                seq=int(seq) if seq.isdigit() else None,
+                                blob=digest,
+                            ))
+                            self.state.messages[:] = self.state.messages[-self.config.MAX_MESSAGES:]
+                            self._show_preview(digest, blob)
+                        continue
+
+                    if msg.startswith("[DM_IMG_REF]|"):
+                        # [DM_IMG_REF]|<sender>|<other_user>|<hash>|<size>|<filename>
+                        parts = msg.split("|", 5)
+                        if len(parts) == 6:
+                            _, sender, other_user, digest, _size, filename = parts
+                            is_self = sender == self.config.USERNAME
+                            conv_key = other_user if is_self else sender
+                            self.state.append_dm(
+                                conv_key, f"[{sender}]: [image: {filename}]", is_self, time.time(),
+                                img_data=self.state.blob_rows.get(digest), blob=digest,
+                            )
+                            if not is_self and not (self.state.current_view == "dm" and self.state.dm_target == conv_key):
+                                self.state.unread_dms[conv_key] = self.state.unread_dms.get(conv_key, 0) + 1
+                            self._show_preview(digest, blob)
+                        continue
+
                     if msg.startswith("[IMG]|"):
                         # [IMG]|<sender>|<filename>|<base64_data>
-                        parts = msg.split("|", 3)
+                        parts = msg.split("|", 3) if blob is None else msg.split("|", 2) + [None]
                         if len(parts) == 4:
                             sender, filename, b64 = parts[1], parts[2], parts[3]
                             is_self = sender == self.config.USERNAME
                             label = f"[{sender}]: [image: {filename}]"
                             try:
-                                raw = base64.b64decode(b64)
+                                raw = blob if blob is not None else base64.b64decode(b64)
                                 img_rows = _img_to_rows(raw)
                             except Exception:
                                 img_rows = None
@@ -499,32 +866,17 @@ class ReceiveMixin:
                             self.state.expire_disp(msg_id, redacted)
                         continue
 
-                    is_self = msg.startswith(
-                        f"[{self.config.USERNAME}]:"
-                    ) or msg.startswith(f"[{self.config.USERNAME}] system")
-                    self.state.messages.append(
-                        Message(text=msg[: self.config.MAX_MESSAGE_LEN], is_self=is_self, ts=time.time())
-                    )
-                    self.state.messages[:] = self.state.messages[
-                        -self.config.MAX_MESSAGES :
-                    ]
-                    # notify on new messages unless dnd is on and window is focused
-                    if not is_self and not self.state.dnd and not self.state.is_window_focused():
-                        try:
-                            if platform.system() == "Darwin":
-                                safe_notif = msg[:80].replace('"', '').replace('\\', '')
-                                subprocess.Popen(
-                                    ["osascript", "-e", f'display notification "{safe_notif}" with title "Lantern"'],
-                                    stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
-                                )
-                            elif platform.system() == "Linux":
-                                safe_msg = msg[:80].replace("\\", "")
-                                subprocess.Popen(
-                                    ["notify-send", "Lantern", safe_msg, "-t", "4000"],
-                                    stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
-                                )
-                        except Exception:
-                            pass
+                    if msg.startswith("[MSG]|"):
+                        # channel line with its id - [MSG]|<id>|<text>
+                        parts = msg.split("|", 2)
+                        if len(parts) == 3:
+                            try:
+                                self._on_chat_line(parts[2], int(parts[1]))
+                            except ValueError:
+                                self._on_chat_line(parts[2])
+                        continue
+
+                    self._on_chat_line(msg)
 
             except Exception:
                 time.sleep(0.1)
@@ -1,25 +1,50 @@
+import hashlib
 import json
-import base64
 import io
 import os
 import platform
 import subprocess
+import threading
 import time
 
-from lantern_chat.frame import send_msg
+from lantern_chat.frame import Frame, send_msg
+from lantern_chat.protocol import PROTO_VERSION, b64_len
 from lantern_chat.client.state import Message
-from lantern_chat.client.net.image import _PIL_AVAILABLE, Image, _img_to_rows
+from lantern_chat.client.net.image import _PIL_AVAILABLE, Image, ImageOps, _img_to_rows
+
+# bytes per [UPLOAD_CHUNK] - small enough that a ping or keypress never waits long behind one
+UPLOAD_CHUNK = 64 * 1024
+# already compressed formats that get sent exactly as they are, as long as they arent too big
+_KEEP_FORMATS = {"PNG", "JPEG", "GIF", "WEBP"}
 
 
 class SendMixin:
-    def _send(self, msg: str):
+    def _send(self, msg: str, blob: bytes = None):
         # all sends go through here to avoid concurrent write races between threads
         # peak niche chat lol
+        # blob is an attachment - goes raw to a v2 server, base64'd onto the end of msg for an old one
+        frame = Frame(msg, blob)
         with self._send_lock:
-            send_msg(self.sock, msg)
+            send_msg(self.sock, frame, self.proto)
+
+    def send_hello(self):
+        # old servers just ignore this, new ones answer with [HELLO]|<version>
+        self.proto = 1
+        self._send(f"[HELLO]|{PROTO_VERSION}")
 
     def send_join(self):
-        self._send(f"[JOIN]|{self.config.USERNAME}")
+        if self.proto >= 3:
+            # small first page, the rest comes in as you scroll up
+            # after a reconnect we already have the channel up to some message, so just ask for whats after it
+            join = f"[JOIN]|{self.config.USERNAME}|limit={self.config.HISTORY_PAGE}"
+            with self.state.lock:
+                since = max((m.seq for m in self.state.messages if m.seq is not None), default=None)
+                self.state.channel_sync = "delta" if since is not None else None
+            if since is not None:
+                join += f"|since={since}"
+            self._send(join)
+        else:
+            self._send(f"[JOIN]|{self.config.USERNAME}")
 
     def send_message(self, msg):
         try:
@@ -58,30 +83,41 @@ class SendMixin:
                 self.state.send_failed = True
 
     def send_img(self, path: str, dm_recipient: str = None):
-        if not _PIL_AVAILABLE:
-            with self.state.lock:
-                self.state.messages.append(Message(text="[system] Pillow not installed — cannot send images", is_self=True, ts=0))
-            return
         try:
-            filename = os.path.basename(path)
-            with Image.open(path) as img:
-                img.load()  # force first frame for GIFs
-                buf = io.BytesIO()
-                img.convert("RGB").save(buf, format="PNG")
-                b64 = base64.b64encode(buf.getvalue()).decode()
-
-            # large image fix - shouldnt kill client now
-            if len(b64) > 8 * 1024 * 1024:
-                with self.state.lock:
-                    self.state.messages.append(Message(text="[system] Image too large to send (max ~8MB)", is_self=True, ts=0))
-                return
-            if dm_recipient:
-                self._send(f"[DM_IMG]|{dm_recipient}|{filename}|{b64}")
-            else:
-                self._send(f"[IMG]|{filename}|{b64}")
-        except Exception as e:
+            with open(path, "rb") as f:
+                data = f.read()
+        except OSError as e:
             with self.state.lock:
                 self.state.messages.append(Message(text=f"[system] Failed to send image: {e}", is_self=True, ts=0))
+            return
+        self.send_img_bytes(data, os.path.basename(path), dm_recipient)
+
+    def _prepare_img(self, data: bytes, filename: str):
+        # (bytes to send, filename) - a png/jpeg/gif/webp that fits goes exactly as it is, a 300kb photo
+        # stays 300kb. anything else (bmp, tiff, huge photos) is shrunk to IMG_MAX_DIMENSION on its longest
+        # side and sent as a jpeg at IMG_QUALITY, instead of blowing it up into a multi mb png
+        limit = self.config.IMG_MAX_DIMENSION
+        with Image.open(io.BytesIO(data)) as img:
+            if img.format in _KEEP_FORMATS and max(img.size) <= limit and b64_len(len(data)) <= 8 * 1024 * 1024:
+                return data, filename
+            img.load()  # first frame for gifs
+            img = ImageOps.exif_transpose(img).convert("RGB")
+            img.thumbnail((limit, limit), Image.LANCZOS)
+            buf = io.BytesIO()
+            img.save(buf, format="JPEG", quality=self.config.IMG_QUALITY, optimize=True)
+        return buf.getvalue(), os.path.splitext(filename)[0] + ".jpg"
+
+    def _send_img_raw(self, raw: bytes, filename: str, dm_recipient: str = None):
+        if self.proto >= 5:
+            # the server only sends our own image back as its hash - render it now so it isnt downloaded again
+            digest = hashlib.sha256(raw).hexdigest()
+            self._cache_blob(digest, _img_to_rows(raw))
+        if self.proto >= 6:
+            self._begin_upload(digest, raw, filename, dm_recipient or "")
+        elif dm_recipient:
+            self._send(f"[DM_IMG]|{dm_recipient}|{filename}", blob=raw)
+        else:
+            self._send(f"[IMG]|{filename}", blob=raw)
 
     # this code is getting very long icl
     def send_img_bytes(self, data: bytes, filename: str, dm_recipient: str = None):
@@ -90,26 +126,91 @@ class SendMixin:
                 self.state.messages.append(Message(text="[system] Pillow not installed — cannot send images", is_self=True, ts=0))
             return
         try:
-            with Image.open(io.BytesIO(data)) as img:
-                buf = io.BytesIO()
-                img.convert("RGB").save(buf, format="PNG")
-                b64 = base64.b64encode(buf.getvalue()).decode()
-            if len(b64) > 8 * 1024 * 1024:
+            raw, filename = self._prepare_img(data, filename)
+            # large image fix - shouldnt kill client now
+            if b64_len(len(raw)) > 8 * 1024 * 1024:
                 with self.state.lock:
                     self.state.messages.append(Message(text="[system] Image too large to send (max ~8MB)", is_self=True, ts=0))
                 return
-            if dm_recipient:
-                self._send(f"[DM_IMG]|{dm_recipient}|{filename}|{b64}")
-            else:
-                self._send(f"[IMG]|{filename}|{b64}")
+            self._send_img_raw(raw, filename, dm_recipient)
         except Exception as e:
             with self.state.lock:
                 self.state.messages.append(Message(text=f"[system] Failed to send image: {e}", is_self=True, ts=0))
 
+    def _begin_upload(self, digest: str, raw: bytes, filename: str, dm_recipient: str):
+        # the same image sent again while its still uploading just gets posted again once its there
+        with self.state.lock:
+            up = self.state.uploads.setdefault(digest, {"raw": raw, "posts": [], "sent": [], "run": None})
+            up["posts"].append((dm_recipient, filename))
+            if up["run"] is not None:
+                return  # already going, that thread commits this one too
+            up["run"] = True
+        self._send(f"[UPLOAD_BEGIN]|{digest}|{len(raw)}")
+
+    def _start_upload(self, digest: str, offset: int):
+        # [UPLOAD_OK] came back - send the rest on its own thread so the receive loop keeps going.
+        # any older thread still on this upload (from before a reconnect) sees it isnt the owner anymore and stops
+        with self.state.lock:
+            up = self.state.uploads.get(digest)
+            if up is None:
+                return
+            run = up["run"] = object()
+        threading.Thread(target=self._upload, args=(digest, up, offset, run), daemon=True).start()
+
+    def _upload(self, digest: str, up: dict, offset: int, run):
+        # one chunk per _send, so the send lock is let go in between and everything else gets a turn
+        raw = up["raw"]
+        try:
+            while offset < len(raw):
+                if up["run"] is not run:
+                    return
+                self._send(f"[UPLOAD_CHUNK]|{digest}|{offset}", blob=raw[offset : offset + UPLOAD_CHUNK])
+                offset += UPLOAD_CHUNK
+            while True:
+                with self.state.lock:
+                    if up["run"] is not run:
+                        return
+                    if not up["posts"]:
+                        up["run"] = None
+                        return
+                    post = up["posts"].pop(0)
+                    up["sent"].append(post)
+                dm_recipient, filename = post
+                self._send(f"[UPLOAD_COMMIT]|{digest}|{dm_recipient}|{filename}")
+        except OSError:
+            pass  # connection went - once its back the upload starts again from wherever the server got to
+
+    def save_image(self, digest: str, path: str):
+        # full original of an image we only have the preview of, written to path once its downloaded
+        self._fetch_blob(digest, path)
+
     def request_dm_history(self, other_user: str):
-        self._send(f"[REQ_DM_HISTORY]|{other_user}")
+        if self.proto >= 3:
+            self._send(f"[REQ_DM_HISTORY]|{other_user}|limit={self.config.HISTORY_PAGE}")
+        else:
+            self._send(f"[REQ_DM_HISTORY]|{other_user}")
         self._send(f"[CLEAR_UNREAD]|{other_user}")
 
+    def request_older_history(self, dm_target: str = None):
+        # scrolled to the top - ask for the page before the oldest message we've got, one request at a time
+        key = dm_target or "channel"
+        with self.state.lock:
+            if self.proto < 3 or not self.state.history_more.get(key) or key in self.state.history_pending:
+                return
+            msgs = self.state.dm_conversations.get(dm_target, []) if dm_target else self.state.messages
+            cursor = min((m.seq for m in msgs if m.seq is not None), default=None)
+            if cursor is None:
+                return
+            self.state.history_pending.add(key)
+        try:
+            if dm_target:
+                self._send(f"[REQ_DM_HISTORY]|{dm_target}|before={cursor}|limit={self.config.HISTORY_PAGE}")
+            else:
+                self._send(f"[REQ_CHANNEL_HISTORY]|before={cursor}|limit={self.config.HISTORY_PAGE}")
+        except OSError:
+            with self.state.lock:
+                self.state.history_pending.discard(key)
+
     def request_fetch(self):
         self._send(f"[REQ_FETCH]|{json.dumps(self.system_fetch())}")
 
@@ -10,6 +10,8 @@ class Message:
     ts: float = 0.0
     msg_id: str = None
     img_rows: list = None
+    seq: int = None  # server's message id - history, [MSG] and [IMG_REF] lines have one, our own unechoed sends dont. [JOIN] since= resumes after the biggest
+    blob: str = None  # content hash of the image, for images the server sent as a reference
 
 
 class ClientState:
@@ -28,7 +30,23 @@ class ClientState:
         self.auth_failed = False
 
         self.channel_history_buffer = []
+        self.channel_history_count = 0  # messages the current join history has brought in so far
         self.channel_history_ready = False
+        self.channel_sync = None  # "delta" while a reconnect is waiting on just the messages it missed
+        # "channel" or a dm username -> whether the server has older history to page in,
+        # and which of those have a page request in flight
+        self.history_more = {}
+        self.history_pending = set()
+        # images by content hash - rendered rows of ones we've got (a few, oldest dropped first),
+        # the bytes so far of ones still coming in over [BLOB] ranges (None for a preview on its way)
+        # and where each of those gets saved
+        self.blob_rows = {}
+        self.blob_fetch = {}
+        self.blob_save = {}
+        # our images still being uploaded, by hash -> {"raw", "posts": [(dm recipient, filename)] still to
+        # commit, "sent": ones committed and waiting on [UPLOAD_DONE], "run": the sender thread that owns it -
+        # True while [UPLOAD_OK] is on its way, None once its all committed}
+        self.uploads = {}
 
         self.users_detailed = []
         self.dm_conversations = {}
@@ -65,10 +83,12 @@ class ClientState:
                 self.dm_conversations[other_user] = []
             return self.dm_conversations[other_user]
 
-    def append_dm(self, other_user, text, is_self, ts=0, msg_id=None, img_data=None):
+    def append_dm(self, other_user, text, is_self, ts=0, msg_id=None, img_data=None, blob=None):
         with self.lock:
             self.ensure_dm_conversation(other_user)
-            self.dm_conversations[other_user].append(Message(text=text, is_self=is_self, ts=ts, msg_id=msg_id, img_rows=img_data))
+            self.dm_conversations[other_user].append(
+                Message(text=text, is_self=is_self, ts=ts, msg_id=msg_id, img_rows=img_data, blob=blob)
+            )
             self.dm_conversations[other_user][:] = self.dm_conversations[other_user][-self.max_messages:]
             if msg_id:
                 self.disp_index[msg_id] = ("dm", other_user)
@@ -727,6 +727,9 @@ class UI:
                 self.dm_scroll_offset = scroll
             else:
                 self.scroll_offset = scroll
+            if scroll >= max_scroll:
+                # at the top of what we have - pull in the next older page if the server has one
+                self.network.request_older_history(dm_target if view == "dm" else None)
 
             start = max(0, total_lines - chat_h - scroll)
             end = total_lines - scroll
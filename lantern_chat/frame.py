@@ -1,8 +1,12 @@
 # yes, im restructuring lantern so it uses TCP not UDP 
 
 # i fear that udp has made be lose more brain cells than packets it has lost, which is a lot
+import asyncio
+import base64
 import socket
 
+from lantern_chat.protocol import V2_MARKER, encode_v2, decode_v2_fields
+
 
 
 MAX_MESSAGE_BYTES = 10 * 1024 * 1024 # 10mb should be way more than enough
@@ -10,24 +14,90 @@ MAX_MESSAGE_BYTES = 10 * 1024 * 1024 # 10mb should be way more than enough
 
 def _recv_exact(sock: socket.socket, n: int):
     # read bytes and return none if disconnected 
-    buf = b""
-    
-    while len(buf) < n:
+    # fills one preallocated buffer in place instead of buf += chunk, which got quadratic for big images
+    buf = bytearray(n)
+    view = memoryview(buf)
+    got = 0
+    while got < n:
         try:
             # chunky
-            chunk = sock.recv(n - len(buf))
+            read = sock.recv_into(view[got:], n - got)
         except OSError:
             return None
-        if not chunk:
+        if not read:
             return None
-        buf += chunk
+        got += read
     return buf
 
-def send_msg(sock: socket.socket, text: str):
-    # send msg - length prefixed 
+def encode_frame(text: str) -> bytes:
+    # length prefix + utf8 payload, built in one go
     # TODO - encrypt here 
     data = text.encode()
-    sock.sendall(len(data).to_bytes(4, "big") + data)
+    return b"".join((len(data).to_bytes(4, "big"), data))
+
+
+class Frame:
+    # a message thats already been encoded for the wire
+    # broadcasts build one of these and hand the exact same bytes to every socket instead of re-encoding per client
+    # blob is an optional attachment (images) - raw bytes on v2 connections, base64'd onto the end of the text for v1
+    # seq is the stored message id for channel lines, v3 peers get it as [MSG]|<seq>|<text> so they
+    # know where to pick up after a reconnect. older ones just get the text
+    __slots__ = ("text", "blob", "seq", "_v1", "_v2", "_v3")
+
+    def __init__(self, text: str, blob: bytes = None, seq: int = None):
+        self.text = text
+        self.blob = blob
+        self.seq = seq
+        self._v1 = None
+        self._v2 = None
+        self._v3 = None
+
+    def _packed(self, text: str) -> bytes:
+        parts = encode_v2(text, self.blob)
+        if parts is None:
+            return self.wire(1)  # no opcode for this one, plain text it is
+        length = sum(len(p) for p in parts)
+        return b"".join([length.to_bytes(4, "big")] + parts)
+
+    def wire(self, proto: int = 1) -> bytes:
+        # encoded lazily per protocol version, then cached - so a broadcast to a mix of old
+        # and new clients encodes at most once per version
+        if proto >= 3 and self.seq is not None:
+            if self._v3 is None:
+                self._v3 = self._packed(f"[MSG]|{self.seq}|{self.text}")
+            return self._v3
+        if proto >= 2:
+            if self._v2 is None:
+                self._v2 = self._packed(self.text)
+            return self._v2
+        if self._v1 is None:
+            if self.blob is None:
+                self._v1 = encode_frame(self.text)
+            else:
+                self._v1 = encode_frame(f"{self.text}|{base64.b64encode(self.blob).decode()}")
+        return self._v1
+
+    @property
+    def data(self) -> bytes:
+        return self.wire(1)
+
+
+def send_msg(sock: socket.socket, msg, proto: int = 1):
+    # send msg - length prefixed, msg can be a str or a pre-encoded Frame
+    # proto only matters for Frames, plain strs always go as v1 text
+    if isinstance(msg, Frame):
+        sock.sendall(msg.wire(proto))
+    else:
+        sock.sendall(encode_frame(msg))
+
+
+def decode_payload(payload):
+    # v1 text or v2 packed frame -> (text, blob, tag)
+    # tag is what the v2 opcode said the message is, None for v1 text (the receiver has to find it in the text)
+    if len(payload) and payload[0] == V2_MARKER:
+        tag, fields, blob = decode_v2_fields(payload)
+        return "|".join([tag] + fields) if fields else tag, blob, tag
+    return str(payload, "utf-8", "ignore"), None, None
 
 
 def recv_msg(sock: socket.socket):
@@ -44,6 +114,117 @@ def recv_msg(sock: socket.socket):
     return data.decode(errors="ignore")
 
 
+class FrameReader:
+    # buffered framing reader for a socket that stays open (server/client receive loops)
+    # recv_into one reusable buffer and slice frames out of it with memoryviews, so a burst of
+    # small messages is one syscall and a big image is one allocation rather than hundreds
+    READ_SIZE = 64 * 1024
 
+    def __init__(self, sock: socket.socket):
+        self.sock = sock
+        self._buf = bytearray(self.READ_SIZE)
+        self._view = memoryview(self._buf)
+        self._start = 0  # first unparsed byte
+        self._end = 0  # end of what we've received
 
+    def _fill(self, need: int) -> bool:
+        # make sure at least need bytes are sitting in the buffer from _start
+        if need > len(self._buf):
+            # frame bigger than the buffer - grow once to fit it exactly
+            grown = bytearray(need)
+            grown[: self._end - self._start] = self._view[self._start : self._end]
+            self._buf, self._view = grown, memoryview(grown)
+            self._end -= self._start
+            self._start = 0
+        elif self._start + need > len(self._buf):
+            # not enough room at the tail, shuffle the leftover bytes to the front
+            pending = self._end - self._start
+            self._view[:pending] = self._view[self._start : self._end]
+            self._start, self._end = 0, pending
+        while self._end - self._start < need:
+            try:
+                read = self.sock.recv_into(self._view[self._end :])
+            except OSError:
+                return False
+            if not read:
+                return False
+            self._end += read
+        return True
 
+    def _next(self):
+        # returns the payload as a memoryview into our buffer - only valid until the next read
+        if not self._fill(4):
+            return None
+        length = int.from_bytes(self._view[self._start : self._start + 4], "big")
+        if length > MAX_MESSAGE_BYTES:
+            return None # reject big messages 
+        if not self._fill(4 + length):
+            return None
+        payload = self._view[self._start + 4 : self._start + 4 + length]
+        self._start += 4 + length
+        return payload
+
+    def _reset(self):
+        if self._start == self._end:
+            self._start = self._end = 0
+            if len(self._buf) > self.READ_SIZE:
+                # dont keep a 10mb buffer around per connection after one big image
+                self._buf = bytearray(self.READ_SIZE)
+                self._view = memoryview(self._buf)
+
+    def read_bytes(self):
+        # raw payload, no decoding - for binary data
+        payload = self._next()
+        if payload is None:
+            return None
+        data = bytes(payload)
+        payload.release()
+        self._reset()
+        return data
+
+    def read(self):
+        # decode straight out of the buffer, same as recv_msg
+        payload = self._next()
+        if payload is None:
+            return None
+        text = str(payload, "utf-8", "ignore")
+        payload.release()
+        self._reset()
+        return text
+
+    def read_message(self):
+        # next message as (text, blob), understanding both v1 and v2 frames - None when disconnected
+        got = self.read_tagged()
+        return got[:2] if got else None
+
+    def read_tagged(self):
+        # read_message plus the tag from the v2 opcode (None for v1) - the server dispatches on that
+        while True:
+            payload = self._next()
+            if payload is None:
+                return None
+            try:
+                msg = decode_payload(payload)
+            except ValueError:
+                msg = None  # garbage v2 frame, skip it
+            payload.release()
+            self._reset()
+            if msg is not None:
+                return msg
+
+
+async def recv_message_async(reader: asyncio.StreamReader):
+    # same as FrameReader.read_tagged but for asyncio streams (server --engine asyncio)
+    while True:
+        try:
+            raw_len = await reader.readexactly(4)
+            length = int.from_bytes(raw_len, "big")
+            if length > MAX_MESSAGE_BYTES:
+                return None
+            data = await reader.readexactly(length)
+        except (asyncio.IncompleteReadError, OSError):
+            return None
+        try:
+            return decode_payload(data)
+        except ValueError:
+            continue
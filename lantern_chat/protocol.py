@@ -0,0 +1,155 @@
+# protocol v2 - same messages as the "[TAG]|a|b" strings, just packed as
+#   0xFF | opcode | field count | (u32 length | bytes) * fields
+# 0xFF can never be the first byte of valid utf8 so v1 text frames and v2 frames can share a socket,
+# the receiver just looks at the first byte. v2 is only sent to a peer once it has said [HELLO]|2,
+# so old clients/servers never see it
+# the big win is attachments: images go as raw bytes instead of base64 text that gets split on "|"
+
+# 3 is the same framing as 2, it just means the peer pages history ([JOIN] limit=, [REQ_CHANNEL_HISTORY])
+# and gets channel lines as [MSG]|<id>|<text> so it can ask for just what it missed ([JOIN] since=),
+# join history comes as [CHANNEL_HISTORY_BATCH]es of json lines instead of slices of one big array
+# 4 gets online/offline changes as [PRESENCE]|+alice;-bob deltas instead of the whole [USERS] list every time
+# 5 gets images as [IMG_REF]/[DM_IMG_REF] - a content hash + size, with a terminal sized preview the server
+# made attached instead of the original. [REQ_PREVIEW]|<hash> -> [PREVIEW]|<hash> + preview gets the one for
+# an image in history, [REQ_BLOB]|<hash>|<offset>|<length> -> [BLOB]|<hash>|<offset>|<total size> + that
+# range of bytes gets the original
+# 6 sends images as an upload instead of one [IMG]/[DM_IMG] frame: [UPLOAD_BEGIN]|<hash>|<size> ->
+# [UPLOAD_OK]|<hash>|<offset the server already has>, [UPLOAD_CHUNK]|<hash>|<offset> + bytes until its all
+# there, then [UPLOAD_COMMIT]|<hash>|<dm recipient or empty>|<filename> -> [UPLOAD_DONE]|<hash> or
+# [UPLOAD_FAIL]|<hash>|<reason>. after a reconnect it starts again at [UPLOAD_BEGIN] and picks up where it was
+# 7 gets a dm it sent from another device as [DM_ECHO]|<recipient>|<ts>|<text>, so every device has the
+# whole conversation (the one it was sent from already added it)
+PROTO_VERSION = 7
+V2_MARKER = 0xFF
+
+# tag -> (opcode, max "|" fields after the tag)
+# the last field keeps any extra "|" in it, same as split("|", n) does in the handlers
+# [HELLO] isnt in here on purpose, it always goes as plain text so old peers can ignore it
+OPCODES = {
+    "[ping]": (0x01, 0),
+    "[REGISTER]": (0x02, 2),
+    "[REGISTER_OK]": (0x03, 0),
+    "[REGISTER_FAIL]": (0x04, 1),
+    "[LOGIN]": (0x05, 2),
+    "[AUTH_OK]": (0x06, 1),
+    "[AUTH_FAIL]": (0x07, 1),
+    "[JOIN]": (0x08, 1),
+    "[LEAVE]": (0x09, 1),
+    "[USERS]": (0x0A, 1),
+    "[ADMINS]": (0x0B, 1),
+    "[REQ_USERS]": (0x0C, 1),
+    "[REQ_USERS_DETAILED]": (0x0D, 1),
+    "[USERS_DETAILED]": (0x0E, 1),
+    "[REQ_USER_STATS]": (0x0F, 1),
+    "[USER_STATS]": (0x10, 1),
+    "[REQ_MAX_MSG_LEN]": (0x11, 1),
+    "[MAX_MSG_LEN]": (0x12, 1),
+    "[UNREAD]": (0x13, 1),
+    "[CLEAR_UNREAD]": (0x14, 1),
+    "[CHANNEL_HISTORY]": (0x15, 2),
+    "[CHANNEL_HISTORY_END]": (0x16, 0),
+    "[DM]": (0x17, 3),
+    "[DM_FAIL]": (0x18, 1),
+    "[REQ_DM_HISTORY]": (0x19, 1),
+    "[DM_HISTORY]": (0x1A, 2),
+    "[ADMIN_CMD]": (0x1B, 4),
+    "[ADMIN_OK]": (0x1C, 1),
+    "[ADMIN_ERROR]": (0x1D, 1),
+    "[BANNED]": (0x1E, 1),
+    "[RATE_LIMITED]": (0x1F, 1),
+    "[PURGE]": (0x20, 1),
+    "[REQ_FETCH]": (0x21, 1),
+    "[FETCH_OK]": (0x22, 0),
+    "[FETCH_COOLDOWN]": (0x23, 1),
+    "[IMG]": (0x24, 2),
+    "[DM_IMG]": (0x25, 3),
+    "[DISP]": (0x26, 4),
+    "[DISP_EXPIRE]": (0x27, 2),
+    "[TYPING]": (0x28, 1),
+    "[TYPING_STOP]": (0x29, 1),
+    "[REQ_CHANNEL_HISTORY]": (0x2A, 2),
+    "[CHANNEL_HISTORY_PAGE]": (0x2B, 1),
+    "[DM_HISTORY_PAGE]": (0x2C, 2),
+    "[MSG]": (0x2D, 2),
+    "[CHANNEL_RESYNC]": (0x2E, 0),
+    "[CHANNEL_HISTORY_BATCH]": (0x2F, 1),
+    "[PRESENCE]": (0x30, 1),
+    "[IMG_REF]": (0x31, 5),
+    "[DM_IMG_REF]": (0x32, 5),
+    "[REQ_BLOB]": (0x33, 3),
+    "[BLOB]": (0x34, 3),
+    "[BLOB_MISSING]": (0x35, 1),
+    "[REQ_PREVIEW]": (0x36, 1),
+    "[PREVIEW]": (0x37, 1),
+    "[UPLOAD_BEGIN]": (0x38, 2),
+    "[UPLOAD_OK]": (0x39, 2),
+    "[UPLOAD_CHUNK]": (0x3A, 2),
+    "[UPLOAD_COMMIT]": (0x3B, 3),
+    "[UPLOAD_DONE]": (0x3C, 1),
+    "[UPLOAD_FAIL]": (0x3D, 2),
+    "[DM_ECHO]": (0x3E, 3),
+}
+TAGS = {op: tag for tag, (op, _) in OPCODES.items()}
+
+# messages whose last field is an attachment - raw bytes in v2, base64 text in v1
+BLOB_TAGS = {"[IMG]", "[DM_IMG]", "[BLOB]", "[IMG_REF]", "[DM_IMG_REF]", "[PREVIEW]", "[UPLOAD_CHUNK]"}
+
+
+def encode_v2(text: str, blob: bytes = None):
+    # returns the payload as a list of byte chunks (caller joins them once), or None if this
+    # message has no opcode and has to go as v1 text (plain chat lines, "[x joined]" etc)
+    tag, sep, rest = text.partition("|")
+    entry = OPCODES.get(tag)
+    if entry is None:
+        return None
+    op, maxFields = entry
+    if sep and not maxFields:
+        return None
+    fields = rest.split("|", maxFields - 1) if sep else []
+    parts = [bytes((V2_MARKER, op, len(fields) + (blob is not None)))]
+    for field in fields:
+        data = field.encode()
+        parts.append(len(data).to_bytes(4, "big"))
+        parts.append(data)
+    if blob is not None:
+        parts.append(len(blob).to_bytes(4, "big"))
+        parts.append(blob)
+    return parts
+
+
+def decode_v2_fields(payload):
+    # payload is bytes or a memoryview, returns (tag, fields, blob) - the tag straight from the opcode
+    if len(payload) < 3 or payload[0] != V2_MARKER:
+        raise ValueError("not a v2 frame")
+    tag = TAGS.get(payload[1])
+    if tag is None:
+        raise ValueError(f"unknown opcode {payload[1]}")
+    count = payload[2]
+    pos = 3
+    fields = []
+    for _ in range(count):
+        if pos + 4 > len(payload):
+            raise ValueError("truncated v2 frame")
+        length = int.from_bytes(payload[pos : pos + 4], "big")
+        pos += 4
+        if pos + length > len(payload):
+            raise ValueError("truncated v2 frame")
+        fields.append(payload[pos : pos + length])
+        pos += length
+    blob = None
+    if tag in BLOB_TAGS and fields:
+        blob = bytes(fields.pop())
+    return tag, [str(f, "utf-8", "ignore") for f in fields], blob
+
+
+def decode_v2(payload):
+    # returns (text, blob) - text is the same "[TAG]|a|b" string a v1 peer would have sent, minus the attachment
+    tag, fields, blob = decode_v2_fields(payload)
+    if not fields:
+        return tag, blob
+    return "|".join([tag] + fields), blob
+
+
+def b64_len(n: int) -> int:
+    # how long n bytes would be as base64 - the size limits were all written against base64 text
+    return (n + 2) // 3 * 4
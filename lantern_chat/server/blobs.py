@@ -0,0 +1,251 @@
+import hashlib
+import os
+import threading
+import time
+
+from lantern_chat.server.imageinfo import probe
+
+# the most one [BLOB] reply carries - bigger images take a few round trips instead of one frame
+# hogging the client's outbox (and everyone waiting behind it)
+BLOB_CHUNK = 256 * 1024
+# half finished uploads nobody came back for get deleted after this long, looked for this often
+UPLOAD_MAX_AGE = 24 * 60 * 60
+UPLOAD_SWEEP_EVERY = 10 * 60
+# (format, width, height) of this many images is kept around so nothing gets probed twice
+INFO_CACHE = 4096
+
+_HEX = set("0123456789abcdef")
+
+
+def valid_digest(digest: str) -> bool:
+    # sha256 hex and nothing else - it ends up in a file path
+    return len(digest) == 64 and set(digest) <= _HEX
+
+
+class BlobStore:
+    # sent images, one file per sha256 of the bytes under blobs/<first 2 chars>/<hash>
+    # the same image sent twice (or to ten dms) is stored once, messages just point at the hash
+    # <hash>.preview next to it is the terminal sized version (see preview.py), made once per image
+    # files never change once written, so reads need no locking
+    # uploads in progress are uploads/<user>-<hash>.part - the file is the whole state, its size is how far
+    # it got, so a client that reconnects (or a server that restarted) just carries on from there.
+    # only upload_begin makes one, chunks for anything else are dropped
+
+    def __init__(self, root: str, sync: bool = True):
+        self.root = root
+        self.sync = sync
+        self._upload_lock = threading.Lock()
+        self._info = {}  # digest -> probe() result, oldest dropped first
+        self._info_lock = threading.Lock()
+        os.makedirs(os.path.join(root, "uploads"), exist_ok=True)
+        self._lastSweep = 0
+        self.sweep_uploads()
+
+    def path(self, digest: str) -> str:
+        return os.path.join(self.root, digest[:2], digest)
+
+    def _write(self, path: str, data: bytes):
+        if os.path.exists(path):
+            return
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        # temp name per thread, two people sending the same image at once both just replace it
+        tmp = f"{path}.{threading.get_ident()}.tmp"
+        with open(tmp, "wb") as f:
+            f.write(data)
+            if self.sync:
+                # has to be on disk before the message pointing at it is
+                f.flush()
+                os.fsync(f.fileno())
+        os.replace(tmp, path)
+
+    def put(self, data: bytes, info=None) -> str:
+        # info is what probe() already said about data, if the caller checked it
+        digest = hashlib.sha256(data).hexdigest()
+        self._write(self.path(digest), data)
+        if info is not None:
+            self._remember(digest, info)
+        return digest
+
+    def _remember(self, digest: str, info):
+        with self._info_lock:
+            self._info[digest] = info
+            while len(self._info) > INFO_CACHE:
+                del self._info[next(iter(self._info))]
+
+    def info(self, digest: str):
+        # (format, width, height) of a stored image from its header, None if its missing or not an image
+        with self._info_lock:
+            if digest in self._info:
+                return self._info[digest]
+        if not valid_digest(digest):
+            return None
+        try:
+            with open(self.path(digest), "rb") as f:
+                info = probe(f.read)
+        except OSError:
+            return None
+        if info is not None:
+            self._remember(digest, info)
+        return info
+
+    def put_preview(self, digest: str, data: bytes):
+        if valid_digest(digest):
+            self._write(self.path(digest) + ".preview", data)
+
+    def read_preview(self, digest: str):
+        # the whole preview (a few kb), None if it hasnt been made
+        if not valid_digest(digest):
+            return None
+        try:
+            with open(self.path(digest) + ".preview", "rb") as f:
+                return f.read()
+        except OSError:
+            return None
+
+    def size(self, digest: str):
+        # bytes, or None if we dont have it
+        if not valid_digest(digest):
+            return None
+        try:
+            return os.path.getsize(self.path(digest))
+        except OSError:
+            return None
+
+    def load(self, digest: str):
+        # the whole thing, None if we dont have it
+        if not valid_digest(digest):
+            return None
+        try:
+            with open(self.path(digest), "rb") as f:
+                return f.read()
+        except OSError:
+            return None
+
+    def read(self, digest: str, offset: int = 0, length: int = BLOB_CHUNK):
+        # up to `length` (capped at BLOB_CHUNK) bytes from offset, None if we dont have it
+        if not valid_digest(digest):
+            return None
+        try:
+            with open(self.path(digest), "rb") as f:
+                f.seek(max(offset, 0))
+                return f.read(max(0, min(length, BLOB_CHUNK)))
+        except OSError:
+            return None
+
+    def _upload_path(self, owner: str, digest: str) -> str:
+        # owner is hashed so any username is safe in a file name
+        tag = hashlib.sha256(owner.encode()).hexdigest()[:16]
+        return os.path.join(self.root, "uploads", f"{tag}-{digest}.part")
+
+    def sweep_uploads(self):
+        # deletes uploads untouched for UPLOAD_MAX_AGE - called every few seconds from the server's cleanup
+        # loop but only actually looks every UPLOAD_SWEEP_EVERY
+        now = time.time()
+        if now - self._lastSweep < UPLOAD_SWEEP_EVERY:
+            return
+        self._lastSweep = now
+        try:
+            names = os.listdir(os.path.join(self.root, "uploads"))
+        except OSError:
+            return
+        for name in names:
+            path = os.path.join(self.root, "uploads", name)
+            with self._upload_lock:
+                try:
+                    if os.path.getmtime(path) < now - UPLOAD_MAX_AGE:
+                        os.remove(path)
+                except OSError:
+                    pass
+
+    def upload_begin(self, owner: str, digest: str, max_open: int):
+        # opens (or reopens) owner's upload of `digest`, returns how much of it we have so far -
+        # None if they already have max_open other uploads going
+        if not valid_digest(digest):
+            return None
+        path = self._upload_path(owner, digest)
+        prefix = os.path.basename(path).split("-", 1)[0] + "-"
+        with self._upload_lock:
+            try:
+                size = os.path.getsize(path)
+                os.utime(path)  # picked back up, so its not stale
+                return size
+            except OSError:
+                pass
+            try:
+                mine = [n for n in os.listdir(os.path.join(self.root, "uploads")) if n.startswith(prefix)]
+            except OSError:
+                mine = []
+            if len(mine) >= max_open:
+                return None
+            try:
+                open(path, "wb").close()
+            except OSError:
+                return None
+            return 0
+
+    def upload_append(self, owner: str, digest: str, offset: int, data: bytes, limit: int):
+        # writes data at offset, returns the new size - None if there's no such upload (never begun, or
+        # finished/swept since), offset isnt where the upload is at (a chunk from before a reconnect)
+        # or it would go past limit bytes
+        if not valid_digest(digest):
+            return None
+        with self._upload_lock:
+            try:
+                f = open(self._upload_path(owner, digest), "r+b")
+            except OSError:
+                return None
+            with f:
+                f.seek(0, os.SEEK_END)
+                if f.tell() != offset or offset + len(data) > limit:
+                    return None
+                f.write(data)
+                return f.tell()
+
+    def upload_info(self, owner: str, digest: str):
+        # probe() of an upload thats all here (or of the blob, if we already had it) - checked before it's kept
+        if self.size(digest) is not None:
+            return self.info(digest)
+        if not valid_digest(digest):
+            return None
+        try:
+            with open(self._upload_path(owner, digest), "rb") as f:
+                return probe(f.read)
+        except OSError:
+            return None
+
+    def upload_discard(self, owner: str, digest: str):
+        if valid_digest(digest):
+            self._remove(self._upload_path(owner, digest))
+
+    def upload_finish(self, owner: str, digest: str, info=None) -> bool:
+        # checks the upload really is `digest` and moves it in with the rest, False (and its gone) if it isnt
+        path = self._upload_path(owner, digest)
+        if not valid_digest(digest):
+            return False
+        if self.size(digest) is not None:
+            # we already had it - nothing was sent, or it came in some other way meanwhile
+            self._remove(path)
+            return True
+        h = hashlib.sha256()
+        try:
+            with open(path, "rb") as f:
+                for block in iter(lambda: f.read(BLOB_CHUNK), b""):
+                    h.update(block)
+                if self.sync:
+                    os.fsync(f.fileno())
+        except OSError:
+            return False
+        if h.hexdigest() != digest:
+            self._remove(path)
+            return False
+        os.makedirs(os.path.dirname(self.path(digest)), exist_ok=True)
+        os.replace(path, self.path(digest))
+        if info is not None:
+            self._remember(digest, info)
+        return True
+
+    def _remove(self, path: str):
+        try:
+            os.remove(path)
+        except OSError:
+            pass
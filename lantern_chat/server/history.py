@@ -0,0 +1,140 @@
+import sys
+import threading
+from collections import deque
+from itertools import islice
+
+
+class StoredMessage:
+    # one channel/dm message as the server keeps it - __slots__ instead of a 3 key dict per message,
+    # and sender names are interned so every message from alice points at the same "alice"
+    # it only turns back into {"id", "sender", "text", "timestamp"} when it gets serialised,
+    # pass to_json as json.dump(s)'s default= for that
+    # id is the journal seq of the change that added it - never reused, and always bigger than
+    # every older message in the same conversation, so clients can page with before=<id>
+    # blob is the content hash of an image in the BlobStore, for "[image: x]" lines - None otherwise
+
+    __slots__ = ("id", "sender", "text", "timestamp", "blob")
+
+    def __init__(self, sender: str, text: str, timestamp: float, id: int = None, blob: str = None):
+        self.id = id
+        self.sender = sys.intern(sender)
+        self.text = text
+        self.timestamp = timestamp
+        self.blob = blob
+
+    @classmethod
+    def from_dict(cls, d):
+        return cls(d["sender"], d["text"], d["timestamp"], d.get("id"), d.get("blob"))
+
+    def to_dict(self):
+        d = {"id": self.id, "sender": self.sender, "text": self.text, "timestamp": self.timestamp}
+        if self.blob is not None:
+            # only images have one, no point putting "blob": null on every other message
+            d["blob"] = self.blob
+        return d
+
+
+def to_json(obj):
+    # json default= hook, so history/journal dumps can take StoredMessage as-is
+    if isinstance(obj, StoredMessage):
+        return obj.to_dict()
+    raise TypeError(f"{type(obj).__name__} is not JSON serializable")
+
+
+class History:
+    # bounded message history for the channel and each dm conversation
+    # a deque with maxlen, so append and dropping the oldest message are both O(1) instead of
+    # copying the whole list every time. tail() only walks the messages it actually returns
+    # each one has its own lock (the per-conversation lock) - a deque iterator blows up if another
+    # thread appends while its running, even a C level one like list(islice(...)) under load.
+    # only held for the copy/walk, never while calling out, so it can't deadlock with anything
+
+    __slots__ = ("_items", "_lock")
+
+    def __init__(self, items=(), maxlen: int = 2000):
+        self._items = deque(items, maxlen=max(maxlen, 1))
+        self._lock = threading.Lock()
+
+    @property
+    def maxlen(self) -> int:
+        return self._items.maxlen
+
+    def append(self, msg):
+        with self._lock:
+            self._items.append(msg)
+
+    def tail(self, limit: int):
+        # last `limit` messages as a list, oldest first
+        if limit <= 0:
+            return []
+        with self._lock:
+            items = self._items
+            if limit >= len(items):
+                return list(items)
+            out = list(islice(reversed(items), limit))
+        out.reverse()
+        return out
+
+    def _copy(self):
+        with self._lock:
+            return list(self._items)
+
+    def before(self, cursor: int, limit: int):
+        # up to `limit` messages older than id `cursor`, oldest first
+        # walks back from the newest under the lock, so nothing can append mid-walk and
+        # the deque never gets copied - only what gets returned does
+        out = []
+        if limit <= 0:
+            return out
+        with self._lock:
+            for msg in reversed(self._items):
+                if msg.id is not None and msg.id >= cursor:
+                    continue
+                out.append(msg)
+                if len(out) >= limit:
+                    break
+        out.reverse()
+        return out
+
+    def after(self, cursor: int, limit: int):
+        # messages newer than id `cursor`, oldest first, at most `limit` of them
+        # stops at the first one at/below the cursor, so a resume right after a drop only touches a few
+        out = []
+        if limit <= 0:
+            return out
+        with self._lock:
+            for msg in reversed(self._items):
+                if msg.id is None or msg.id <= cursor:
+                    break
+                out.append(msg)
+                if len(out) >= limit:
+                    break
+        out.reverse()
+        return out
+
+    def oldest(self):
+        with self._lock:
+            return self._items[0] if self._items else None
+
+    def pop_newest(self, count: int):
+        # /purge - drop the newest `count`, returns the ones that went
+        with self._lock:
+            return [self._items.pop() for _ in range(min(max(count, 0), len(self._items)))]
+
+    def resize(self, maxlen: int):
+        # max_channel_messages / max_dm_messages changed on a config reload
+        with self._lock:
+            if max(maxlen, 1) != self._items.maxlen:
+                self._items = deque(self._items, maxlen=max(maxlen, 1))
+
+    def newest(self):
+        with self._lock:
+            return self._items[-1] if self._items else None
+
+    def __len__(self):
+        return len(self._items)
+
+    def __iter__(self):
+        # over a copy - a python for loop can be interrupted by another thread's append,
+        # which a live deque iterator would blow up on
+        return iter(self._copy())
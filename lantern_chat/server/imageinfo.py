@@ -0,0 +1,98 @@
+import base64
+
+# works out what an image is and how many pixels it has from its header alone, without decoding it -
+# pillow would happily start inflating a 1mb png that claims to be 60000x60000 before telling us.
+# png, jpeg, gif, webp and bmp, which is everything clients send
+
+
+def probe(read):
+    # read(n) -> up to n more bytes of the image. (format, width, height), or None if its not one we know
+    head = read(30)
+    if head.startswith(b"\x89PNG\r\n\x1a\n") and head[12:16] == b"IHDR":
+        return "png", int.from_bytes(head[16:20], "big"), int.from_bytes(head[20:24], "big")
+    if head[:6] in (b"GIF87a", b"GIF89a") and len(head) >= 10:
+        return "gif", int.from_bytes(head[6:8], "little"), int.from_bytes(head[8:10], "little")
+    if head[:4] == b"RIFF" and head[8:12] == b"WEBP":
+        return _webp(head)
+    if head[:2] == b"BM" and len(head) >= 26:
+        if int.from_bytes(head[14:18], "little") == 12:
+            return "bmp", int.from_bytes(head[18:20], "little"), int.from_bytes(head[20:22], "little")
+        w = int.from_bytes(head[18:22], "little", signed=True)
+        h = int.from_bytes(head[22:26], "little", signed=True)
+        return "bmp", abs(w), abs(h)  # negative height is a top down bmp
+    if head[:2] == b"\xff\xd8":
+        return _jpeg(head[2:], read)
+    return None
+
+
+def _webp(head):
+    chunk, data = head[12:16], head[20:30]
+    if chunk == b"VP8 " and data[3:6] == b"\x9d\x01\x2a":
+        return "webp", int.from_bytes(data[6:8], "little") & 0x3FFF, int.from_bytes(data[8:10], "little") & 0x3FFF
+    if chunk == b"VP8L" and data[:1] == b"\x2f":
+        bits = int.from_bytes(data[1:5], "little")
+        return "webp", (bits & 0x3FFF) + 1, ((bits >> 14) & 0x3FFF) + 1
+    if chunk == b"VP8X":
+        return "webp", int.from_bytes(data[4:7], "little") + 1, int.from_bytes(data[7:10], "little") + 1
+    return None
+
+
+def _jpeg(buf, read):
+    # walks the markers until the frame header (SOFn) - exif and other stuff before it just gets skipped,
+    # so only the bytes up to there are ever read
+    def take(n):
+        nonlocal buf
+        while len(buf) < n:
+            more = read(max(n - len(buf), 4096))
+            if not more:
+                return None
+            buf += more
+        out, buf = buf[:n], buf[n:]
+        return out
+
+    while True:
+        marker = take(2)
+        if marker is None or marker[0] != 0xFF:
+            return None
+        kind = marker[1]
+        while kind == 0xFF:  # fill bytes
+            b = take(1)
+            if b is None:
+                return None
+            kind = b[0]
+        if kind in (0xD8, 0x01) or 0xD0 <= kind <= 0xD7:
+            continue  # markers with no length
+        if kind in (0xD9, 0xDA):
+            return None  # end of image / start of scan before any frame header
+        size = take(2)
+        if size is None:
+            return None
+        length = int.from_bytes(size, "big")
+        if length < 2:
+            return None
+        body = take(length - 2)
+        if body is None:
+            return None
+        if 0xC0 <= kind <= 0xCF and kind not in (0xC4, 0xC8, 0xCC):
+            if len(body) < 5:
+                return None
+            return "jpeg", int.from_bytes(body[3:5], "big"), int.from_bytes(body[1:3], "big")
+
+
+class B64Reader:
+    # read() over base64 text that only decodes as far as has been asked for, 4 chars -> 3 bytes at a time.
+    # bad base64 raises binascii.Error (a ValueError) just like b64decode(validate=True) would
+
+    def __init__(self, text: str):
+        self.text = text
+        self.pos = 0
+        self.buf = b""
+
+    def read(self, n: int) -> bytes:
+        if len(self.buf) < n and self.pos < len(self.text):
+            chars = -(-(n - len(self.buf)) // 3) * 4
+            chunk = self.text[self.pos : self.pos + chars]
+            self.pos += len(chunk)
+            self.buf += base64.b64decode(chunk, validate=True)
+        out, self.buf = self.buf[:n], self.buf[n:]
+        return out
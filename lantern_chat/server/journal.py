@@ -0,0 +1,56 @@
+import json
+import os
+
+from lantern_chat.server.history import to_json
+
+
+class Journal:
+    # append-only log of state changes, one json record per line
+    # ServerState writes one small record per mutation instead of re-dumping all of messages.json,
+    # then every so often compacts everything into a fresh snapshot and truncates this file
+    # only the Persister thread writes to it, and it decides when to fsync
+
+    def __init__(self, path: str):
+        self.path = path
+        self._f = open(path, "a", encoding="utf-8")
+
+    def replay(self):
+        # every record currently in the journal, oldest first
+        # a half-written last line (crash mid-append) is just skipped
+        records = []
+        try:
+            with open(self.path, "r", encoding="utf-8") as f:
+                for line in f:
+                    line = line.strip()
+                    if not line:
+                        continue
+                    try:
+                        records.append(json.loads(line))
+                    except ValueError:
+                        continue
+        except OSError:
+            pass
+        return records
+
+    def append(self, records):
+        # one write for the whole batch, handed to the os straight away so a crashed server doesnt lose it
+        self._f.write("".join(json.dumps(r, separators=(",", ":"), default=to_json) + "\n" for r in records))
+        self._f.flush()
+
+    def sync(self):
+        os.fsync(self._f.fileno())
+
+    def reset(self):
+        # everything in here is in the snapshot now
+        self._f.seek(0)
+        self._f.truncate()
+        self._f.flush()
+        os.fsync(self._f.fileno())
+
+    def close(self):
+        try:
+            self._f.flush()
+            os.fsync(self._f.fileno())
+            self._f.close()
+        except (OSError, ValueError):
+            pass
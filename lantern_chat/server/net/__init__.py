@@ -1,3 +1,4 @@
 from lantern_chat.server.net.manager import networkManager
+from lantern_chat.server.net.aio import asyncNetworkManager
 
-__all__ = ["networkManager"]
\ No newline at end of file
+__all__ = ["networkManager", "asyncNetworkManager"]
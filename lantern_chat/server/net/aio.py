@@ -0,0 +1,82 @@
+import asyncio
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from rich import print
+from lantern_chat.frame import recv_message_async
+
+from lantern_chat.server.net.handlers import registry
+from lantern_chat.server.net.manager import networkManager
+from lantern_chat.server.net.outbox import AsyncOutbox
+
+# threads for handlers that cant run on the loop - enough that plenty of every-write writers can share each fsync
+HANDLER_THREADS = 64
+
+
+class asyncNetworkManager(networkManager):
+    # same handlers + registry as networkManager, but every connection lives on one event loop
+    # instead of getting its own thread. idle clients just cost a StreamReader/StreamWriter pair
+    # "conn" everywhere in here is an AsyncOutbox around the StreamWriter, same interface as the threaded Outbox
+
+    def __init__(self, host, port, state):
+        super().__init__(host, port, state)
+        self.loop = None
+        self._loopThread = None
+        # anything that sits on the disk would hold up every connection on the loop - every-write handlers
+        # (they wait on an fsync) and the ones registered blocking= run on a thread pool instead.
+        # one message per client at a time either way, so each client's are still handled in order
+        self._handlers = ThreadPoolExecutor(HANDLER_THREADS, thread_name_prefix="handler")
+        self._everyWrite = state.durability == "every-write"
+
+    async def _offLoop(self, fn, *args, blocking=False):
+        # fn(*args) on the handler pool if it could block, right here otherwise
+        if not (blocking or self._everyWrite):
+            return fn(*args)
+        return await self.loop.run_in_executor(self._handlers, fn, *args)
+
+    def _write(self, conn, msg: str):
+        # handlers like /disp expire from other threads, hop back onto the loop for those
+        if threading.get_ident() != self._loopThread:
+            self.loop.call_soon_threadsafe(conn.put, msg)
+            return True
+        return conn.put(msg)
+
+    async def _handleStream(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        addr = writer.get_extra_info("peername")
+        outbox = AsyncOutbox(writer, self.state, addr)
+        try:
+            while True:
+                got = await recv_message_async(reader)
+                if got is None:
+                    break
+                msg, blob, tag = got
+                blocking = registry.is_blocking(msg, self.state.store.lazy, tag)
+                await self._offLoop(self._processMessage, msg, addr, outbox, blob, tag, blocking=blocking)
+                if writer.is_closing():
+                    break  # left or got kicked while handling that one
+                # let the transport push back if this client isnt reading what we send it
+                await writer.drain()
+        except Exception as e:
+            print(f"[red][ERROR][/red] client {addr}: {e}")
+        finally:
+            # leaving saves last_seen, which with every-write is an fsync too
+            await self._offLoop(self._dropClient, addr, outbox)
+
+    async def _cleanupLoop(self):
+        while True:
+            await asyncio.sleep(5)
+            await self._offLoop(self._reapIdle)
+            self.state.blobs.sweep_uploads()
+
+    async def _serve(self):
+        self.loop = asyncio.get_running_loop()
+        self._loopThread = threading.get_ident()
+        # bigger accept backlog since reconnect storms all land at once
+        self.sock.listen(1024)
+        server = await asyncio.start_server(self._handleStream, sock=self.sock)
+        print(f"[blue][*][/blue] TCP server listening on {self.host}:{self.port} (asyncio)")
+        self.loop.create_task(self._cleanupLoop())
+        async with server:
+            await server.serve_forever()
+
+    def run(self):
+        asyncio.run(self._serve())
@@ -1,3 +1,4 @@
+import io
 import json
 import time
 import uuid
@@ -5,35 +6,128 @@ import base64
 import threading
 
 from rich import print
-from lantern_chat.frame import send_msg
+from lantern_chat.frame import Frame
+from lantern_chat.protocol import PROTO_VERSION, b64_len
+from lantern_chat.server.blobs import BLOB_CHUNK, valid_digest
+from lantern_chat.server.imageinfo import probe, B64Reader
+from lantern_chat.server.history import to_json
 
 
 TIMEOUT = 60
+# history paging - [JOIN]/[REQ_DM_HISTORY] without a limit= get the old 500, pages are capped at the same
+HISTORY_LIMIT = 500
+# messages per [CHANNEL_HISTORY_BATCH] frame
+HISTORY_BATCH = 100
+# most bytes an uploaded image can be - the same ~8MB of base64 an [IMG] is allowed
+UPLOAD_LIMIT = 8 * 1024 * 1024 * 3 // 4
+# unfinished uploads one user can have on disk at once
+UPLOAD_MAX_OPEN = 4
 # set of banned characters - only _ and - are allowed as special characters, no spaces allowed
 # this is checked server side and client side so users cannot just modify client code to bypass
 # its better to check if a username only contains allow chars rather than bad chars since there is way more banned chars than this yet only allow any letters, num, _ and -
 ALLOWED_CHARS = set("abcdefghijklmnopqrstuvwxyzABCDEFGHIJKLMNOPQRSTUVWXYZ0123456789_-")
 
 
+def _tag(msg: str):
+    # "[DM]|bob|hi" -> "[DM]", None if it doesnt start with a tag
+    if not msg.startswith("["):
+        return None
+    end = msg.find("]")
+    if end == -1:
+        return None
+    return msg[: end + 1]
+
+
+def _opts(fields):
+    # ["before=120", "limit=50"] -> {"before": 120, "limit": 50}, anything that isnt key=<int> is ignored
+    out = {}
+    for field in fields:
+        key, sep, value = field.partition("=")
+        if sep:
+            try:
+                out[key.strip()] = int(value)
+            except ValueError:
+                pass
+    return out
+
+
+def _limit(opts):
+    return max(1, min(opts.get("limit", HISTORY_LIMIT), HISTORY_LIMIT))
+
+
+def _ndjson_batches(history):
+    # HISTORY_BATCH messages at a time as json lines - each one is built just before it goes out
+    # and stands on its own, so nothing ever holds the whole history as one string
+    for i in range(0, len(history), HISTORY_BATCH):
+        yield "\n".join(json.dumps(m.to_dict(), separators=(",", ":")) for m in history[i : i + HISTORY_BATCH])
+
+
 class HandlerRegistry:
     def __init__(self):
-        self._handlers = []
-
-    def register(self, trigger):
+        # tag -> (handler, needs "|" after the tag) - triggers like "[DM]|" only fire when the pipe is there,
+        # so a user called "DM" saying "[DM]: hi" still just goes to chat
+        self._handlers = {}
+        # tag -> True for handlers that do slow disk work, "lazy" for ones that only do with a lazy store
+        # (they can read the db) - the asyncio engine runs those off its loop
+        self._blocking = {}
+        # tag -> [calls, total secs, slowest call secs]
+        self._stats = {}
+        self._statsLock = threading.Lock()
+
+    def register(self, trigger, blocking=False):
         def decorator(fn):
-            self._handlers.append((trigger, fn))
+            tag = _tag(trigger)
+            self._handlers[tag] = (fn, trigger.endswith("|"))
+            self._stats[tag] = [0, 0.0, 0.0]
+            if blocking:
+                self._blocking[tag] = blocking
             return fn
         return decorator
 
-    def dispatch(self, msg, ctx, handler_instance):
-        for trigger, fn in self._handlers:
-            if msg.startswith(trigger):
-                fn(handler_instance, msg, ctx)
-                return True
-        return None
+    def is_blocking(self, msg, lazy=False, tag=None):
+        kind = self._blocking.get(tag or _tag(msg))
+        return kind is True or (kind == "lazy" and lazy)
+
+    def dispatch(self, msg, ctx, handler_instance, tag=None):
+        # v2 frames come with the tag their opcode named, v1 text has it pulled out of the front once -
+        # either way its one dict lookup, not startswith over every trigger
+        if tag is None:
+            tag = _tag(msg)
+        entry = self._handlers.get(tag)
+        if entry is None:
+            return None
+        fn, needsPipe = entry
+        if needsPipe and msg[len(tag) : len(tag) + 1] != "|":
+            return None
+        start = time.perf_counter()
+        try:
+            fn(handler_instance, msg, ctx)
+        finally:
+            took = time.perf_counter() - start
+            with self._statsLock:
+                stat = self._stats[tag]
+                stat[0] += 1
+                stat[1] += took
+                if took > stat[2]:
+                    stat[2] = took
+        return True
 
     def get_handler_names(self):
-        return [trigger for trigger, _ in self._handlers]
+        return list(self._handlers)
+
+    def get_stats(self):
+        # tag -> {"calls", "total_ms", "avg_ms", "max_ms"}, hottest first
+        with self._statsLock:
+            snapshot = {tag: list(stat) for tag, stat in self._stats.items() if stat[0]}
+        out = {}
+        for tag, (calls, total, slowest) in sorted(snapshot.items(), key=lambda kv: -kv[1][1]):
+            out[tag] = {
+                "calls": calls,
+                "total_ms": round(total * 1000, 2),
+                "avg_ms": round(total * 1000 / calls, 3),
+                "max_ms": round(slowest * 1000, 2),
+            }
+        return out
 
 
 registry = HandlerRegistry()
@@ -45,8 +139,20 @@ class HandlerMixin:
 
     def handlePing(self, addr):
         self.send(addr, "[ping]")
-        if addr in self.state.clients:
-            self.state.clients[addr]["last_seen"] = time.time()
+        self.state.touch_client(addr)
+
+    @register("[HELLO]|")
+    def handleHello(self, msg, ctx):
+        # [HELLO]|<highest protocol version the client speaks>
+        # reply goes out as plain text, after that this connection can be sent v2 frames
+        conn = ctx["conn"]
+        try:
+            version = int(msg.split("|", 1)[1])
+        except (IndexError, ValueError):
+            return
+        proto = max(1, min(version, PROTO_VERSION))
+        self.sendConn(conn, f"[HELLO]|{proto}")
+        conn.proto = proto
 
     @register("[REGISTER]|")
     def handleRegister(self, msg, ctx):
@@ -115,28 +221,32 @@ class HandlerMixin:
         self.state.clearLoginAttempts(addr[0])
 
         # i love tokens
-        token = self.state.create_session(username)
+        token = self.state.create_session(username, addr)
         self.state.set_pending_auth(addr, username)
         self.sendConn(conn, f"[AUTH_OK]|{token}")
         print(f"[cyan][~][/cyan] User authenticated: {username} from {addr}")
 
-    @register("[JOIN]|")
+    @register("[JOIN]|", blocking="lazy")
     def handleJoin(self, msg, ctx):
         addr = ctx["addr"]
         conn = ctx["conn"]
-        parts = msg.split("|", 1)
+        # [JOIN]|<username>[|limit=<n>][|since=<id>] - clients that page ask for a small first page, then
+        # [REQ_CHANNEL_HISTORY] the rest as they scroll up. a reconnecting one says the newest message
+        # it has and only gets whats after that, or [CHANNEL_RESYNC] + a fresh page if thats not possible
+        parts = msg.split("|")
         if len(parts) < 2:
             return True
-        _, username = parts
-        username = username.strip()
+        username = parts[1].strip()
+        opts = _opts(parts[2:])
         pending = self.state.pop_pending_auth(addr)
         if pending != username:
             self.sendConn(conn, "[AUTH_FAIL]|Please login first")
             return True
-        now = time.time()
-        self.state.clients[addr] = {"username": username, "last_seen": now, "conn": conn}
+        firstDevice = self.state.add_client(addr, username, conn)
+        self.state.mark_seen(username)
         print(f"[green][+][/green] {username} joined from {addr}")
-        self.broadcast(f"[{username} joined]", excludeAddr=addr)
+        if firstDevice:
+            self.broadcast(f"[{username} joined]", excludeAddr=addr)
         self.sendUserList()
         self.sendUserList(addr)
         self.sendAdminList(addr)
@@ -147,16 +257,38 @@ class HandlerMixin:
             self.send(addr, f"[UNREAD]|{json.dumps(unreadCounts)}")
 
         # send recent channel history so new joiners have some context
-        # with TCP this is a single reliable stream so chunking is just for protocol consistency
-        history = self.state.get_channel_history()
-        payload = json.dumps(history)
-        chunkSize = 4000
-        for i in range(0, max(1, len(payload)), chunkSize):
-            chunk = payload[i : i + chunkSize]
-            self.send(addr, f"[CHANNEL_HISTORY]|{i // chunkSize}|{chunk}")
+        history = None
+        if "since" in opts:
+            history = self.state.get_channel_since(opts["since"], HISTORY_LIMIT)
+            if history is None:
+                self.send(addr, "[CHANNEL_RESYNC]")
+        if history is None:
+            history = self.state.get_channel_history(_limit(opts))
+        if conn.proto >= 3:
+            # the client shows each batch as it arrives instead of waiting for the end
+            for batch in _ndjson_batches(history):
+                self.send(addr, f"[CHANNEL_HISTORY_BATCH]|{batch}")
+        else:
+            # old clients want one json array cut into 4000 char pieces
+            payload = json.dumps(history, default=to_json)
+            chunkSize = 4000
+            for i in range(0, max(1, len(payload)), chunkSize):
+                chunk = payload[i : i + chunkSize]
+                self.send(addr, f"[CHANNEL_HISTORY]|{i // chunkSize}|{chunk}")
         self.send(addr, "[CHANNEL_HISTORY_END]")
         return True
 
+    @register("[REQ_CHANNEL_HISTORY]|", blocking="lazy")
+    def handleReqChannelHistory(self, msg, ctx):
+        # [REQ_CHANNEL_HISTORY]|before=<id>|limit=<n> -> [CHANNEL_HISTORY_PAGE]|<json>, oldest first
+        # fewer than limit back means theres nothing older
+        addr = ctx["addr"]
+        if not self.state.clients.get(addr, {}).get("username"):
+            return
+        opts = _opts(msg.split("|")[1:])
+        history = self.state.get_channel_history(_limit(opts), opts.get("before"))
+        self.send(addr, f"[CHANNEL_HISTORY_PAGE]|{json.dumps(history, default=to_json)}")
+
     @register("[LEAVE]|")
     def handleLeave(self, msg, ctx):
         if ctx is None:
@@ -167,17 +299,24 @@ class HandlerMixin:
             # Called from registry with proper ctx
             addr = ctx["addr"]
         
-        info = self.state.clients.pop(addr, {})
-        username = info.get("username", "unknown")
+        info, lastDevice = self.state.remove_client(addr)
+        if not info:
+            # already gone - the reaper and the clients own reader can both get here
+            return True
+        username = info["username"]
+        if "username" in info:
+            self.state.mark_seen(username)
         conn = info.get("conn")
         if conn:
             try:
                 conn.close()
             except Exception:
                 pass
-        self.state.clear_session(username)
+        self.state.clear_session(username, addr)
         print(f"[red][-][/red] {username} left")
-        self.broadcast(f"[{username} left]")
+        # still online on another device - nothing for everyone else to hear about
+        if lastDevice:
+            self.broadcast(f"[{username} left]")
         self.sendUserList()
         return True
 
@@ -186,7 +325,7 @@ class HandlerMixin:
         addr = ctx["addr"]
         self.sendUserList(addr)
 
-    @register("[REQ_USERS_DETAILED]|")
+    @register("[REQ_USERS_DETAILED]|", blocking="lazy")
     def handleReqUsersDetailed(self, msg, ctx):
         addr = ctx["addr"]
         parts = msg.split("|", 1)
@@ -195,7 +334,21 @@ class HandlerMixin:
             username = self.state.clients.get(addr, {}).get("username", "")
         self.sendUserListDetailed(addr, username)
 
-    @register("[DM]|")
+    @register("[REQ_USER_STATS]")
+    def handleReqUserStats(self, msg, ctx):
+        addr = ctx["addr"]
+        parts = msg.split("|", 1)
+        username = parts[1].strip() if len(parts) > 1 else None
+        if not username:
+            username = self.state.clients.get(addr, {}).get("username")
+        if username:
+            self.sendUserStats(addr, username)
+
+    @register("[REQ_MAX_MSG_LEN]")
+    def handleReqMaxMsgLen(self, msg, ctx):
+        self.sendMaxMessageLen(ctx["addr"])
+
+    @register("[DM]|", blocking="lazy")
     def handleDm(self, msg, ctx):
         addr = ctx["addr"]
         senderInfo = self.state.clients.get(addr, {})
@@ -221,29 +374,36 @@ class HandlerMixin:
         senderInfo["last_msg"] = now
         self.state.add_dm(sender, recipient, text)
         ts = int(time.time())
-        payload = f"[DM]|{sender}|{ts}|{text}"
+        payload = Frame(f"[DM]|{sender}|{ts}|{text}")
 
         # always track unread (online or offline)
         self.state.addUnreadMessage(recipient, sender)
 
         self.sendToUser(recipient, payload)
         self.send(addr, payload)
+        # the senders other devices get it with who it went to, so they can put it in that conversation
+        self.sendToUser(sender, Frame(f"[DM_ECHO]|{recipient}|{ts}|{text}"), minProto=7, excludeAddr=addr)
 
-    @register("[REQ_DM_HISTORY]|")
+    @register("[REQ_DM_HISTORY]|", blocking="lazy")
     def handleReqDmHistory(self, msg, ctx):
         addr = ctx["addr"]
         sender = self.state.clients.get(addr, {}).get("username")
         if not sender:
             return
-        parts = msg.split("|", 1)
+        # [REQ_DM_HISTORY]|<other>[|limit=<n>] opens the conversation with its newest page,
+        # adding before=<id> gets an older page back as [DM_HISTORY_PAGE]|<other>|<json> instead
+        parts = msg.split("|")
         other = parts[1].strip() if len(parts) > 1 else None
         if not other:
             return
         if not self.state.user_exists(other):
             self.send(addr, f"[DM_FAIL]|User '{other}' not found")
             return
-        history = self.state.get_dm_history(sender, other)
-        self.send(addr, f"[DM_HISTORY]|{other}|{json.dumps(history)}")
+        opts = _opts(parts[2:])
+        before = opts.get("before")
+        history = self.state.get_dm_history(sender, other, _limit(opts), before)
+        tag = "[DM_HISTORY]" if before is None else "[DM_HISTORY_PAGE]"
+        self.send(addr, f"{tag}|{other}|{json.dumps(history, default=to_json)}")
 
     @register("[CLEAR_UNREAD]|")
     def handleClearUnread(self, msg, ctx):
@@ -275,7 +435,7 @@ class HandlerMixin:
             self.send(addr, "[ADMIN_ERROR]|Actor mismatch for this connection")
             return
 
-        expectedToken = self.state.get_session_token(actor)
+        expectedToken = self.state.get_session_token(actor, addr)
         if not expectedToken or token != expectedToken:
             self.send(addr, "[ADMIN_ERROR]|Invalid or missing session token")
             return
@@ -319,7 +479,7 @@ class HandlerMixin:
                 info = f"[system] {actor} unbanned {target}"
             else:  # ban
                 self.state.set_banned(target, True, reason=banReason)
-                kickedAddrs = [a for a, d in list(self.state.clients.items()) if d.get("username") == target]
+                kickedAddrs = self.state.client_addrs(target)
                 # construct a stable ban message that includes the optional reason
                 bannedText = banReason or self.state.get_ban_reason(target) or "None"
                 for a in kickedAddrs:
@@ -329,8 +489,7 @@ class HandlerMixin:
 
             self.send(addr, "[ADMIN_OK]|Command applied")
             # announce to channel
-            self.broadcast(info)
-            self.state.add_channel_message("system", info)
+            self.broadcastChannel("system", info)
             return
 
         if command == "rename":
@@ -363,11 +522,8 @@ class HandlerMixin:
 
             info = f"[system] {actor} renamed user {oldName} to {newName}"
             self.send(addr, "[ADMIN_OK]|Username changed")
-            for infoDict in self.state.clients.values():
-                if infoDict.get("username") == oldName:
-                    infoDict["username"] = newName
-            self.broadcast(info)
-            self.state.add_channel_message("system", info)
+            self.state.rename_client(oldName, newName)
+            self.broadcastChannel("system", info)
             # refresh admin list for all, in case an admin was renamed
             self.sendAdminList()
             # refresh user list so panels don't show the old name
@@ -385,17 +541,25 @@ class HandlerMixin:
             removed = self.state.purge_channel_messages(count)
             self.broadcast(f"[PURGE]|{removed}")
             info = f"[system] {actor} purged {removed} message(s)"
-            self.state.add_channel_message("system", info)
-            self.broadcast(info)
+            self.broadcastChannel("system", info)
             self.send(addr, f"[ADMIN_OK]|Purged {removed} message(s)")
             return
 
+        # which handlers are eating the time
+        if command == "handlerstats":
+            stats = registry.get_stats()
+            if not stats:
+                self.send(addr, "[ADMIN_OK]|No handler calls yet")
+                return
+            top = [f"{tag} {v['calls']} calls, avg {v['avg_ms']}ms, max {v['max_ms']}ms" for tag, v in list(stats.items())[:5]]
+            self.send(addr, f"[ADMIN_OK]|{'; '.join(top)}")
+            return
+
         # reload server config
         if command == "reload":
             self.state.reload_config()
             info = f"[system] {actor} reloaded server config"
-            self.state.add_channel_message("system", info)
-            self.broadcast(info)
+            self.broadcastChannel("system", info)
             self.send(addr, "[ADMIN_OK]|Config reloaded")
             return
 
@@ -429,12 +593,11 @@ class HandlerMixin:
                 pass
         lines = [f"[{username}] system"] + [f"  {k}: {v}" for k, v in info.items()]
         for line in lines:
-            self.state.add_channel_message(username if line == lines[0] else "system", line)
-            self.broadcast(line)
+            self.broadcastChannel(username if line == lines[0] else "system", line)
         self.send(addr, "[FETCH_OK]")
 
     # all the handling img methods below,
-    @register("[IMG]|")
+    @register("[IMG]|", blocking=True)  # decodes + writes (and fsyncs) the image
     def handleImg(self, msg, ctx):
         addr = ctx["addr"]
         clientInfo = self.state.clients.get(addr)
@@ -455,25 +618,83 @@ class HandlerMixin:
             return
         clientInfo["last_msg"] = now
 
-        # [IMG]|<filename>|<base64_data>
-        parts = msg.split("|", 2)
-        if len(parts) < 3:
-            return
-        filename, b64 = parts[1], parts[2]
+        # v1: [IMG]|<filename>|<base64_data>
+        # v2: [IMG]|<filename> with the raw image bytes as the attachment
+        raw = ctx.get("blob")
+        if raw is not None:
+            parts = msg.split("|", 1)
+            if len(parts) < 2:
+                return
+            filename = parts[1]
+            size = b64_len(len(raw))
+        else:
+            parts = msg.split("|", 2)
+            if len(parts) < 3:
+                return
+            filename, b64 = parts[1], parts[2]
+            size = len(b64)
         filename = "".join(c for c in filename if 32 <= ord(c) < 127 and c not in '|\\/')[:64] or "image.png"
-        if len(b64) > 8 * 1024 * 1024:
+        if size > 8 * 1024 * 1024:
             self.send(addr, "[ADMIN_ERROR]|Image too large (max ~8MB)")
             return
-        try:
-            base64.b64decode(b64, validate=True)
-        except Exception:
-            self.send(addr, "[ADMIN_ERROR]|Invalid image data")
+        raw, info, error = self._readImage(raw, b64 if raw is None else None)
+        if error:
+            self.send(addr, f"[ADMIN_ERROR]|{error}")
             return
 
-        self.broadcast(f"[IMG]|{sender}|{filename}|{b64}")
-        self.state.add_channel_message(sender, f"[{sender}]: [image: {filename}]")
+        # stored once by hash and kept in the history, so people joining later still get to see it
+        self._postImg(sender, None, filename, self.state.blobs.put(raw, info), raw)
+
+    def _readImage(self, raw, b64):
+        # (raw bytes, probe info, error) for an [IMG]/[DM_IMG] - raw from v2, b64 from v1.
+        # only the header gets looked at before deciding, so junk or a decompression bomb is turned away
+        # without decoding the lot, and the b64 is only decoded (once) if its being kept
+        try:
+            info = probe(io.BytesIO(raw).read if raw is not None else B64Reader(b64).read)
+        except ValueError:
+            info = None
+        error = self._imageError(info)
+        if error:
+            return None, None, error
+        if raw is None:
+            try:
+                raw = base64.b64decode(b64, validate=True)
+            except ValueError:
+                return None, None, "Invalid image data"
+        return raw, info, None
+
+    def _imageError(self, info):
+        # why an image cant be posted, None if it can
+        if info is None or not info[1] or not info[2]:
+            return "Invalid image data"
+        _fmt, width, height = info
+        if width * height > self.state.max_image_pixels:
+            return f"Image too large ({width}x{height}, max {self.state.max_image_pixels:,} pixels)"
+        return None
+
+    def _postImg(self, sender, recipient, filename, digest, raw):
+        # an image thats been checked + stored - its put in the history straight away so it keeps its place
+        # (and id) among the messages around it, then goes out once the worker process has made its preview
+        if recipient:
+            self.state.add_dm(sender, recipient, f"[image: {filename}]", blob=digest)
+            announce = lambda preview: self._announceDmImg(sender, recipient, filename, digest, raw, preview)
+        else:
+            stored = self.state.add_channel_message(sender, f"[{sender}]: [image: {filename}]", blob=digest)
+            announce = lambda preview: self._announceImg(stored.id, sender, filename, digest, raw, preview)
+        self.state.previews.get(digest, announce)
+
+    def _announceImg(self, msgId, sender, filename, digest, raw, preview):
+        # v5 clients get the hash + the preview (a few kb however big the image is), nobody has to decode
+        # and shrink the original themselves, and it can still be [REQ_BLOB]'d. older ones get all of it
+        # (raw for v2, base64 for v1) - each encoded once
+        # no preview (workers off, or it failed) goes out empty and the client fetches the original instead
+        self.broadcast(
+            Frame(f"[IMG_REF]|{msgId}|{sender}|{digest}|{len(raw)}|{filename}", blob=preview or b""),
+            legacy=Frame(f"[IMG]|{sender}|{filename}", blob=raw),
+            minProto=5,
+        )
     # ik this is basically the same as handle_img but i couldnt get it to work any other way - trying to do it in with same method made all dm images show up in the main channel for recipients which was v bad.
-    @register("[DM_IMG]|")
+    @register("[DM_IMG]|", blocking=True)
     def handleDmImg(self, msg, ctx):
         addr = ctx["addr"]
         clientInfo = self.state.clients.get(addr)
@@ -494,30 +715,172 @@ class HandlerMixin:
             return
         clientInfo["last_msg"] = now
 
-        # [DM_IMG]|<recipient>|<base64>
-        parts = msg.split("|", 3)
-        if len(parts) < 4:
-            return
-        recipient, filename, b64 = parts[1], parts[2], parts[3]
+        # v1: [DM_IMG]|<recipient>|<filename>|<base64>
+        # v2: [DM_IMG]|<recipient>|<filename> with the raw bytes as the attachment
+        raw = ctx.get("blob")
+        if raw is not None:
+            parts = msg.split("|", 2)
+            if len(parts) < 3:
+                return
+            recipient, filename = parts[1], parts[2]
+            size = b64_len(len(raw))
+        else:
+            parts = msg.split("|", 3)
+            if len(parts) < 4:
+                return
+            recipient, filename, b64 = parts[1], parts[2], parts[3]
+            size = len(b64)
         filename = "".join(c for c in filename if 32 <= ord(c) < 127 and c not in '|\\/')[:64] or "image.png"
 
         if not self.state.user_exists(recipient):
             self.send(addr, "[DM_FAIL]|User not found")
             return
-        if len(b64) > 8 * 1024 * 1024:
+        if size > 8 * 1024 * 1024:
             self.send(addr, "[ADMIN_ERROR]|Image too large (max ~8MB)")
             return
+        raw, info, error = self._readImage(raw, b64 if raw is None else None)
+        if error:
+            self.send(addr, f"[ADMIN_ERROR]|{error}")
+            return
+
+        self._postImg(sender, recipient, filename, self.state.blobs.put(raw, info), raw)
+
+    def _announceDmImg(self, sender, recipient, filename, digest, raw, preview):
+        # send to recipient (if online) and echo back to sender - reference + preview for v5 clients, like _announceImg
+        ref = Frame(f"[DM_IMG_REF]|{sender}|{recipient}|{digest}|{len(raw)}|{filename}", blob=preview or b"")
+        wire = Frame(f"[DM_IMG]|{sender}|{recipient}|{filename}", blob=raw)
+        self.sendToUser(recipient, ref, legacy=wire, minProto=5)
+        # every one of the senders devices shows it, not just the one it came from
+        self.sendToUser(sender, ref, legacy=wire, minProto=5)
+
+    @register("[REQ_PREVIEW]|")
+    def handleReqPreview(self, msg, ctx):
+        # [REQ_PREVIEW]|<hash> -> [PREVIEW]|<hash> + the preview, for images in history
+        # made now if it never was (images from before previews existed). one that cant be made comes back
+        # empty so the client goes for the original, [BLOB_MISSING] if there isnt even that
+        addr = ctx["addr"]
+        if not self.state.clients.get(addr, {}).get("username"):
+            return
+        digest = msg.split("|", 1)[1].strip()
+
+        def reply(preview):
+            if preview is None and self.state.blobs.size(digest) is None:
+                self.send(addr, f"[BLOB_MISSING]|{digest}")
+            else:
+                self.send(addr, Frame(f"[PREVIEW]|{digest}", blob=preview or b""))
+
+        self.state.previews.get(digest, reply)
+
+    @register("[REQ_BLOB]|")
+    def handleReqBlob(self, msg, ctx):
+        # [REQ_BLOB]|<hash>[|<offset>|<length>] -> [BLOB]|<hash>|<offset>|<total size> with the bytes attached,
+        # never more than BLOB_CHUNK at a time - the client asks for the next range until it has them all
+        addr = ctx["addr"]
+        if not self.state.clients.get(addr, {}).get("username"):
+            return
+        parts = msg.split("|")
+        digest = parts[1].strip()
         try:
-            base64.b64decode(b64, validate=True)
-        except Exception:
-            self.send(addr, "[ADMIN_ERROR]|Invalid image data")
+            offset = int(parts[2]) if len(parts) > 2 else 0
+            length = int(parts[3]) if len(parts) > 3 else BLOB_CHUNK
+        except ValueError:
+            return
+        total = self.state.blobs.size(digest)
+        data = self.state.blobs.read(digest, offset, length) if total is not None else None
+        if data is None:
+            self.send(addr, f"[BLOB_MISSING]|{digest}")
             return
+        self.send(addr, Frame(f"[BLOB]|{digest}|{offset}|{total}", blob=data))
 
-        # send to recipient (if online) and echo back to sender
-        wire = f"[DM_IMG]|{sender}|{recipient}|{filename}|{b64}"
-        self.sendToUser(recipient, wire)
-        self.send(addr, wire)
-        self.state.add_dm(sender, recipient, f"[image: {filename}]")
+    # v6 clients send images as an upload - chunks written straight to disk, then a commit that posts it.
+    # no frame is ever bigger than a chunk so their pings and typing dont queue behind a whole image,
+    # and a dropped connection carries on from whatever made it here instead of starting over
+    @register("[UPLOAD_BEGIN]|")
+    def handleUploadBegin(self, msg, ctx):
+        # [UPLOAD_BEGIN]|<hash>|<size> -> [UPLOAD_OK]|<hash>|<offset to send from>
+        addr = ctx["addr"]
+        sender = self.state.clients.get(addr, {}).get("username")
+        if not sender:
+            return
+        parts = msg.split("|", 2)
+        if len(parts) < 3 or not valid_digest(parts[1]) or not parts[2].isdigit():
+            return
+        digest, size = parts[1], int(parts[2])
+        if self.state.is_muted(sender):
+            self.send(addr, f"[UPLOAD_FAIL]|{digest}|You are muted and cannot send messages")
+            return
+        if size > UPLOAD_LIMIT:
+            self.send(addr, f"[UPLOAD_FAIL]|{digest}|Image too large (max ~8MB)")
+            return
+        if self.state.blobs.size(digest) is not None:
+            offset = size  # same image was sent before, nothing to upload
+        else:
+            offset = self.state.blobs.upload_begin(sender, digest, UPLOAD_MAX_OPEN)
+            if offset is None:
+                self.send(addr, f"[UPLOAD_FAIL]|{digest}|Too many uploads at once, wait for one to finish")
+                return
+        self.send(addr, f"[UPLOAD_OK]|{digest}|{offset}")
+
+    @register("[UPLOAD_CHUNK]|")
+    def handleUploadChunk(self, msg, ctx):
+        # [UPLOAD_CHUNK]|<hash>|<offset> + bytes, no reply. one that doesnt line up with what we have
+        # (sent just before a reconnect) is dropped, the client goes again from [UPLOAD_OK]'s offset
+        addr = ctx["addr"]
+        sender = self.state.clients.get(addr, {}).get("username")
+        data = ctx.get("blob")
+        if not sender or data is None:
+            return
+        parts = msg.split("|", 2)
+        if len(parts) < 3 or not parts[2].isdigit():
+            return
+        self.state.blobs.upload_append(sender, parts[1], int(parts[2]), data, UPLOAD_LIMIT)
+
+    @register("[UPLOAD_COMMIT]|", blocking=True)  # hashes, fsyncs + reads back the whole upload
+    def handleUploadCommit(self, msg, ctx):
+        # [UPLOAD_COMMIT]|<hash>|<dm recipient, empty for the channel>|<filename> -> [UPLOAD_DONE]|<hash>,
+        # then it goes out exactly like an [IMG]/[DM_IMG] would
+        addr = ctx["addr"]
+        clientInfo = self.state.clients.get(addr)
+        if not clientInfo:
+            return
+        sender = clientInfo.get("username")
+        if not sender:
+            return
+        parts = msg.split("|", 3)
+        if len(parts) < 4:
+            return
+        digest, recipient, filename = parts[1], parts[2], parts[3]
+        filename = "".join(c for c in filename if 32 <= ord(c) < 127 and c not in '|\\/')[:64] or "image.png"
+        if self.state.is_muted(sender):
+            self.send(addr, f"[UPLOAD_FAIL]|{digest}|You are muted and cannot send messages")
+            return
+        now = time.time()
+        last = clientInfo.get("last_msg", 0)
+        if self.state.msg_rate_limit > 0 and (now - last) < self.state.msg_rate_limit:
+            wait = round(self.state.msg_rate_limit - (now - last), 1)
+            self.send(addr, f"[RATE_LIMITED]|{wait}")
+            self.send(addr, f"[UPLOAD_FAIL]|{digest}|Slow down")
+            return
+        clientInfo["last_msg"] = now
+        if recipient and not self.state.user_exists(recipient):
+            self.send(addr, f"[UPLOAD_FAIL]|{digest}|User not found")
+            return
+        # checked from its header before its kept, same as an [IMG]
+        info = self.state.blobs.upload_info(sender, digest)
+        error = self._imageError(info)
+        if error:
+            self.state.blobs.upload_discard(sender, digest)
+            self.send(addr, f"[UPLOAD_FAIL]|{digest}|{error}")
+            return
+        if not self.state.blobs.upload_finish(sender, digest, info):
+            self.send(addr, f"[UPLOAD_FAIL]|{digest}|Upload was incomplete or corrupted")
+            return
+        raw = self.state.blobs.load(digest)
+        if raw is None:
+            self.send(addr, f"[UPLOAD_FAIL]|{digest}|Upload was incomplete or corrupted")
+            return
+        self.send(addr, f"[UPLOAD_DONE]|{digest}")
+        self._postImg(sender, recipient, filename, digest, raw)
 
     def _redact(self, text):
         return " ".join("*" * len(w) for w in text.split(" "))
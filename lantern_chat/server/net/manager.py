@@ -3,63 +3,109 @@ import time
 import threading
 import json
 from rich import print
-from lantern_chat.frame import send_msg, recv_msg
+from lantern_chat.frame import Frame, FrameReader
 
 from lantern_chat.server.net.handlers import HandlerMixin, registry
+from lantern_chat.server.net.outbox import Outbox
 
 
 class networkManager(HandlerMixin):
-    def __init__(self, host, port, state):
+    def __init__(self, host, port, state, listen=True):
         self.host = host
         self.port = port
         self.state = state
-        self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-        self.sock.bind((host, port))
-        self.sock.listen(50)
+        # listen=False is just the handlers with no socket behind them, for driving them directly (tests)
+        self.sock = None
+        if listen:
+            self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+            self.sock.bind((host, port))
+            self.sock.listen(50)
+        # presence - joins/leaves within presence_coalesce_ms of each other go out as one update
+        # _announced is the online list as clients last heard it, deltas are always against that
+        self._announced = set()
+        self._presenceLock = threading.Lock()
+        self._presenceTimer = None
+
+    def _write(self, conn, msg):
+        # conn is the client's Outbox - this just queues, the outbox's writer does the actual send
+        # msg can be a str or an already encoded Frame
+        return conn.put(msg)
 
     def send(self, addr, msg: str):
         # send to a specific connected client by addr key
         client = self.state.clients.get(addr)
         if client:
-            try:
-                send_msg(client["conn"], msg)
-            except Exception:
-                self.state.clients.pop(addr, None)
+            self._write(client["conn"], msg)
 
-    def sendConn(self, conn: socket.socket, msg: str):
+    def sendConn(self, conn, msg: str):
         # send directly to a connection before it's been added to clients (e.g. during auth)
-        try:
-            send_msg(conn, msg)
-        except Exception:
-            pass
-
-    def broadcast(self, msg, excludeAddr=None):
-        for addr, info in list(self.state.clients.items()):
+        self._write(conn, msg)
+
+    def broadcast(self, msg, excludeAddr=None, legacy=None, minProto=0):
+        # encode once, every outbox gets the same bytes
+        # a dead or slow client gets cleaned up by its own reader once its outbox shuts, not here
+        # with legacy, connections older than minProto get that instead (also encoded just once)
+        frame = msg if isinstance(msg, Frame) else Frame(msg)
+        for addr, info in self.state.client_list():
             if addr == excludeAddr:
                 continue
-            try:
-                send_msg(info["conn"], msg)
-            except Exception:
-                self.state.clients.pop(addr, None)
-
-    def sendToUser(self, username: str, msg: str) -> bool:
-        for addr, info in list(self.state.clients.items()):
-            if info.get("username") == username:
-                try:
-                    send_msg(info["conn"], msg)
-                except Exception:
-                    self.state.clients.pop(addr, None)
-                return True
-        return False
+            conn = info["conn"]
+            self._write(conn, legacy if legacy is not None and conn.proto < minProto else frame)
+
+    def broadcastChannel(self, sender: str, text: str, excludeAddr=None):
+        # store a channel line and send it out tagged with its id, so reconnecting clients can resume after it
+        stored = self.state.add_channel_message(sender, text)
+        self.broadcast(Frame(text, seq=stored.id), excludeAddr=excludeAddr)
+
+    def sendToUser(self, username: str, msg, legacy=None, minProto=0, excludeAddr=None) -> bool:
+        # every device the user is on, False if theyre offline. legacy/minProto same as broadcast, except
+        # with no legacy a device older than minProto just doesnt get it
+        frame = msg if isinstance(msg, Frame) else Frame(msg)
+        sent = False
+        for addr in self.state.client_addrs(username):
+            client = self.state.clients.get(addr)
+            if client and addr != excludeAddr:
+                conn = client["conn"]
+                if conn.proto < minProto:
+                    if legacy is None:
+                        continue
+                    self._write(conn, legacy)
+                else:
+                    self._write(conn, frame)
+                sent = True
+        return sent
 
     def sendUserList(self, targetAddr=None):
-        userList = ";".join(info["username"] for info in self.state.clients.values())
-        msg = f"[USERS]|{userList}"
+        # one client gets the full list now (just joined / asked for it), everyone else hears about
+        # the change in the next coalesced presence update
         if targetAddr:
-            self.send(targetAddr, msg)
+            with self._presenceLock:
+                # the list the next deltas apply to, so nothing in between gets lost
+                self.send(targetAddr, f"[USERS]|{';'.join(self._announced)}")
         else:
-            self.broadcast(msg)
+            self._presenceChanged()
+
+    def _presenceChanged(self):
+        with self._presenceLock:
+            if self._presenceTimer is None:
+                self._presenceTimer = threading.Timer(self.state.presence_coalesce_ms / 1000, self._flushPresence)
+                self._presenceTimer.daemon = True
+                self._presenceTimer.start()
+
+    def _flushPresence(self):
+        # v4+ clients get [PRESENCE]|+alice;-bob, older ones the whole [USERS] list - each encoded once
+        with self._presenceLock:
+            self._presenceTimer = None
+            online = self.state.online_users()
+            changes = [f"+{u}" for u in sorted(online - self._announced)]
+            changes += [f"-{u}" for u in sorted(self._announced - online)]
+            if not changes:
+                return
+            self._announced = online
+            self.broadcast(
+                Frame(f"[PRESENCE]|{';'.join(changes)}"), legacy=Frame(f"[USERS]|{';'.join(online)}"), minProto=4
+            )
 
     def sendAdminList(self, targetAddr=None):
         admins = ";".join(sorted(self.state.admins))
@@ -79,65 +125,67 @@ class networkManager(HandlerMixin):
         self.send(addr, f"[USER_STATS]|{json.dumps(stats)}")
 
     def sendUserListDetailed(self, addr, requestingUsername: str):
-        online = set(info["username"] for info in self.state.clients.values())
+        online = self.state.online_users()
         allRegistered = set(self.state.users.keys())
         allUsers = allRegistered | online
+        lastDmMap = self.state.get_last_dm_time_for_user(requestingUsername)
         entries = []
         for u in sorted(allUsers):
             if self.state.is_banned(u):
                 continue
             status = "online" if u in online else "offline"
-            lastDmMap = self.state.get_last_dm_time_for_user(requestingUsername)
             ts = lastDmMap.get(u, 0)
             entries.append(f"{u},{status},{ts}")
         self.send(addr, f"[USERS_DETAILED]|{';'.join(entries)}")
 
-    def _handleClient(self, conn: socket.socket, addr):
-        # per-client receive loop - each connection runs in its own thread
-        try:
-            while True:
-                msg = recv_msg(conn)
-                if msg is None:
-                    break  # client disconnected cleanly
+    def _processMessage(self, msg, addr, conn, blob=None, tag=None):
+        # everything that happens to one inbound message, shared by both engines
+        # tag is the one a v2 frame's opcode gave, None for v1 text
+        self.state.touch_client(addr)
 
-                if addr in self.state.clients:
-                    self.state.clients[addr]["last_seen"] = time.time()
+        if msg == "[ping]":
+            self.handlePing(addr)
+            return
 
-                if msg == "[ping]":
-                    self.handlePing(addr)
-                    continue
+        # blob is the raw attachment from a v2 frame (images), None for v1 clients
+        ctx = {"addr": addr, "conn": conn, "blob": blob}
 
-                ctx = {"addr": addr, "conn": conn}
+        result = registry.dispatch(msg, ctx, self, tag)
+        if result is not None:
+            return
 
-                if msg.startswith("[REQ_USER_STATS]"):
-                    parts = msg.split("|", 1)
-                    username = parts[1].strip() if len(parts) > 1 else None
-                    if not username:
-                        username = self.state.clients.get(addr, {}).get("username")
-                    if username:
-                        self.sendUserStats(addr, username)
-                    continue
-                if msg.startswith("[REQ_MAX_MSG_LEN]"):
-                    self.sendMaxMessageLen(addr)
-                    continue
+        self.handleMessage(msg, ctx)
 
-                result = registry.dispatch(msg, ctx, self)
-                if result is not None:
-                    continue
+    def _dropClient(self, addr, conn):
+        # clean up if not already removed (e.g. from ban or explicit leave)
+        if addr in self.state.clients:
+            self.handleLeave({"addr": addr, "conn": None}, None)
+        else:
+            # logged in but never joined - dont leave its token lying around
+            username = self.state.pop_pending_auth(addr)
+            if username:
+                self.state.clear_session(username, addr)
+            try:
+                conn.close()
+            except Exception:
+                pass
 
-                self.handleMessage(msg, ctx)
+    def _handleClient(self, sock: socket.socket, addr):
+        # per-client receive loop - each connection runs in its own thread, writes go through its outbox
+        outbox = Outbox(sock, self.state, addr)
+        reader = FrameReader(sock)
+        try:
+            while True:
+                got = reader.read_tagged()
+                if got is None:
+                    break  # client disconnected cleanly
+                msg, blob, tag = got
+                self._processMessage(msg, addr, outbox, blob, tag)
 
         except Exception as e:
             print(f"[red][ERROR][/red] client {addr}: {e}")
         finally:
-            # clean up if not already removed (e.g. from ban or explicit leave)
-            if addr in self.state.clients:
-                self.handleLeave({"addr": addr, "conn": None}, None)
-            else:
-                try:
-                    conn.close()
-                except Exception:
-                    pass
+            self._dropClient(addr, outbox)
 
     def handleMessage(self, msg, ctx):
         addr = ctx["addr"]
@@ -156,17 +204,20 @@ class networkManager(HandlerMixin):
             return
         clientInfo["last_msg"] = now
         print(f"[purple][>][/purple] {sender} {msg}")
-        self.state.add_channel_message(sender, msg)
-        self.broadcast(msg, excludeAddr=addr)
+        self.broadcastChannel(sender, msg, excludeAddr=addr)
+
+    def _reapIdle(self):
+        now = time.time()
+        for addr, info in self.state.client_list():
+            if now - info["last_seen"] > 60:
+                print(f"[yellow][TIMEOUT][/yellow] {info['username']} removed")
+                self.handleLeave({"addr": addr, "conn": info.get("conn")}, None)
 
     def cleanupLoop(self):
         while True:
             time.sleep(5)
-            now = time.time()
-            for addr, info in list(self.state.clients.items()):
-                if now - info["last_seen"] > 60:
-                    print(f"[yellow][TIMEOUT][/yellow] {info['username']} removed")
-                    self.handleLeave({"addr": addr, "conn": info.get("conn")}, None)
+            self._reapIdle()
+            self.state.blobs.sweep_uploads()
 
     def run(self):
         print(f"[blue][*][/blue] TCP server listening on {self.host}:{self.port}")
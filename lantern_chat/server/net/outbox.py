@@ -0,0 +1,158 @@
+import asyncio
+import socket
+import threading
+from collections import deque
+from rich import print
+from lantern_chat.frame import Frame
+
+# stuff thats fine to lose if a client cant keep up - theyll get the next one anyway
+DROPPABLE = ("[TYPING]|", "[TYPING_STOP]|", "[USERS]|")
+
+
+def is_droppable(msg: str) -> bool:
+    return msg.startswith(DROPPABLE)
+
+
+class Outbox:
+    # bounded outbound queue + writer thread for one client socket (threads engine)
+    # handlers just put() and move on, so one client with a full tcp window only stalls itself
+    # past outbox_soft_limit queued bytes typing/presence get dropped, past outbox_high_water the client gets cut off
+
+    def __init__(self, sock: socket.socket, state, addr=None):
+        self.sock = sock
+        self.state = state
+        self.addr = addr
+        self.proto = 1  # bumped by [HELLO] once the client says it speaks v2
+        self._queue = deque()
+        self._queued = 0
+        self._cond = threading.Condition()
+        self._closing = False
+        self._closed = False
+        threading.Thread(target=self._writer, daemon=True).start()
+
+    def put(self, msg) -> bool:
+        # msg is a str or a Frame - broadcasts pass the same Frame to every outbox
+        frame = msg if isinstance(msg, Frame) else Frame(msg)
+        data = frame.wire(self.proto)
+        size = len(data)
+        with self._cond:
+            if self._closing:
+                return False
+            if self._queued + size > self.state.outbox_soft_limit and is_droppable(frame.text):
+                return True
+            if self._queued + size > self.state.outbox_high_water:
+                overflow = True
+            else:
+                overflow = False
+                self._queue.append(data)
+                self._queued += size
+                self._cond.notify()
+        if overflow:
+            print(f"[yellow][SLOW][/yellow] {self.addr} fell too far behind, disconnecting")
+            self.abort()
+            return False
+        return True
+
+    def is_closing(self) -> bool:
+        return self._closing
+
+    def close(self):
+        # flush whatever is queued (e.g. [BANNED]) then close - reader wakes up straight away
+        with self._cond:
+            if self._closing:
+                return
+            self._closing = True
+            backlog = self._queued
+            self._cond.notify()
+        if backlog > self.state.outbox_soft_limit:
+            self.abort()
+            return
+        try:
+            self.sock.shutdown(socket.SHUT_RD)
+        except OSError:
+            pass
+
+    def abort(self):
+        # drop everything and kill the socket now
+        with self._cond:
+            self._closing = True
+            self._queue.clear()
+            self._queued = 0
+            self._cond.notify()
+        self._shutdown()
+
+    def _shutdown(self):
+        with self._cond:
+            if self._closed:
+                return
+            self._closed = True
+        try:
+            self.sock.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+        try:
+            self.sock.close()
+        except OSError:
+            pass
+
+    def _writer(self):
+        while True:
+            with self._cond:
+                while not self._queue and not self._closing:
+                    self._cond.wait()
+                if not self._queue:
+                    break  # closing and nothing left to flush
+                data = self._queue.popleft()
+            try:
+                self.sock.sendall(data)
+            except OSError:
+                self.abort()
+                return
+            with self._cond:
+                self._queued -= len(data)
+        self._shutdown()
+
+
+class AsyncOutbox:
+    # same policy for the asyncio engine - the transport's write buffer already is the queue,
+    # so just look at how full it is before adding to it
+
+    def __init__(self, writer, state, addr=None):
+        self.writer = writer
+        self.state = state
+        self.addr = addr
+        self.proto = 1
+        self.loop = asyncio.get_running_loop()
+        self._loopThread = threading.get_ident()
+
+    def put(self, msg) -> bool:
+        if self.writer.is_closing():
+            return False
+        frame = msg if isinstance(msg, Frame) else Frame(msg)
+        data = frame.wire(self.proto)
+        buffered = self.writer.transport.get_write_buffer_size()
+        if buffered + len(data) > self.state.outbox_soft_limit and is_droppable(frame.text):
+            return True
+        if buffered + len(data) > self.state.outbox_high_water:
+            print(f"[yellow][SLOW][/yellow] {self.addr} fell too far behind, disconnecting")
+            self.abort()
+            return False
+        self.writer.write(data)
+        return True
+
+    def is_closing(self) -> bool:
+        return self.writer.is_closing()
+
+    def close(self):
+        # asyncio flushes the buffer before actually closing
+        # handlers can be off the loop (every-write, see asyncNetworkManager) - transports only get touched on it
+        if threading.get_ident() != self._loopThread:
+            self.loop.call_soon_threadsafe(self.writer.close)
+            return
+        self.writer.close()
+
+    def abort(self):
+        if threading.get_ident() != self._loopThread:
+            self.loop.call_soon_threadsafe(self.writer.transport.abort)
+            return
+        self.writer.transport.abort()
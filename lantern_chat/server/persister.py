@@ -0,0 +1,159 @@
+import threading
+import time
+from rich import print
+
+DURABILITY_MODES = ("none", "batched", "every-write")
+
+
+class Persister:
+    # background writer for ServerState - mutators queue a journal record and carry on,
+    # this thread writes them out in groups and does the fsync + snapshot work off the request path
+    # the store (JsonStore / SqliteStore) decides what "writing a batch" actually means
+    #   none        - records are written in batches but never fsynced, the os decides when they hit disk
+    #   batched     - one fsync per batch, a record is at most flush_interval_ms / flush_batch writes late
+    #   every-write - the mutating call waits until its record is fsynced (concurrent writers share one fsync)
+
+    def __init__(self, state, store, durability="batched", interval_ms=50, batch=256):
+        self.state = state
+        self.store = store
+        self.durability = durability if durability in DURABILITY_MODES else "batched"
+        self.interval = max(interval_ms, 1) / 1000
+        self.batch = max(batch, 1)
+        self._pending = []  # records not in the journal yet, in seq order
+        self._written = 0  # records in the journal since the last snapshot
+        self._durable = state._seq  # highest seq that's safely on disk
+        self._dropped = set()  # seqs above _durable that failed to write, so nobody waits on them forever
+        self._waiters = 0
+        self._compactWanted = False
+        self._compactions = 0
+        self._closing = False
+        self._cond = threading.Condition()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def submit(self, record: dict):
+        # caller holds state._save_lock so records land here in seq order
+        with self._cond:
+            self._pending.append(record)
+            if len(self._pending) >= self.batch:
+                self._cond.notify()
+
+    def wait(self, seq: int):
+        # block until record seq is fsynced (every-write)
+        with self._cond:
+            self._waiters += 1
+            self._cond.notify_all()
+            try:
+                while self._durable < seq and seq not in self._dropped and self._thread.is_alive():
+                    self._cond.wait(1.0)
+            finally:
+                self._waiters -= 1
+
+    def flush(self):
+        # wait until everything committed so far is written out - for reads that go to the store directly
+        self.wait(self.state._seq)
+
+    def compact(self):
+        # snapshot now and wait for it
+        with self._cond:
+            target = self._compactions + 1
+            self._compactWanted = True
+            self._cond.notify_all()
+            while self._compactions < target and self._thread.is_alive():
+                self._cond.wait(1.0)
+
+    def close(self):
+        # flush everything that's queued and leave a fresh snapshot behind
+        with self._cond:
+            self._closing = True
+            self._cond.notify_all()
+        self._thread.join()
+
+    def _run(self):
+        while True:
+            with self._cond:
+                deadline = None
+                while not self._closing and not self._compactWanted:
+                    if self._pending:
+                        if self._waiters or len(self._pending) >= self.batch:
+                            break
+                        if deadline is None:
+                            deadline = time.monotonic() + self.interval
+                        left = deadline - time.monotonic()
+                        if left <= 0:
+                            break
+                        self._cond.wait(left)
+                    else:
+                        self._cond.wait()
+                batch, self._pending = self._pending, []
+                compact = self._compactWanted
+                closing = self._closing
+            if batch:
+                self._flush(batch)
+            if compact or closing or (self.store.compacts and self._written >= self.state.journal_compact_every):
+                self._compact()
+            if closing:
+                return
+
+    def _flush(self, batch):
+        written = batch
+        try:
+            self.store.write(batch)
+        except Exception as e:
+            # the batch went in as one write (journal line dump / sqlite transaction) so none of it landed -
+            # go again one record at a time, so only whatever actually broke it gets dropped
+            print(f"[yellow][WARN][/yellow] write failed ({e}), retrying {len(batch)} changes one at a time")
+            written = []
+            for rec in batch:
+                try:
+                    self.store.write([rec])
+                    written.append(rec)
+                except Exception as e:
+                    print(f"[red][ERROR][/red] change {rec['seq']} ({rec['op']}) lost: {e}")
+                    self._drop(rec["seq"])
+        if not written:
+            return
+        if self.durability != "none":
+            try:
+                self.store.sync()
+            except Exception as e:
+                print(f"[red][ERROR][/red] sync failed: {e}")
+        self._written += len(written)
+        self._markDurable(written[-1]["seq"])
+
+    def _compact(self):
+        # state hands over copies + the seq they're up to, the slow part (dumping) happens without its lock
+        if not self.store.compacts:
+            self._compactDone()
+            return
+        with self.state._save_lock:
+            seq, files = self.state._capture_snapshot()
+            with self._cond:
+                # anything still queued at or below seq is already in the copies
+                self._pending = [r for r in self._pending if r["seq"] > seq]
+        try:
+            self.store.snapshot(files, sync=self.durability != "none")
+            self._written = 0
+        except Exception as e:
+            print(f"[red][ERROR][/red] snapshot failed: {e}")
+        self._markDurable(seq)
+        self._compactDone()
+
+    def _compactDone(self):
+        with self._cond:
+            self._compactWanted = False
+            self._compactions += 1
+            self._cond.notify_all()
+
+    def _drop(self, seq: int):
+        # never written - _durable doesnt move for it, but anyone waiting on it is let go
+        with self._cond:
+            self._dropped.add(seq)
+            self._cond.notify_all()
+
+    def _markDurable(self, seq: int):
+        with self._cond:
+            if seq > self._durable:
+                self._durable = seq
+                self._dropped = {s for s in self._dropped if s > seq}
+            self._cond.notify_all()
@@ -0,0 +1,100 @@
+import io
+import multiprocessing
+import threading
+from concurrent.futures import ProcessPoolExecutor
+from rich import print
+
+# the box clients draw an image in, in terminal cells - same numbers as client/net/image.py
+PREVIEW_WIDTH = 80
+PREVIEW_HEIGHT = 40
+
+
+def make_preview(path: str, max_pixels: int):
+    # runs in a worker process - original image file -> png of exactly what the client will draw
+    # (one pixel per cell, height already squashed since a cell is ~2x taller than wide), None if it cant
+    try:
+        from PIL import Image
+    except ImportError:
+        return None
+    # already checked from the header before it got here, this is pillow double checking
+    Image.MAX_IMAGE_PIXELS = max_pixels
+    with Image.open(path) as img:
+        # jpegs can decode straight at a smaller size, which is most of the work for big photos
+        img.draft("RGB", (PREVIEW_WIDTH * 2, PREVIEW_HEIGHT * 4))
+        img = img.convert("RGB")
+    w = min(img.width, PREVIEW_WIDTH)
+    h = max(1, min(int(img.height * (w / img.width) * 0.45), PREVIEW_HEIGHT))
+    img = img.resize((w, h), Image.LANCZOS)
+    buf = io.BytesIO()
+    img.save(buf, format="PNG")
+    return buf.getvalue()
+
+
+class PreviewPool:
+    # makes previews off the handler threads, in worker processes - resizing is cpu bound so threads would
+    # just queue up on the GIL behind it. the pool starts on first use, with spawn rather than fork since
+    # forking a process full of threads can hand the child a lock some other thread was holding
+    # asking for a preview thats already being made just waits on that one
+    # images over max_pixels never get opened, whatever got them into the store
+
+    def __init__(self, blobs, workers: int = 2, max_pixels: int = 40 * 1000 * 1000):
+        self.blobs = blobs
+        self.workers = workers
+        self.max_pixels = max_pixels
+        self._pool = None
+        self._lock = threading.Lock()
+        self._waiting = {}  # digest -> callbacks waiting on its preview
+
+    def get(self, digest: str, callback):
+        # callback(png bytes or None) once blob `digest` has a preview - right here if it already does,
+        # otherwise from a pool thread when the worker is done
+        data = self.blobs.read_preview(digest)
+        if data is not None or self.workers <= 0 or not self._fits(self.blobs.info(digest)):
+            callback(data)
+            return
+        with self._lock:
+            if digest in self._waiting:
+                self._waiting[digest].append(callback)
+                return
+            self._waiting[digest] = [callback]
+            try:
+                if self._pool is None:
+                    self._pool = ProcessPoolExecutor(self.workers, mp_context=multiprocessing.get_context("spawn"))
+                future = self._pool.submit(make_preview, self.blobs.path(digest), self.max_pixels)
+            except Exception as e:
+                print(f"[red][ERROR][/red] preview pool: {e}")
+                self._pool = None
+                future = None
+        if future is None:
+            self._finish(digest, None)
+            return
+        future.add_done_callback(lambda f: self._done(digest, f))
+
+    def _fits(self, info):
+        # info is BlobStore.info() - None for missing or not an image
+        return info is not None and info[1] * info[2] <= self.max_pixels
+
+    def _done(self, digest, future):
+        try:
+            data = future.result()
+        except Exception as e:
+            print(f"[yellow][WARN][/yellow] couldn't make a preview for {digest[:12]}: {e}")
+            data = None
+        if data:
+            self.blobs.put_preview(digest, data)
+        self._finish(digest, data)
+
+    def _finish(self, digest, data):
+        with self._lock:
+            callbacks = self._waiting.pop(digest, [])
+        for callback in callbacks:
+            try:
+                callback(data)
+            except Exception as e:
+                print(f"[red][ERROR][/red] preview callback: {e}")
+
+    def close(self):
+        with self._lock:
+            pool, self._pool = self._pool, None
+        if pool is not None:
+            pool.shutdown(wait=False)
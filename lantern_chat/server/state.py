@@ -4,6 +4,14 @@ import os
 import secrets
 import threading
 import time
+from contextlib import contextmanager
+from rich import print
+
+from lantern_chat.server.blobs import BlobStore
+from lantern_chat.server.history import History, StoredMessage
+from lantern_chat.server.persister import Persister, DURABILITY_MODES
+from lantern_chat.server.preview import PreviewPool
+from lantern_chat.server.storage import JsonStore, SqliteStore, STORAGE_KINDS
 
 _DATA_DIR = os.path.join(os.path.expanduser("~"), ".local", "share", "lantern")
 _CONFIG_DIR = os.path.join(os.path.expanduser("~"), ".config", "lantern")
@@ -11,6 +19,9 @@ os.makedirs(_DATA_DIR, exist_ok=True)
 os.makedirs(_CONFIG_DIR, exist_ok=True)
 HISTORY_FILE = os.path.join(_DATA_DIR, "messages.json")
 USERS_FILE = os.path.join(_DATA_DIR, "users.json")
+JOURNAL_FILE = os.path.join(_DATA_DIR, "journal.log")
+DB_FILE = os.path.join(_DATA_DIR, "lantern.db")
+BLOB_DIR = os.path.join(_DATA_DIR, "blobs")
 CONFIG_FILE = os.path.join(_CONFIG_DIR, "server.json")
 
 
@@ -20,45 +31,69 @@ def _hash_password(password: str, salt: str) -> str:
 
 
 class ServerState:
+    # locking - every client thread (or the event loop), cleanupLoop and the persister all share this
+    #   _save_lock     every change to users/history/dms/unread/stats goes through _commit under it, so
+    #                  theres one writer at a time and the journal seq matches the order things happened.
+    #                  anything that reads a value and writes back something based on it (unread +1,
+    #                  ban/mute editing a user entry, "is the name free" then register/rename) holds it
+    #                  across both, through _saving(). RLock, _commit inside is fine
+    #   History._lock  one per conversation (and the channel), so readers copying a page out never
+    #                  trip over an append. writers still go one at a time, the seq has to anyway
+    #   _clients_lock  clients, connections and sessions - who is online on which connection
+    #   _logins_lock   failed_logins
+    # other reads dont lock: they grab the dict once and copy out of it (dict(), list(), client_list())
+    # instead of looping over the live thing, since another thread can change it mid loop.
+    # _save_lock is always the outer one - never take it while holding any of the others.
+    # and never wait on an every-write fsync while holding it: the persister takes it to snapshot,
+    # so _saving() does that wait after the outermost one is let go
     def __init__(self):
         self.clients = {}  # addr -> {"username": str, "last_seen": float}
+        # username -> set of addrs in clients, one per device the user is logged in from
+        # only touched through add_client/remove_client/rename_client so it never drifts from clients
+        self.connections = {}
+        self._clients_lock = threading.Lock()
         self.pending_auth = {}  # addr -> username (after LOGIN/REGISTER success, until JOIN)
-        self.sessions = {}  # username -> current session token
-
-        self.users = self._load_users()  # username -> dict/legacy password
-        self.channel_messages = self._load_channel_messages()
-        self.dm_conversations = self._load_dm_conversations()  # (u1,u2) normalized -> [{"sender", "text", "timestamp"}]
+        self.sessions = {}  # username -> {addr: session token}, one per logged in connection
         self._dm_key = lambda a, b: tuple(sorted([a, b]))
 
-        self.admins = self._load_admins()  # set of usernames
-        
-        # load config values
-        self.fetch_cooldown = self._load_config_int("fetch_cooldown", 30)
-        self.msg_rate_limit = self._load_config_float("msg_rate_limit", 1.0)
-        self.max_msg_len = self._load_config_int("max_msg_len", 400)
-        self.max_channel_messages = self._load_config_int("max_channel_messages", 2000)
-        self.max_dm_messages = self._load_config_int("max_dm_messages", 5000)
-        self.login_rate_limit_attempts = self._load_config_int("login_rate_limit_attempts", 5)
-        self.login_rate_limit_window = self._load_config_int("login_rate_limit_window", 300)
-        self.login_rate_limit_lockout = self._load_config_int("login_rate_limit_lockout", 900)
+        # load config values - server.json is parsed once into _config, the _load_config_* just read from that
+        self._config = self._read_config()
+        self._load_settings()
+        # these only take effect on restart
+        self.durability = self._load_config_str("durability", "batched", DURABILITY_MODES)
+        self.storage = self._load_config_str("storage", "json", STORAGE_KINDS)
 
         self.fetch_last = {}
         self.failed_logins = {}
-        self.unreadMessages = self._loadUnreadMessages()  # username -> {sender: count}
-        self.usersWithUnread = self._loadUsersWithUnread()  # username -> set(senders)
-        self._save_lock = threading.Lock()
-        
-
-    def _loadUnreadMessages(self):
-        # load unread message counts from history file
-        if os.path.exists(HISTORY_FILE):
-            try:
-                with open(HISTORY_FILE, "r") as f:
-                    data = json.load(f)
-                    return data.get("unread", {})
-            except Exception:
-                pass
-        return {}
+        self._logins_lock = threading.Lock()
+        self._save_lock = threading.RLock()
+        self._saving_local = threading.local()  # per thread: _saving() depth + newest seq it committed
+
+        if self.storage == "sqlite":
+            self.store = SqliteStore(DB_FILE, self.durability)
+        else:
+            self.store = JsonStore(HISTORY_FILE, USERS_FILE, JOURNAL_FILE)
+        # sent images, by content hash - messages only keep the hash
+        self.blobs = BlobStore(BLOB_DIR, sync=self.durability != "none")
+        self.previews = PreviewPool(self.blobs, self._load_config_int("preview_workers", 2), self.max_image_pixels)
+        # users: username -> dict/legacy password
+        # channel_messages: History of StoredMessage
+        # dm_conversations: "u1,u2" sorted -> History of the same
+        # dm_index: username -> {peer: timestamp of the newest dm between them}
+        # user_stats: username -> counters for get_user_stats, kept up to date by the _apply_* below
+        # unreadMessages: username -> {sender: count}, usersWithUnread: username -> set(senders)
+        replayed = self._load_data()
+        # disk writes happen on the persister thread from here on
+        self.persister = Persister(
+            self,
+            self.store,
+            self.durability,
+            self._load_config_int("flush_interval_ms", 50),
+            self._load_config_int("flush_batch", 256),
+        )
+        if replayed:
+            # fold it all into a fresh snapshot so the next start is quick
+            self.save_all()
 
     def _loadUsersWithUnread(self):
         # build reverse index: username -> {users who sent unread msgs}
@@ -67,110 +102,244 @@ class ServerState:
             result[username] = set(k for k, v in unreadMap.items() if v > 0)
         return result
 
-    def _load_users(self):
-        if os.path.exists(USERS_FILE):
+    def _load_data(self):
+        # every data file is read once here, and the counts/timing get logged so slow starts are obvious
+        # _lazy means dm conversations come out of the store on first use instead of all being in memory
+        started = time.perf_counter()
+        self._lazy = False
+        replayed = 0
+        legacy = any(os.path.exists(p) and os.path.getsize(p) for p in (HISTORY_FILE, USERS_FILE, JOURNAL_FILE))
+        if self.store.lazy and self.store.is_new and legacy:
+            # first start on sqlite with json files still around - bring everything over once
+            old = JsonStore(HISTORY_FILE, USERS_FILE, JOURNAL_FILE)
+            data = old.load(self.max_channel_messages, self.max_dm_messages)
+            self._use_data(data)
+            self._replay_journal(old.replay())
+            numbered = self._number_messages()
+            old.close()
+            self.store.import_state(
+                self.users, self.channel_messages, self.dm_conversations, self.unreadMessages, self.user_stats, self._seq,
+                self._purge_seq,
+            )
+            print(f"[blue][*][/blue] Imported json history into {DB_FILE}")
+        else:
+            # json: messages.json + users.json are a snapshot, journal.log has every change since
+            # sqlite: only whats needed up front, the rest stays in the db
+            data = self.store.load(self.max_channel_messages, self.max_dm_messages)
+            self._use_data(data)
+            if not self.store.lazy:
+                replayed = self._replay_journal(self.store.replay())
+            numbered = self._number_messages()
+        self._lazy = self.store.lazy
+
+        took = (time.perf_counter() - started) * 1000
+        dmCount = sum(len(m) for m in self.dm_conversations.values())
+        dms = f"{len(self.dm_conversations)} dm conversations ({dmCount} messages)" if not self._lazy else "dms on demand"
+        print(
+            f"[blue][*][/blue] Loaded {len(self.users)} users, {len(self.channel_messages)} channel messages, "
+            f"{dms}, {replayed} journal records in {took:.0f}ms ({self.storage})"
+        )
+        if data["skipped"]:
+            print(f"[yellow][WARN][/yellow] skipped {data['skipped']} malformed records while loading")
+        # freshly numbered messages go into the snapshot too, so their ids stay the same from now on
+        return replayed or (numbered and not self._lazy)
+
+    def _use_data(self, data):
+        # _seq is the last journal record applied, the snapshot remembers which one it's up to
+        self.users = data["users"]
+        self.channel_messages = History(data["channel"], self.max_channel_messages)
+        self.dm_conversations = {k: History(m, self.max_dm_messages) for k, m in data["dm"].items()}
+        self.unreadMessages = data["unread"]
+        self.usersWithUnread = self._loadUsersWithUnread()
+        self._seq = data["seq"]
+        # seq of the last /purge - a client that last saw something before it has to start over
+        self._purge_seq = data["purge_seq"]
+        self.user_stats = data["stats"]
+        if self.user_stats is None:
+            # snapshot from before counters existed - best we can do is count whats still in history
+            self.user_stats = {}
+            for msg in self.channel_messages:
+                self._count_message(msg, "channel_messages")
+            for msgs in self.dm_conversations.values():
+                for msg in msgs:
+                    self._count_message(msg, "dm_messages")
+        # with a lazy store a user's entry is filled in the first time someone asks for it
+        self.dm_index = {}
+        for key, msgs in self.dm_conversations.items():
+            newest = msgs.newest()
+            if newest is not None:
+                self._index_dm(key, newest.timestamp)
+
+    def _number_messages(self):
+        # history from before messages had ids (journal records replayed on top of it did get their seq).
+        # the whole lot is numbered again in order from past _seq, so ids still only go up through the
+        # history and whatever is added next gets a bigger one. returns how many got an id
+        msgs = list(self.channel_messages)
+        for key in sorted(self.dm_conversations):
+            msgs.extend(self.dm_conversations[key])
+        if all(m.id is not None for m in msgs):
+            return 0
+        for msg in msgs:
+            self._seq += 1
+            msg.id = self._seq
+        return len(msgs)
+
+    def _replay_journal(self, records):
+        # rebuild whatever happened after the last snapshot, skipping anything the snapshot already has
+        replayed = 0
+        for rec in records:
+            seq = rec.get("seq", 0)
+            if seq <= self._seq:
+                continue
             try:
-                with open(USERS_FILE, "r") as f:
-                    return json.load(f)
+                self._apply(rec.get("op"), rec)
             except Exception:
-                pass
-        return {}
+                continue
+            self._seq = seq
+            replayed += 1
+        return replayed
+
+    def _apply(self, op, rec):
+        # the only place state actually changes - live mutators and journal replay both come through here
+        if op == "user":
+            self.users[rec["username"]] = rec["entry"]
+        elif op == "chan":
+            return self._apply_channel_message(self._as_message(rec["msg"], rec["seq"]))
+        elif op == "purge":
+            self._purge_seq = rec["seq"]
+            return self._apply_purge(rec["count"])
+        elif op == "dm":
+            return self._apply_dm(rec["key"], self._as_message(rec["msg"], rec["seq"]))
+        elif op == "rename":
+            return self._apply_rename(rec["old"], rec["new"])
+        elif op == "unread":
+            return self._apply_unread(rec["user"], rec["sender"], rec["count"])
+        elif op == "seen":
+            self._touch(self._stats_for(rec["username"]), rec["ts"])
+
+    def _as_message(self, msg, seq):
+        # replayed journal records have plain dicts, live ones already have a StoredMessage
+        # either way the message id is the seq of the record that added it
+        if not isinstance(msg, StoredMessage):
+            msg = StoredMessage.from_dict(msg)
+        msg.id = seq
+        return msg
 
-    def _load_channel_messages(self):
-        if os.path.exists(HISTORY_FILE):
+    @contextmanager
+    def _saving(self):
+        # _save_lock for a change (or a read-then-change). with every-write, whatever this thread committed
+        # inside is waited on once the outermost _saving() has let the lock go
+        local = self._saving_local
+        depth = getattr(local, "depth", 0)
+        with self._save_lock:
+            local.depth = depth + 1
             try:
-                with open(HISTORY_FILE, "r") as f:
-                    data = json.load(f)
-                    # use a large sentinel since max_channel_messages isn't loaded yet
-                    return data.get("channel", [])[-99999:]
-            except Exception:
-                pass
-        return []
+                yield
+            finally:
+                local.depth = depth
+        if depth == 0:
+            seq, local.seq = getattr(local, "seq", 0), 0
+            if seq and self.durability == "every-write":
+                self.persister.wait(seq)
+
+    def _commit(self, op, **fields):
+        # apply a change and queue its journal record as one step under _save_lock,
+        # so a snapshot can never have the change without its seq or the other way round
+        with self._saving():
+            seq = self._seq + 1
+            fields["seq"] = seq
+            result = self._apply(op, fields)
+            self._seq = seq
+            fields["op"] = op
+            self.persister.submit(fields)
+            self._saving_local.seq = seq
+        return result
 
-    def _load_dm_conversations(self):
-        if os.path.exists(HISTORY_FILE):
+    def _read_config(self):
+        if os.path.exists(CONFIG_FILE):
             try:
-                with open(HISTORY_FILE, "r") as f:
+                with open(CONFIG_FILE, "r") as f:
                     data = json.load(f)
-                    return data.get("dm", {})
+                if isinstance(data, dict):
+                    return data
             except Exception:
                 pass
         return {}
 
+    def _load_settings(self):
+        # 2nd value passed is default
+        self.admins = self._load_admins()  # set of usernames
+        self.fetch_cooldown = self._load_config_int("fetch_cooldown", 30)
+        self.msg_rate_limit = self._load_config_float("msg_rate_limit", 1.0)
+        self.max_msg_len = self._load_config_int("max_msg_len", 400)
+        self.max_channel_messages = self._load_config_int("max_channel_messages", 2000)
+        self.max_dm_messages = self._load_config_int("max_dm_messages", 5000)
+        self.login_rate_limit_attempts = self._load_config_int("login_rate_limit_attempts", 5)
+        self.login_rate_limit_window = self._load_config_int("login_rate_limit_window", 300)
+        self.login_rate_limit_lockout = self._load_config_int("login_rate_limit_lockout", 900)
+        self.outbox_soft_limit = self._load_config_int("outbox_soft_limit", 1024 * 1024)
+        self.outbox_high_water = self._load_config_int("outbox_high_water", 32 * 1024 * 1024)
+        self.journal_compact_every = self._load_config_int("journal_compact_every", 5000)
+        self.presence_coalesce_ms = self._load_config_int("presence_coalesce_ms", 250)
+        self.max_image_pixels = self._load_config_int("max_image_pixels", 40 * 1000 * 1000)
+
     def _load_admins(self):
-        if os.path.exists(CONFIG_FILE):
-            try:
-                with open(CONFIG_FILE, "r") as f:
-                    data = json.load(f)
-                admins = data.get("admins", [])
-                if isinstance(admins, list):
-                    return set(str(a) for a in admins if a)
-            except Exception:
-                pass
+        admins = self._config.get("admins", [])
+        if isinstance(admins, list):
+            return set(str(a) for a in admins if a)
         return set()
-       
+
     def _load_config_int(self, key, default):
-        if os.path.exists(CONFIG_FILE):
-            try:
-                with open(CONFIG_FILE, "r") as f:
-                    data = json.load(f)
-                    return int(data.get(key, default))
-            except Exception:
-                pass
-        return default
+        try:
+            return int(self._config.get(key, default))
+        except (TypeError, ValueError):
+            return default
 
-    def _load_config_float(self, key, default):
-        if os.path.exists(CONFIG_FILE):
-            try:
-                with open(CONFIG_FILE, "r") as f:
-                    data = json.load(f)
-                    return float(data.get(key, default))
-            except Exception:
-                pass
-        return default
+    def _load_config_str(self, key, default, choices):
+        value = str(self._config.get(key, default))
+        return value if value in choices else default
 
-    def _load_fetch_cooldown(self):
-        if os.path.exists(CONFIG_FILE):
-            try:
-                with open(CONFIG_FILE, "r") as f:
-                    data = json.load(f)
-                    return int(data.get("fetch_cooldown"))
-            except Exception:
-                pass
-        return 30 # default cooldown if fetch_cooldown missing
-
-    def _load_msg_rate_limit(self):
-        if os.path.exists(CONFIG_FILE):
-            try:
-                with open(CONFIG_FILE, "r") as f:
-                    data = json.load(f)
-                    return float(data.get("msg_rate_limit", 1.0))
-            except Exception:
-                pass
-        return 1.0  # default: 1 message per second
+    def _load_config_float(self, key, default):
+        try:
+            return float(self._config.get(key, default))
+        except (TypeError, ValueError):
+            return default
 
     def save_admins(self):
-        data = {"admins": sorted(self.admins)}
+        # keep the rest of server.json, we have it all in _config anyway
+        self._config["admins"] = sorted(self.admins)
         os.makedirs(os.path.dirname(CONFIG_FILE), exist_ok=True)
         with open(CONFIG_FILE, "w") as f:
-            json.dump(data, f, indent=2)
+            json.dump(self._config, f, indent=2)
 
     def save_all(self):
+        # full snapshot + empty journal, waits for it - normal changes go through _commit
+        self.persister.compact()
+
+    def close(self):
+        # clean shutdown - flush whatever is queued and leave a snapshot behind
+        self.persister.close()
+        self.store.close()
+        self.previews.close()
+
+    def _capture_snapshot(self):
+        # persister holds _save_lock while this runs. copies only, the dumping happens after the lock is dropped
+        # the lists/dicts are copied since handlers keep appending to them while the snapshot is written
+        users = {u: dict(e) if isinstance(e, dict) else e for u, e in self.users.items()}
         data = {
-            "channel": self.channel_messages[-self.max_channel_messages:],
-            "dm": self.dm_conversations,
-            "unread": self.unreadMessages,
+            "channel": list(self.channel_messages),
+            "dm": {k: list(v) for k, v in self.dm_conversations.items()},
+            "unread": {u: dict(m) for u, m in self.unreadMessages.items()},
+            "stats": {u: dict(st) for u, st in self.user_stats.items()},
+            "seq": self._seq,
+            "purge_seq": self._purge_seq,
         }
-        with self._save_lock:
-            with open(HISTORY_FILE, "w") as f:
-                json.dump(data, f)
-            with open(USERS_FILE, "w") as f:
-                json.dump(self.users, f)
+        return self._seq, ((USERS_FILE, users), (HISTORY_FILE, data))
 
     def validate_user(self, username: str, password: str) -> bool:
-        if username not in self.users:
+        entry = self.users.get(username)
+        if entry is None:
             return False
-        entry = self.users[username]
 
         if isinstance(entry, dict):
             if entry.get("banned"):
@@ -195,66 +364,215 @@ class ServerState:
         if not username or not username.strip():
             return False
         username = username.strip()
-        if username in self.users:
-            return False
         salt = secrets.token_hex(16)
 
         h = _hash_password(password, salt)
-        self.users[username] = {
+        entry = {
             "salt": salt,
             "hash": h,
             "banned": False,
             "muted": False,
         }
-        self.save_all()
+        with self._saving():
+            # two people registering the same name at once - only the first one gets it
+            if username in self.users:
+                return False
+            self._commit("user", username=username, entry=entry)
         return True
 
-    def add_channel_message(self, sender: str, text: str):
-        msg = {"sender": sender, "text": text, "timestamp": time.time()}
-        self.channel_messages.append(msg)
-        self.channel_messages[:] = self.channel_messages[-self.max_channel_messages:]
-        self.save_all()
+    def add_channel_message(self, sender: str, text: str, blob: str = None):
+        msg = StoredMessage(sender, text, time.time(), blob=blob)
+        self._commit("chan", msg=msg)
         return msg
 
+    def _apply_channel_message(self, msg):
+        self.channel_messages.append(msg)
+        self._count_message(msg, "channel_messages")
+
     def purge_channel_messages(self, count: int):
         # purge last n messages from chat - only main channel
-        removed = min(count, len(self.channel_messages))
-        self.channel_messages = self.channel_messages[:-removed] if removed else self.channel_messages
-        self.save_all()
-        return removed
-
-    def get_channel_history(self, limit=500):
-        return self.channel_messages[-limit:]
+        with self._saving():
+            # never more than whats in memory, so a lazy store deletes exactly the same messages
+            return self._commit("purge", count=min(count, len(self.channel_messages)))
+
+    def _apply_purge(self, count: int):
+        removed = self.channel_messages.pop_newest(count)
+        for msg in removed:
+            st = self.user_stats.get(msg.sender)
+            if st and st["channel_messages"] > 0:
+                st["channel_messages"] -= 1
+        return len(removed)
+
+    def _stats_for(self, username: str):
+        st = self.user_stats.get(username)
+        if st is None:
+            st = self.user_stats[username] = {
+                "channel_messages": 0,
+                "dm_messages": 0,
+                "bytes_sent": 0,
+                "first_seen": 0,
+                "last_seen": 0,
+            }
+        return st
+
+    def _touch(self, st, ts):
+        if not st["first_seen"] or ts < st["first_seen"]:
+            st["first_seen"] = ts
+        if ts > st["last_seen"]:
+            st["last_seen"] = ts
+
+    def _count_message(self, msg, field):
+        st = self._stats_for(msg.sender)
+        st[field] += 1
+        st["bytes_sent"] += len(msg.text.encode())
+        self._touch(st, msg.timestamp)
+
+    def mark_seen(self, username: str):
+        # joined/left - keeps first_seen/last_seen right for people who never say anything
+        self._commit("seen", username=username, ts=time.time())
+
+    def get_channel_history(self, limit=500, before=None):
+        # newest `limit` messages, or the `limit` just older than message id `before` (scrolling back)
+        if before is None:
+            msgs = self.channel_messages.tail(limit)
+        else:
+            msgs = self.channel_messages.before(before, limit)
+        if self._lazy and len(msgs) < limit:
+            # ran out of whats in memory - range scan on the db (anything queued gets written first)
+            self.persister.flush()
+            return self.store.channel_history(limit, before)
+        return msgs
+
+    def get_channel_since(self, since: int, limit=500):
+        # what a reconnecting client missed after message id `since`, or None if it has to resync:
+        # a /purge happened since, the gap is more than `limit`, or it's older than anything we still have
+        with self._save_lock:
+            if since < self._purge_seq or since > self._seq:
+                return None
+            oldest = self.channel_messages.oldest()
+            if oldest is not None and oldest.id <= since:
+                msgs = self.channel_messages.after(since, limit + 1)
+            elif self._lazy:
+                self.persister.flush()
+                msgs = self.store.channel_since(since, limit + 1)
+            else:
+                return None
+        return msgs if len(msgs) <= limit else None
 
     def _dm_key_str(self, u1: str, u2: str):
         return ",".join(sorted([u1, u2]))
 
-    def add_dm(self, sender: str, recipient: str, text: str):
+    def add_dm(self, sender: str, recipient: str, text: str, blob: str = None):
         key = self._dm_key_str(sender, recipient)
-        if key not in self.dm_conversations:
-            self.dm_conversations[key] = []
-        msg = {"sender": sender, "text": text, "timestamp": time.time()}
-        self.dm_conversations[key].append(msg)
-        self.dm_conversations[key] = self.dm_conversations[key][-self.max_dm_messages:]
-        self.save_all() 
+        msg = StoredMessage(sender, text, time.time(), blob=blob)
+        self._commit("dm", key=key, msg=msg)
         return msg
 
-    def get_dm_history(self, user1: str, user2: str, limit=500):
+    def _apply_dm(self, key, msg):
+        if self._dm_messages(key) is None:
+            self.dm_conversations[key] = History(maxlen=self.max_dm_messages)
+        self.dm_conversations[key].append(msg)
+        self._index_dm(key, msg.timestamp)
+        self._count_message(msg, "dm_messages")
+
+    def _index_dm(self, key, ts):
+        u1, u2 = key.split(",", 1)
+        for user, peer in ((u1, u2), (u2, u1)):
+            peers = self.dm_index.get(user)
+            if peers is None:
+                if self._lazy:
+                    continue  # not pulled out of the db yet, itll be right when it is
+                peers = self.dm_index[user] = {}
+            if ts > peers.get(peer, 0):
+                peers[peer] = ts
+
+    def _dm_messages(self, key):
+        # cached conversation or None - with a lazy store the first look pulls its tail out of the db
+        msgs = self.dm_conversations.get(key)
+        if msgs is None and self._lazy:
+            with self._save_lock:
+                msgs = self.dm_conversations.get(key)
+                if msgs is None:
+                    # a queued rename could still change which rows belong to key
+                    self.persister.flush()
+                    msgs = History(self.store.dm_history(key, self.max_dm_messages), self.max_dm_messages)
+                    self.dm_conversations[key] = msgs
+        return msgs
+
+    def get_dm_history(self, user1: str, user2: str, limit=500, before=None):
         key = self._dm_key_str(user1, user2)
-        msgs = self.dm_conversations.get(key, [])
-        return msgs[-limit:]
+        msgs = self._dm_messages(key)
+        if msgs is None:
+            return []
+        page = msgs.tail(limit) if before is None else msgs.before(before, limit)
+        if self._lazy and len(page) < limit:
+            self.persister.flush()
+            return self.store.dm_history(key, limit, before)
+        return page
 
     def get_last_dm_time_for_user(self, username: str): # chat is this peak
-
-        out = {}
-        for key, msgs in self.dm_conversations.items():
-            u1, u2 = key.split(",", 1)
-            if not msgs:
-                continue
-            ts = msgs[-1]["timestamp"]
-            other = u2 if u1 == username else u1
-            out[other] = max(out.get(other, 0), ts)
-        return out
+        # {peer: ts of newest dm} straight out of dm_index
+        peers = self.dm_index.get(username)
+        if peers is None and self._lazy:
+            with self._save_lock:
+                peers = self.dm_index.get(username)
+                if peers is None:
+                    self.persister.flush()
+                    peers = self.dm_index[username] = self.store.last_dm_times(username)
+        return dict(peers) if peers else {}
+
+    def add_client(self, addr, username: str, conn):
+        # returns True if this is the users first connection (theyve just come online)
+        with self._clients_lock:
+            self.clients[addr] = {"username": username, "last_seen": time.time(), "conn": conn}
+            addrs = self.connections.setdefault(username, set())
+            addrs.add(addr)
+            return len(addrs) == 1
+
+    def remove_client(self, addr):
+        # -> (the removed info or {}, True if that was the users last connection)
+        with self._clients_lock:
+            info = self.clients.pop(addr, None)
+            if info is None:
+                return {}, False
+            addrs = self.connections.get(info["username"])
+            if addrs is not None:
+                addrs.discard(addr)
+                if addrs:
+                    return info, False
+                del self.connections[info["username"]]
+            return info, True
+
+    def client_addrs(self, username: str):
+        # copy, so callers can send/kick while others connect and leave
+        with self._clients_lock:
+            return tuple(self.connections.get(username, ()))
+
+    def online_users(self):
+        with self._clients_lock:
+            return set(self.connections)
+
+    def rename_client(self, old_username: str, new_username: str):
+        with self._clients_lock:
+            addrs = self.connections.pop(old_username, set())
+            for addr in addrs:
+                self.clients[addr]["username"] = new_username
+            if addrs:
+                self.connections.setdefault(new_username, set()).update(addrs)
+            if old_username in self.sessions:
+                self.sessions[new_username] = self.sessions.pop(old_username)
+
+    def client_list(self):
+        # [(addr, info)] copy of clients for broadcasting/reaping
+        with self._clients_lock:
+            return list(self.clients.items())
+
+    def touch_client(self, addr):
+        # .get, not `in` then [] - it can be removed between the two
+        info = self.clients.get(addr)
+        if info is not None:
+            info["last_seen"] = time.time()
+        return info
 
     def set_pending_auth(self, addr, username: str):
         self.pending_auth[addr] = username
@@ -262,16 +580,24 @@ class ServerState:
     def pop_pending_auth(self, addr):
         return self.pending_auth.pop(addr, None)
 
-    def create_session(self, username: str):
+    def create_session(self, username: str, addr):
+        # every device gets its own token, logging in on one doesnt log the others out
         token = secrets.token_hex(32)
-        self.sessions[username] = token
+        with self._clients_lock:
+            self.sessions.setdefault(username, {})[addr] = token
         return token
 
-    def get_session_token(self, username: str):
-        return self.sessions.get(username)
+    def get_session_token(self, username: str, addr):
+        return self.sessions.get(username, {}).get(addr)
 
-    def clear_session(self, username: str):
-        self.sessions.pop(username, None)
+    def clear_session(self, username: str, addr):
+        with self._clients_lock:
+            tokens = self.sessions.get(username)
+            if tokens is None:
+                return
+            tokens.pop(addr, None)
+            if not tokens:
+                self.sessions.pop(username, None)
 
     def is_admin(self, username: str):
         return username in self.admins
@@ -299,37 +625,35 @@ class ServerState:
             return bool(entry.get("muted"))
         return False
 
-    def _ensure_user_dict(self, username: str):
+    def _user_dict(self, username: str):
+        # copy of the entry as a dict - changes are made on the copy and committed whole
         entry = self.users.get(username)
-        if entry is None:
-            return
         if isinstance(entry, dict):
-            return
+            return dict(entry)
         # upgrade legacy plain-text entry to a structured dict, preserving password
-        self.users[username] = {"legacy_password": entry, "banned": False, "muted": False}
+        return {"legacy_password": entry, "banned": False, "muted": False}
 
     def set_banned(self, username: str, banned: bool, reason: str = ""):
-        if username not in self.users:
-            return
-        self._ensure_user_dict(username)
-        entry = self.users[username]
-        if isinstance(entry, dict):
+        # copy, edit, commit all under the lock - otherwise a ban and a mute at the same time lose one
+        with self._saving():
+            if username not in self.users:
+                return
+            entry = self._user_dict(username)
             entry["banned"] = banned
             if banned:
                 if reason is not None:
                     entry["ban_reason"] = reason.strip()[:256]
                 else:
                     entry.pop("ban_reason", None)
-        self.save_all()
+            self._commit("user", username=username, entry=entry)
 
     def set_muted(self, username: str, muted: bool):
-        if username not in self.users:
-            return
-        self._ensure_user_dict(username)
-        entry = self.users[username]
-        if isinstance(entry, dict):
+        with self._saving():
+            if username not in self.users:
+                return
+            entry = self._user_dict(username)
             entry["muted"] = muted
-        self.save_all()
+            self._commit("user", username=username, entry=entry)
 
     def rename_user(self, old_username: str, new_username: str):
         # if a user is renamed in dms then you must reopen dms for msgs to send 
@@ -337,15 +661,23 @@ class ServerState:
         new_username = (new_username or "").strip()
         if not old_username or not new_username:
             return False
-        if old_username not in self.users or new_username in self.users:
-            return False
+        with self._saving():
+            if old_username not in self.users or new_username in self.users:
+                return False
+            self._commit("rename", old=old_username, new=new_username)
 
-        # move user entry
-        self.users[new_username] = self.users.pop(old_username)
+        # update admin set if needed
+        if old_username in self.admins:
+            self.admins.discard(old_username)
+            self.admins.add(new_username)
+            self.save_admins()
+
+        return True
 
-        # move session token if present
-        if old_username in self.sessions:
-            self.sessions[new_username] = self.sessions.pop(old_username)
+    def _apply_rename(self, old_username: str, new_username: str):
+        # move user entry
+        if old_username in self.users:
+            self.users[new_username] = self.users.pop(old_username)
 
         new_dm_conversations = {}
         for key, msgs in self.dm_conversations.items():
@@ -358,27 +690,44 @@ class ServerState:
             new_dm_conversations[new_key] = msgs
         self.dm_conversations = new_dm_conversations
 
-        # update admin set if needed
-        if old_username in self.admins:
-            self.admins.discard(old_username)
-            self.admins.add(new_username)
-            self.save_admins()
-
-        self.save_all()
-        return True
+        # the new name can already have counters (like "system", which posts without being a user) - add
+        # the old ones on instead of replacing them, same as SqliteStore does
+        old_stats = self.user_stats.pop(old_username, None)
+        if old_stats is not None:
+            st = self._stats_for(new_username)
+            for field in ("channel_messages", "dm_messages", "bytes_sent"):
+                st[field] += old_stats[field]
+            for ts in (old_stats["first_seen"], old_stats["last_seen"]):
+                if ts:
+                    self._touch(st, ts)
+
+        peers = self.dm_index.pop(old_username, None)
+        if peers is not None:
+            self.dm_index[new_username] = peers
+        # rename is rare enough that walking every entry is fine - with a lazy store the old name
+        # can be in someone's map even when its own entry hasnt been loaded
+        for peerMap in self.dm_index.values():
+            if old_username in peerMap:
+                peerMap[new_username] = peerMap.pop(old_username)
     
     def get_user_stats(self, username: str):
-        # return dict with stats for a given user (not necessarily one requesting) - send their username, admin or not, banned?, muted?, total number of channel messages sent 
+        # return dict with stats for a given user (not necessarily one requesting) - send their username, admin or not, banned?, muted?, message counters
+        # counters come straight out of user_stats, nothing gets counted here
         entry = self.users.get(username)
         if entry is None:
             return None
         if isinstance(entry, dict):
+            st = self.user_stats.get(username) or {}
             return {
                 "username": username,
                 "is_admin": self.is_admin(username),
                 "is_banned": self.is_banned(username),
                 "is_muted": self.is_muted(username),
-                "total_channel_messages": sum(1 for msg in self.channel_messages if msg["sender"] == username),
+                "total_channel_messages": st.get("channel_messages", 0),
+                "total_dm_messages": st.get("dm_messages", 0),
+                "bytes_sent": st.get("bytes_sent", 0),
+                "first_seen": st.get("first_seen", 0),
+                "last_seen": st.get("last_seen", 0),
             }
         # if hasnt met any of these if statements then return None 
         return None
@@ -386,91 +735,90 @@ class ServerState:
     def isLoginRateLimited(self, ip):
         # check if ip is ratelimited
         now = time.time()
-        if ip not in self.failed_logins:
+        with self._logins_lock:
+            if ip not in self.failed_logins:
+                return False
+            record = self.failed_logins[ip]
+            # remove old attempts outside the window
+            self.failed_logins[ip] = [
+                r for r in record
+                if now - r["timestamp"] <= self.login_rate_limit_window
+            ]
+            # if still have 5+ recent failures, we're locked out for the lockout period
+            if len(self.failed_logins[ip]) >= self.login_rate_limit_attempts:
+                first_attempt = self.failed_logins[ip][0]["timestamp"]
+                if now - first_attempt <= self.login_rate_limit_lockout:
+                    return True
+            # no record or lockout expired
+            if not self.failed_logins[ip]:
+                del self.failed_logins[ip]
             return False
-        record = self.failed_logins[ip]
-        # remove old attempts outside the window
-        self.failed_logins[ip] = [
-            r for r in record
-            if now - r["timestamp"] <= self.login_rate_limit_window
-        ]
-        # if still have 5+ recent failures, we're locked out for the lockout period
-        if len(self.failed_logins[ip]) >= self.login_rate_limit_attempts:
-            first_attempt = self.failed_logins[ip][0]["timestamp"]
-            if now - first_attempt <= self.login_rate_limit_lockout:
-                return True
-        # no record or lockout expired
-        if not self.failed_logins[ip]:
-            del self.failed_logins[ip]
-        return False
 
     def recordFailedLogin(self, ip):
         # record a failed login 
         now = time.time()
-        if ip not in self.failed_logins:
-            self.failed_logins[ip] = []
-        # remove old attempts outside the window
-        self.failed_logins[ip] = [
-            r for r in self.failed_logins[ip]
-            if now - r["timestamp"] <= self.login_rate_limit_window
-        ]
-        # add this attempt
-        self.failed_logins[ip].append({"timestamp": now, "count": len(self.failed_logins[ip]) + 1})
+        with self._logins_lock:
+            # remove old attempts outside the window
+            record = [
+                r for r in self.failed_logins.get(ip, [])
+                if now - r["timestamp"] <= self.login_rate_limit_window
+            ]
+            # add this attempt
+            record.append({"timestamp": now, "count": len(record) + 1})
+            self.failed_logins[ip] = record
         # if we've hit the limit, return seconds until unlock
-        if len(self.failed_logins[ip]) >= self.login_rate_limit_attempts:
-            first_attempt = self.failed_logins[ip][0]["timestamp"]
+        if len(record) >= self.login_rate_limit_attempts:
+            first_attempt = record[0]["timestamp"]
             unlock_time = first_attempt + self.login_rate_limit_lockout
             return max(1, int(unlock_time - now))
         return 0
 
     def clearLoginAttempts(self, ip):
         # clear attempts for an ip if login success
-        if ip in self.failed_logins:
-            del self.failed_logins[ip]
+        with self._logins_lock:
+            self.failed_logins.pop(ip, None)
 
     def addUnreadMessage(self, recipient: str, sender: str):
         # increment unread count for recipient from sender
+        # journal the new count rather than "+1" so replaying it twice cant double count -
+        # which means reading the old one has to be under the same lock or two dms at once count as one
+        with self._saving():
+            count = self.unreadMessages.get(recipient, {}).get(sender, 0) + 1
+            self._commit("unread", user=recipient, sender=sender, count=count)
+
+    def clearUnread(self, username: str, sender: str):
+        # mark conversation as read
+        with self._saving():
+            if sender in self.unreadMessages.get(username, {}):
+                self._commit("unread", user=username, sender=sender, count=0)
+
+    def _apply_unread(self, recipient: str, sender: str, count: int):
         if recipient not in self.unreadMessages:
             self.unreadMessages[recipient] = {}
-        if sender not in self.unreadMessages[recipient]:
-            self.unreadMessages[recipient][sender] = 0
-        self.unreadMessages[recipient][sender] += 1
+        self.unreadMessages[recipient][sender] = count
         # update the set of users with unread msgs
         if recipient not in self.usersWithUnread:
             self.usersWithUnread[recipient] = set()
-        self.usersWithUnread[recipient].add(sender)
-        self.save_all()
-
-    def clearUnread(self, username: str, sender: str):
-        # mark conversation as read
-        if username in self.unreadMessages and sender in self.unreadMessages[username]:
-            self.unreadMessages[username][sender] = 0
-            # remove from the set
-            if username in self.usersWithUnread:
-                self.usersWithUnread[username].discard(sender)
-            self.save_all()
+        if count > 0:
+            self.usersWithUnread[recipient].add(sender)
+        else:
+            self.usersWithUnread[recipient].discard(sender)
 
     def getUnreadCounts(self, username: str):
         # return unread counts for a user {sender: count}
-        if username not in self.unreadMessages:
-            return {}
-        return {k: v for k, v in self.unreadMessages[username].items() if v > 0}
+        counts = dict(self.unreadMessages.get(username, {}))
+        return {k: v for k, v in counts.items() if v > 0}
 
     def getUsersWithUnread(self, username: str):
-        # return set of users who sent unread messages
-        return self.usersWithUnread.get(username, set())
+        # return set of users who sent unread messages (a copy)
+        return set(self.usersWithUnread.get(username, ()))
 
     def reload_config(self):
         # reload all config values from disk - admin only
-        # 2nd value passed is default 
-        self.admins = self._load_admins()
-        self.fetch_cooldown = self._load_config_int("fetch_cooldown", 30) 
-        self.msg_rate_limit = self._load_config_float("msg_rate_limit", 1.0)
-        self.max_msg_len = self._load_config_int("max_msg_len", 400)
-        self.max_channel_messages = self._load_config_int("max_channel_messages", 2000)
-        self.max_dm_messages = self._load_config_int("max_dm_messages", 5000)
-        self.login_rate_limit_attempts = self._load_config_int("login_rate_limit_attempts", 5)
-        self.login_rate_limit_window = self._load_config_int("login_rate_limit_window", 300)
-        self.login_rate_limit_lockout = self._load_config_int("login_rate_limit_lockout", 900)
-
-
+        self._config = self._read_config()
+        self._load_settings()
+        self.channel_messages.resize(self.max_channel_messages)
+        for msgs in list(self.dm_conversations.values()):
+            msgs.resize(self.max_dm_messages)
+        self.previews.max_pixels = self.max_image_pixels
+        # durability + flush timing only take effect on restart, the persister is already running
@@ -0,0 +1,392 @@
+import json
+import os
+import sqlite3
+import threading
+from rich import print
+
+from lantern_chat.server.history import StoredMessage, to_json
+from lantern_chat.server.journal import Journal
+
+STORAGE_KINDS = ("json", "sqlite")
+
+
+def write_atomic(path: str, payload, sync: bool = True):
+    # write to a temp file and swap it in so a crash never leaves half a file
+    tmp = path + ".tmp"
+    with open(tmp, "w") as f:
+        json.dump(payload, f, default=to_json)
+        f.flush()
+        if sync:
+            os.fsync(f.fileno())
+    os.replace(tmp, path)
+
+
+def _read_json(path: str):
+    if not os.path.exists(path):
+        return {}
+    try:
+        with open(path, "r") as f:
+            data = json.load(f)
+        return data if isinstance(data, dict) else {}
+    except Exception as e:
+        print(f"[red][ERROR][/red] couldn't read {path}: {e}")
+        return {}
+
+
+_STAT_KEYS = {"channel_messages", "dm_messages", "bytes_sent", "first_seen", "last_seen"}
+
+
+def _valid_messages(msgs, limit):
+    # keep the last `limit` well formed messages as StoredMessage, returns (messages, how many were thrown away)
+    if not isinstance(msgs, list):
+        return [], 0
+    # just the shape - full type checks on every message cost more than parsing the file did
+    msgs = msgs[-limit:]
+    out = [
+        StoredMessage(m["sender"], m["text"], m["timestamp"], m.get("id"), m.get("blob"))
+        for m in msgs
+        if type(m) is dict and "sender" in m and "text" in m and "timestamp" in m
+    ]
+    return out, len(msgs) - len(out)
+
+
+class JsonStore:
+    # the original layout - messages.json + users.json snapshot, journal.log for everything since
+    # the whole thing lives in memory, ServerState loads it all at startup
+    lazy = False
+    compacts = True
+
+    def __init__(self, history_file: str, users_file: str, journal_file: str):
+        self.history_file = history_file
+        self.users_file = users_file
+        self.journal = Journal(journal_file)
+
+    def load(self, max_channel, max_dm):
+        # one parse per file (it used to be one per field), trimmed + checked on the way in
+        users = _read_json(self.users_file)
+        data = _read_json(self.history_file)
+        channel, skipped = _valid_messages(data.get("channel"), max_channel)
+        dm = {}
+        rawDm = data.get("dm")
+        for key, msgs in (rawDm.items() if isinstance(rawDm, dict) else ()):
+            if "," not in key:
+                skipped += 1
+                continue
+            dm[key], bad = _valid_messages(msgs, max_dm)
+            skipped += bad
+        unread = {}
+        rawUnread = data.get("unread")
+        for user, counts in (rawUnread.items() if isinstance(rawUnread, dict) else ()):
+            if isinstance(counts, dict):
+                unread[user] = {s: c for s, c in counts.items() if isinstance(c, int)}
+        stats = None
+        rawStats = data.get("stats")
+        if isinstance(rawStats, dict):
+            stats = {u: st for u, st in rawStats.items() if isinstance(st, dict) and _STAT_KEYS <= st.keys()}
+            skipped += len(rawStats) - len(stats)
+        try:
+            seq = int(data.get("seq", 0))
+            purgeSeq = int(data.get("purge_seq", 0))
+        except (TypeError, ValueError):
+            seq = purgeSeq = 0
+        return {
+            "users": users,
+            "channel": channel,
+            "dm": dm,
+            "unread": unread,
+            "stats": stats,
+            "seq": seq,
+            "purge_seq": purgeSeq,
+            "skipped": skipped,
+        }
+
+    def replay(self):
+        return self.journal.replay()
+
+    def write(self, batch):
+        self.journal.append(batch)
+
+    def sync(self):
+        self.journal.sync()
+
+    def snapshot(self, files, sync=True):
+        # files is [(path, payload)] from ServerState._capture_snapshot
+        for path, payload in files:
+            write_atomic(path, payload, sync)
+        self.journal.reset()
+
+    def close(self):
+        self.journal.close()
+
+
+class SqliteStore:
+    # one sqlite file with indexed tables, written by the persister thread one transaction per batch
+    # users + unread counts are small and stay in memory. messages dont - only the channel tail
+    # is loaded at startup and dm conversations get pulled in the first time someone touches them,
+    # anything older than that is read straight out of the db
+    lazy = True
+    compacts = False
+
+    # durability -> synchronous pragma, commits are already one per batch
+    SYNC_MODES = {"none": "OFF", "batched": "NORMAL", "every-write": "FULL"}
+
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT);
+        CREATE TABLE IF NOT EXISTS users (username TEXT PRIMARY KEY, entry TEXT NOT NULL);
+        CREATE TABLE IF NOT EXISTS channel (
+            id INTEGER PRIMARY KEY, sender TEXT NOT NULL, text TEXT NOT NULL, timestamp REAL NOT NULL, blob TEXT
+        );
+        CREATE TABLE IF NOT EXISTS dm (
+            id INTEGER PRIMARY KEY, u1 TEXT NOT NULL, u2 TEXT NOT NULL,
+            sender TEXT NOT NULL, text TEXT NOT NULL, timestamp REAL NOT NULL, blob TEXT
+        );
+        CREATE INDEX IF NOT EXISTS dm_convo ON dm (u1, u2, id);
+        CREATE INDEX IF NOT EXISTS dm_u2 ON dm (u2);
+        CREATE TABLE IF NOT EXISTS unread (
+            username TEXT NOT NULL, sender TEXT NOT NULL, count INTEGER NOT NULL,
+            PRIMARY KEY (username, sender)
+        );
+        CREATE TABLE IF NOT EXISTS user_stats (
+            username TEXT PRIMARY KEY, channel_messages INTEGER NOT NULL, dm_messages INTEGER NOT NULL,
+            bytes_sent INTEGER NOT NULL, first_seen REAL NOT NULL, last_seen REAL NOT NULL
+        );
+    """
+
+    # add to a user's counters, same rules as ServerState._count_message/_touch
+    BUMP_STATS = """
+        INSERT INTO user_stats (username, channel_messages, dm_messages, bytes_sent, first_seen, last_seen)
+        VALUES (?, ?, ?, ?, ?, ?)
+        ON CONFLICT (username) DO UPDATE SET
+            channel_messages = channel_messages + excluded.channel_messages,
+            dm_messages = dm_messages + excluded.dm_messages,
+            bytes_sent = bytes_sent + excluded.bytes_sent,
+            first_seen = CASE WHEN first_seen = 0 OR excluded.first_seen < first_seen
+                THEN excluded.first_seen ELSE first_seen END,
+            last_seen = MAX(last_seen, excluded.last_seen)
+    """
+
+    # fold one user's counters into another's on rename - the new name can already have a row
+    MERGE_STATS = """
+        INSERT INTO user_stats (username, channel_messages, dm_messages, bytes_sent, first_seen, last_seen)
+        SELECT ?, channel_messages, dm_messages, bytes_sent, first_seen, last_seen FROM user_stats WHERE username = ?
+        ON CONFLICT (username) DO UPDATE SET
+            channel_messages = channel_messages + excluded.channel_messages,
+            dm_messages = dm_messages + excluded.dm_messages,
+            bytes_sent = bytes_sent + excluded.bytes_sent,
+            first_seen = CASE WHEN excluded.first_seen = 0 THEN first_seen
+                WHEN first_seen = 0 OR excluded.first_seen < first_seen THEN excluded.first_seen ELSE first_seen END,
+            last_seen = MAX(last_seen, excluded.last_seen)
+    """
+
+    def __init__(self, db_file: str, durability: str = "batched"):
+        self.db_file = db_file
+        self.is_new = not os.path.exists(db_file)
+        # writes only ever come from the persister thread, reads from handler threads share one connection
+        self._db = sqlite3.connect(db_file, check_same_thread=False)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute(f"PRAGMA synchronous={self.SYNC_MODES.get(durability, 'NORMAL')}")
+        self._db.executescript(self.SCHEMA)
+        self._add_blob_columns()
+        self._backfill_stats()
+        self._db.commit()
+        self._read = sqlite3.connect(db_file, check_same_thread=False)
+        self._readLock = threading.Lock()
+
+    def _add_blob_columns(self):
+        # dbs from before images were kept - CREATE TABLE IF NOT EXISTS doesnt touch existing tables
+        for table in ("channel", "dm"):
+            cols = [row[1] for row in self._db.execute(f"PRAGMA table_info({table})")]
+            if "blob" not in cols:
+                self._db.execute(f"ALTER TABLE {table} ADD COLUMN blob TEXT")
+
+    def _backfill_stats(self):
+        # dbs from before user_stats existed - count everything once
+        db = self._db
+        if db.execute("SELECT 1 FROM user_stats LIMIT 1").fetchone():
+            return
+        db.execute("""
+            INSERT INTO user_stats
+            SELECT sender, SUM(c), SUM(d), SUM(b), MIN(ts), MAX(ts) FROM (
+                SELECT sender, 1 AS c, 0 AS d, LENGTH(CAST(text AS BLOB)) AS b, timestamp AS ts FROM channel
+                UNION ALL
+                SELECT sender, 0, 1, LENGTH(CAST(text AS BLOB)), timestamp FROM dm
+            ) GROUP BY sender
+        """)
+
+    def _query(self, sql, args=()):
+        with self._readLock:
+            return self._read.execute(sql, args).fetchall()
+
+    def load(self, max_channel, max_dm):
+        # no dm messages up front, ServerState asks for each conversation when its first used
+        meta = dict(self._query("SELECT key, value FROM meta"))
+        seq = int(meta.get("seq", 0))
+        # message ids are seqs, but dbs from before that numbered their rows on their own -
+        # start past the biggest one so new messages still sort after them
+        for (top,) in self._query("SELECT MAX(id) FROM channel UNION ALL SELECT MAX(id) FROM dm"):
+            if top is not None and top > seq:
+                seq = top
+        unread = {}
+        for user, sender, count in self._query("SELECT username, sender, count FROM unread"):
+            unread.setdefault(user, {})[sender] = count
+        stats = {}
+        for row in self._query(
+            "SELECT username, channel_messages, dm_messages, bytes_sent, first_seen, last_seen FROM user_stats"
+        ):
+            stats[row[0]] = dict(zip(("channel_messages", "dm_messages", "bytes_sent", "first_seen", "last_seen"), row[1:]))
+        return {
+            "users": {u: json.loads(e) for u, e in self._query("SELECT username, entry FROM users")},
+            "channel": self.channel_history(max_channel),
+            "dm": {},
+            "unread": unread,
+            "stats": stats,
+            "seq": seq,
+            "purge_seq": int(meta.get("purge_seq", 0)),
+            "skipped": 0,
+        }
+
+    def channel_history(self, limit, before=None):
+        # newest `limit` messages (older than id `before` if given), oldest first
+        rows = self._query(
+            "SELECT id, sender, text, timestamp, blob FROM channel WHERE id < ? ORDER BY id DESC LIMIT ?",
+            (self._cursor(before), limit),
+        )
+        return [StoredMessage(s, t, ts, i, b) for i, s, t, ts, b in reversed(rows)]
+
+    def channel_since(self, since, limit):
+        # messages after id `since`, oldest first - what a reconnecting client missed
+        rows = self._query(
+            "SELECT id, sender, text, timestamp, blob FROM channel WHERE id > ? ORDER BY id LIMIT ?", (since, limit)
+        )
+        return [StoredMessage(s, t, ts, i, b) for i, s, t, ts, b in rows]
+
+    def dm_history(self, key, limit, before=None):
+        u1, u2 = key.split(",", 1)
+        rows = self._query(
+            "SELECT id, sender, text, timestamp, blob FROM dm WHERE u1 = ? AND u2 = ? AND id < ? ORDER BY id DESC LIMIT ?",
+            (u1, u2, self._cursor(before), limit),
+        )
+        return [StoredMessage(s, t, ts, i, b) for i, s, t, ts, b in reversed(rows)]
+
+    def _cursor(self, before):
+        # no cursor = from the newest message, ids are 64 bit in sqlite
+        return (1 << 63) - 1 if before is None else before
+
+    def last_dm_times(self, username):
+        # other user -> timestamp of the newest dm with them
+        rows = self._query(
+            "SELECT u2, MAX(timestamp) FROM dm WHERE u1 = ? GROUP BY u2 "
+            "UNION ALL SELECT u1, MAX(timestamp) FROM dm WHERE u2 = ? GROUP BY u1",
+            (username, username),
+        )
+        out = {}
+        for other, ts in rows:
+            out[other] = max(out.get(other, 0), ts)
+        return out
+
+    def write(self, batch):
+        # one transaction for the whole batch, the records are the same ones the json journal gets
+        db = self._db
+        with db:
+            for rec in batch:
+                op = rec["op"]
+                if op == "user":
+                    db.execute(
+                        "INSERT OR REPLACE INTO users (username, entry) VALUES (?, ?)",
+                        (rec["username"], json.dumps(rec["entry"])),
+                    )
+                elif op == "chan":
+                    m = rec["msg"]
+                    db.execute(
+                        "INSERT INTO channel (id, sender, text, timestamp, blob) VALUES (?, ?, ?, ?, ?)",
+                        (m.id, m.sender, m.text, m.timestamp, m.blob),
+                    )
+                    db.execute(self.BUMP_STATS, (m.sender, 1, 0, len(m.text.encode()), m.timestamp, m.timestamp))
+                elif op == "purge":
+                    purged = db.execute(
+                        "SELECT sender, COUNT(*) FROM (SELECT sender FROM channel ORDER BY id DESC LIMIT ?) GROUP BY sender",
+                        (rec["count"],),
+                    ).fetchall()
+                    db.executemany(
+                        "UPDATE user_stats SET channel_messages = MAX(channel_messages - ?, 0) WHERE username = ?",
+                        [(n, sender) for sender, n in purged],
+                    )
+                    db.execute(
+                        "DELETE FROM channel WHERE id IN (SELECT id FROM channel ORDER BY id DESC LIMIT ?)",
+                        (rec["count"],),
+                    )
+                    db.execute("INSERT OR REPLACE INTO meta (key, value) VALUES ('purge_seq', ?)", (str(rec["seq"]),))
+                elif op == "dm":
+                    m = rec["msg"]
+                    u1, u2 = rec["key"].split(",", 1)
+                    db.execute(
+                        "INSERT INTO dm (id, u1, u2, sender, text, timestamp, blob) VALUES (?, ?, ?, ?, ?, ?, ?)",
+                        (m.id, u1, u2, m.sender, m.text, m.timestamp, m.blob),
+                    )
+                    db.execute(self.BUMP_STATS, (m.sender, 0, 1, len(m.text.encode()), m.timestamp, m.timestamp))
+                elif op == "rename":
+                    old, new = rec["old"], rec["new"]
+                    db.execute("UPDATE users SET username = ? WHERE username = ?", (new, old))
+                    db.execute(self.MERGE_STATS, (new, old))
+                    db.execute("DELETE FROM user_stats WHERE username = ?", (old,))
+                    db.execute("UPDATE dm SET u1 = ? WHERE u1 = ?", (new, old))
+                    db.execute("UPDATE dm SET u2 = ? WHERE u2 = ?", (new, old))
+                    # keep (u1, u2) sorted like the "a,b" conversation keys
+                    db.execute("UPDATE dm SET u1 = u2, u2 = u1 WHERE (u1 = ? OR u2 = ?) AND u1 > u2", (new, new))
+                elif op == "unread":
+                    if rec["count"] > 0:
+                        db.execute(
+                            "INSERT OR REPLACE INTO unread (username, sender, count) VALUES (?, ?, ?)",
+                            (rec["user"], rec["sender"], rec["count"]),
+                        )
+                    else:
+                        db.execute("DELETE FROM unread WHERE username = ? AND sender = ?", (rec["user"], rec["sender"]))
+                elif op == "seen":
+                    db.execute(self.BUMP_STATS, (rec["username"], 0, 0, 0, rec["ts"], rec["ts"]))
+            db.execute("INSERT OR REPLACE INTO meta (key, value) VALUES ('seq', ?)", (str(batch[-1]["seq"]),))
+
+    def sync(self):
+        # commit in write() already synced as hard as the pragma says
+        pass
+
+    def import_state(self, users, channel, dm, unread, stats, seq, purge_seq=0):
+        # first start on sqlite with old json files around - copy everything over once
+        db = self._db
+        with db:
+            db.executemany(
+                "INSERT OR REPLACE INTO users (username, entry) VALUES (?, ?)",
+                [(u, json.dumps(e)) for u, e in users.items()],
+            )
+            db.executemany(
+                "INSERT INTO channel (id, sender, text, timestamp, blob) VALUES (?, ?, ?, ?, ?)",
+                [(m.id, m.sender, m.text, m.timestamp, m.blob) for m in channel],
+            )
+            for key, msgs in dm.items():
+                u1, u2 = key.split(",", 1)
+                db.executemany(
+                    "INSERT INTO dm (id, u1, u2, sender, text, timestamp, blob) VALUES (?, ?, ?, ?, ?, ?, ?)",
+                    [(m.id, u1, u2, m.sender, m.text, m.timestamp, m.blob) for m in msgs],
+                )
+            db.executemany(
+                "INSERT OR REPLACE INTO unread (username, sender, count) VALUES (?, ?, ?)",
+                [(u, s, c) for u, m in unread.items() for s, c in m.items() if c > 0],
+            )
+            db.executemany(
+                "INSERT OR REPLACE INTO user_stats VALUES (?, ?, ?, ?, ?, ?)",
+                [
+                    (u, st["channel_messages"], st["dm_messages"], st["bytes_sent"], st["first_seen"], st["last_seen"])
+                    for u, st in stats.items()
+                ],
+            )
+            db.execute("INSERT OR REPLACE INTO meta (key, value) VALUES ('seq', ?)", (str(seq),))
+            db.execute("INSERT OR REPLACE INTO meta (key, value) VALUES ('purge_seq', ?)", (str(purge_seq),))
+
+    def snapshot(self, files, sync=True):
+        pass
+
+    def close(self):
+        try:
+            self._read.close()
+            self._db.close()
+        except sqlite3.Error:
+            pass
@@ -1,9 +1,10 @@
 import argparse
 import json
 import os
+import shutil
 
-from lantern_chat.server.state import ServerState, HISTORY_FILE, USERS_FILE, CONFIG_FILE
-from lantern_chat.server.net import networkManager
+from lantern_chat.server.state import ServerState, HISTORY_FILE, USERS_FILE, JOURNAL_FILE, DB_FILE, BLOB_DIR, CONFIG_FILE
+from lantern_chat.server.net import networkManager, asyncNetworkManager
 
 def fetch_version():
     # pull from package metadata if available
@@ -18,6 +19,7 @@ def _load_server_config():
         default = {
             "admins": [],
             "port": 6000,
+            "engine": "threads",
             "fetch_cooldown": 30,
             "msg_rate_limit": 1.0,
             "max_msg_len": 400,
@@ -25,7 +27,17 @@ def _load_server_config():
             "max_dm_messages": 5000,
             "login_rate_limit_attempts": 5,
             "login_rate_limit_window": 300,
-            "login_rate_limit_lockout": 900
+            "login_rate_limit_lockout": 900,
+            "outbox_soft_limit": 1048576,
+            "outbox_high_water": 33554432,
+            "presence_coalesce_ms": 250,
+            "journal_compact_every": 5000,
+            "storage": "json",
+            "durability": "batched",
+            "flush_interval_ms": 50,
+            "flush_batch": 256,
+            "preview_workers": 2,
+            "max_image_pixels": 40000000
         }
         try:
             with open(CONFIG_FILE, "w") as f:
@@ -55,7 +67,7 @@ def clear_db():
         print("Aborting database reset.")
         return
 
-    for path in (HISTORY_FILE, USERS_FILE):
+    for path in (HISTORY_FILE, USERS_FILE, JOURNAL_FILE, DB_FILE, DB_FILE + "-wal", DB_FILE + "-shm"):
         try:
             if os.path.exists(path):
                 os.unlink(path)
@@ -63,6 +75,14 @@ def clear_db():
         except OSError as e:
             print(f"Failed to remove {path}: {e}")
 
+    # image blobs, their previews and any half finished uploads
+    try:
+        if os.path.isdir(BLOB_DIR):
+            shutil.rmtree(BLOB_DIR)
+            print(f"Removed {BLOB_DIR}")
+    except OSError as e:
+        print(f"Failed to remove {BLOB_DIR}: {e}")
+
 
 def main():
     file_config = _load_server_config()
@@ -70,6 +90,7 @@ def main():
     parser = argparse.ArgumentParser(description="Lantern chat server")
     parser.add_argument("--reset-db", action="store_true", help="Clear all stored messages and users")
     parser.add_argument("--port", "-p", type=int, help="Port to listen on (default: 6000)")
+    parser.add_argument("--engine", choices=("threads", "asyncio"), help="Connection engine - one thread per client or a single asyncio loop (default: threads)")
     parser.add_argument("--version", "-v", help="Show version information", action="version", version=fetch_version())
     args = parser.parse_args()
 
@@ -84,6 +105,17 @@ def main():
     if args.reset_db:
         clear_db()
 
+    engine = args.engine or file_config.get("engine") or "threads"
+
     state = ServerState()
-    network = networkManager(HOST, PORT, state)
-    network.run()
+    if engine == "asyncio":
+        network = asyncNetworkManager(HOST, PORT, state)
+    else:
+        network = networkManager(HOST, PORT, state)
+    try:
+        network.run()
+    except KeyboardInterrupt:
+        print("Shutting down...")
+    finally:
+        # flush anything the persister hasn't written yet
+        state.close()
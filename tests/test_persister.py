@@ -0,0 +1,70 @@
+# the Persister on its own, against a store that refuses some records
+import threading
+import unittest
+
+from lantern_chat.server.persister import Persister
+
+
+class _State:
+    _seq = 0
+    journal_compact_every = 1000
+    _save_lock = threading.RLock()
+
+
+class _Store:
+    # all or nothing per write() like the real ones, and anything marked bad breaks the write its in
+    compacts = False
+
+    def __init__(self, bad=()):
+        self.bad = set(bad)
+        self.rows = []
+        self.syncs = 0
+
+    def write(self, batch):
+        if any(r["seq"] in self.bad for r in batch):
+            raise ValueError("bad record")
+        self.rows.extend(r["seq"] for r in batch)
+
+    def sync(self):
+        self.syncs += 1
+
+
+class PersisterTest(unittest.TestCase):
+    def _persister(self, store, **kw):
+        p = Persister(_State(), store, **kw)
+        self.addCleanup(p.close)
+        return p
+
+    def _submit(self, p, seqs):
+        # all queued before the thread gets to them, so they go out as one batch
+        with p._cond:
+            p._pending.extend({"seq": s, "op": "chan"} for s in seqs)
+            p._cond.notify()
+
+    def test_bad_record_only_drops_itself(self):
+        store = _Store(bad={3})
+        p = self._persister(store)
+        self._submit(p, range(1, 6))
+        p.wait(5)
+        self.assertEqual(store.rows, [1, 2, 4, 5])
+        self.assertEqual(p._durable, 5)
+
+    def test_dropped_record_is_not_durable(self):
+        store = _Store(bad={4})
+        p = self._persister(store, durability="every-write")
+        self._submit(p, range(1, 5))
+        done = threading.Event()
+        threading.Thread(target=lambda: (p.wait(4), done.set()), daemon=True).start()
+        self.assertTrue(done.wait(10), "waiter on a dropped record never let go")
+        self.assertEqual(store.rows, [1, 2, 3])
+        self.assertEqual(p._durable, 3)
+        self.assertEqual(p._written, 3)
+        # a later record going through moves past it
+        self._submit(p, [5])
+        p.wait(5)
+        self.assertEqual(p._durable, 5)
+        self.assertEqual(p._dropped, set())
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,184 @@
+# hammers ServerState + the handlers from a lot of threads at once, then checks nothing drifted:
+# unread counts match the dms stored, the connection index matches clients, sessions match connections,
+# message ids only ever go up. plus every-write durability, which has to finish rather than deadlock
+import json
+import os
+import random
+import shutil
+import sys
+import tempfile
+import threading
+import time
+import unittest
+from unittest import mock
+
+from lantern_chat.server import state as state_mod
+from lantern_chat.server.net import networkManager
+from lantern_chat.server.state import ServerState
+
+USERS = [f"u{i}" for i in range(12)]
+ROUNDS = 200
+THREADS = 12
+
+
+class _Conn:
+    proto = 1
+
+    def put(self, msg):
+        return True
+
+    def close(self):
+        pass
+
+
+def _net(st):
+    # the handlers without a socket behind them
+    return networkManager("127.0.0.1", 0, st, listen=False)
+
+
+class StateStressTest(unittest.TestCase):
+    def setUp(self):
+        # state.py worked its paths out from HOME when it was imported - point every one of them into a
+        # temp dir for this test, whoever imported it first
+        tmp = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmp, ignore_errors=True)
+        data, config = os.path.join(tmp, "data"), os.path.join(tmp, "config")
+        paths = {
+            "_DATA_DIR": data,
+            "_CONFIG_DIR": config,
+            "HISTORY_FILE": os.path.join(data, "messages.json"),
+            "USERS_FILE": os.path.join(data, "users.json"),
+            "JOURNAL_FILE": os.path.join(data, "journal.log"),
+            "DB_FILE": os.path.join(data, "lantern.db"),
+            "BLOB_DIR": os.path.join(data, "blobs"),
+            "CONFIG_FILE": os.path.join(config, "server.json"),
+        }
+        for name, path in paths.items():
+            patcher = mock.patch.object(state_mod, name, path)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        for name in paths:
+            self.assertTrue(getattr(state_mod, name).startswith(tmp + os.sep), name)
+        os.makedirs(data)
+        os.makedirs(config)
+        self.switch = sys.getswitchinterval()
+        sys.setswitchinterval(1e-5)  # switch threads as often as possible
+
+    def tearDown(self):
+        sys.setswitchinterval(self.switch)
+
+    def _state(self, cleanup=True, **config):
+        config.setdefault("msg_rate_limit", 0)
+        config.setdefault("max_dm_messages", 100000)
+        config.setdefault("max_channel_messages", 100000)
+        with open(state_mod.CONFIG_FILE, "w") as f:
+            json.dump(config, f)
+        st = ServerState()
+        if cleanup:
+            self.addCleanup(st.close)
+        return st
+
+    def _hammer(self, st):
+        net = _net(st)
+        for u in USERS:
+            st.register_user(u, "pw")
+        errors = []
+        done = threading.Event()
+
+        def worker(w):
+            try:
+                rnd = random.Random(w)
+                for i in range(ROUNDS):
+                    u = rnd.choice(USERS)
+                    addr = (f"10.0.0.{w}", i)
+                    st.set_pending_auth(addr, u)
+                    st.create_session(u, addr)
+                    net.handleJoin(f"[JOIN]|{u}", {"addr": addr, "conn": _Conn(), "blob": None})
+                    peer = rnd.choice([x for x in USERS if x != u])
+                    net.handleDm(f"[DM]|{peer}|m{w}-{i}", {"addr": addr, "conn": None, "blob": None})
+                    net._processMessage(f"[{u}]: hi {w} {i}", addr, None)
+                    st.recordFailedLogin("1.2.3.4")
+                    st.getUnreadCounts(rnd.choice(USERS))
+                    st.get_user_stats(u)
+                    st.get_dm_history(u, peer, 20)
+                    if rnd.random() < 0.7:
+                        net.handleLeave(f"[LEAVE]|{u}", {"addr": addr, "conn": None, "blob": None})
+            except Exception as e:
+                errors.append(e)
+
+        def reaper():
+            # drops random connections under the workers, like cleanupLoop timing them out
+            while not done.is_set():
+                for addr, _info in st.client_list():
+                    if random.random() < 0.05:
+                        net.handleLeave({"addr": addr, "conn": None}, None)
+                net.sendUserListDetailed(("x", 0), "u0")
+                time.sleep(0.001)
+
+        threads = [threading.Thread(target=worker, args=(w,)) for w in range(THREADS)]
+        reap = threading.Thread(target=reaper)
+        for t in threads + [reap]:
+            t.start()
+        for t in threads:
+            t.join(120)
+        done.set()
+        reap.join(10)
+        self.assertFalse(any(t.is_alive() for t in threads + [reap]), "stress threads stuck")
+        self.assertEqual(errors, [])
+        self._check(st)
+
+    def _check(self, st):
+        # nobody read anything, so every stored dm is exactly one unread
+        stored = {}
+        for key, msgs in st.dm_conversations.items():
+            a, b = key.split(",")
+            for m in msgs:
+                rcpt = b if m.sender == a else a
+                stored[(rcpt, m.sender)] = stored.get((rcpt, m.sender), 0) + 1
+        self.assertTrue(stored)
+        for (rcpt, sender), n in stored.items():
+            self.assertEqual(st.unreadMessages.get(rcpt, {}).get(sender, 0), n, (rcpt, sender))
+        self.assertEqual(len(st.failed_logins["1.2.3.4"]), ROUNDS * THREADS)
+
+        index = {}
+        for addr, info in st.client_list():
+            index.setdefault(info["username"], set()).add(addr)
+        self.assertEqual(index, st.connections)
+        for user, tokens in st.sessions.items():
+            self.assertEqual(set(tokens), st.connections.get(user, set()), user)
+
+        ids = [m.id for m in st.channel_messages]
+        self.assertEqual(ids, sorted(set(ids)))
+        dm_ids = [m.id for msgs in st.dm_conversations.values() for m in msgs]
+        self.assertEqual(len(dm_ids), len(set(dm_ids)))
+
+    def test_json(self):
+        self._hammer(self._state(storage="json"))
+
+    def test_sqlite(self):
+        self._hammer(self._state(storage="sqlite"))
+
+    def test_every_write_compacting(self):
+        # every-write waits on the persister, which needs _save_lock to snapshot - waiting while holding
+        # it hung the second register_user once compaction came round
+        # closed by hand - close() on a deadlocked state would hang the test run instead of failing it
+        st = self._state(cleanup=False, durability="every-write", journal_compact_every=1)
+        failed = []
+
+        def run():
+            try:
+                self._hammer(st)
+            except BaseException as e:
+                failed.append(e)
+
+        worker = threading.Thread(target=run, daemon=True)
+        worker.start()
+        worker.join(120)
+        self.assertFalse(worker.is_alive(), "every-write deadlocked")
+        st.close()
+        if failed:
+            raise failed[0]
+
+
+if __name__ == "__main__":
+    unittest.main()